@@ -1,13 +1,67 @@
 # __init__.py (i huvudkatalogen)
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
 import os
 
 # Initiera delade extensions
-db = SQLAlchemy()
+# Databasinstansen definieras i models.py så att modeller, rutter och app delar samma instans
+from models import db
 login_manager = LoginManager()
 
+# Databasprofil: anslutningspool och SQLite-inställningar (kan ändras via miljön)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 20))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', 65536))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+
+def _is_memory_sqlite(url):
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+def engine_options(uri):
+    """SQLALCHEMY_ENGINE_OPTIONS för en databas-URL"""
+    url = make_url(uri)
+    if _is_memory_sqlite(url):
+        # Minnesdatabaser har en egen pool (en anslutning); inget att ställa in
+        return {}
+    options = {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+    }
+    if url.get_backend_name() != 'sqlite':
+        # Servern stänger inaktiva anslutningar; kontrollera och förnya dem
+        options.update(pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=True)
+    return options
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """Körs för varje ny SQLite-anslutning.
+
+    WAL låter läsare och en skrivare arbeta samtidigt, och busy_timeout gör
+    att en skrivare väntar på låset i stället för att få "database is locked".
+    synchronous=NORMAL är säkert i WAL-läge (bara den senaste transaktionen
+    kan gå förlorad vid strömavbrott, databasen blir aldrig korrupt).
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f'PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}')
+    cursor.execute('PRAGMA journal_mode = WAL')
+    cursor.execute('PRAGMA synchronous = NORMAL')
+    cursor.execute(f'PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}')
+    cursor.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_SIZE}')
+    cursor.execute('PRAGMA temp_store = MEMORY')
+    cursor.close()
+
+def configure_engines(app):
+    """Koppla in SQLite-inställningarna på appens databasmotorer"""
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite' and not _is_memory_sqlite(engine.url):
+                event.listen(engine, 'connect', apply_sqlite_pragmas)
+
 def create_app():
     app = Flask(__name__)
     
@@ -15,9 +69,19 @@ def create_app():
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', os.urandom(24))
     app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///resonate.db')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+    # /api/metrics är bara för intern övervakning och avstängd som standard
+    app.config['METRICS_ENABLED'] = os.getenv('METRICS_ENABLED') == '1'
+    
+    # Läsrepliker (kommaseparerade URL:er); används av rutter märkta @replica_reads
+    from services.db_routing import replicas, replica_binds
+    replica_urls = [url.strip() for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    app.config['SQLALCHEMY_BINDS'] = replica_binds(replica_urls, engine_options)
     
     # Initiera databas
     db.init_app(app)
+    configure_engines(app)
+    replicas.init_app(app, db)
     
     # Initiera login_manager
     login_manager.init_app(app)
@@ -44,8 +108,22 @@ def create_app():
     def load_user(user_id):
         return User.query.get(int(user_id))
     
-    # Skapa databastabeller
+    # Bakgrundsjobb (hanterarna registreras när job_handlers importeras av rutterna)
+    from services.jobs import jobs
+    jobs.init_app(app)
+    
+    # Registrera CLI-kommandon
+    from commands import register_commands
+    register_commands(app)
+    
+    # Skapa databastabeller och gör schemaändringar för befintliga databaser
+    # (index, unika villkor, nya kolumner), en arbetsprocess i taget
     with app.app_context():
-        db.create_all()
+        from services import migrations
+        migrations.upgrade()
+        
+        # Sökindex för användarnamn (FTS5/trigram på SQLite, pg_trgm på Postgres)
+        from services.user_search import ensure_index
+        ensure_index(app)
     
     return app
\ No newline at end of file
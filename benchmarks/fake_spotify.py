@@ -0,0 +1,182 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+
+from flask import Flask, jsonify, request
+
+# Lokal attrapp av Spotifys token- och sök-API för benchmarks utan nätverk.
+# Svaren byggs från inspelade sökresultat i fixtures/spotify_search.json.
+# Starta med `python benchmarks/fake_spotify.py` och peka appen hit med
+# SPOTIFY_ACCOUNTS_URL och SPOTIFY_API_URL.
+FIXTURES_PATH = os.getenv(
+    'FAKE_SPOTIFY_FIXTURES',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'spotify_search.json')
+)
+
+TOKEN_LIFETIME = 3600
+
+DEFAULTS = {
+    'latency_ms': float(os.getenv('FAKE_SPOTIFY_LATENCY_MS', 80)),
+    'jitter_ms': float(os.getenv('FAKE_SPOTIFY_JITTER_MS', 40)),
+    'error_rate': float(os.getenv('FAKE_SPOTIFY_ERROR_RATE', 0)),
+    'rate_limit_rate': float(os.getenv('FAKE_SPOTIFY_429_RATE', 0)),
+    'retry_after': int(os.getenv('FAKE_SPOTIFY_RETRY_AFTER', 1)),
+    'token_lifetime': int(os.getenv('FAKE_SPOTIFY_TOKEN_LIFETIME', TOKEN_LIFETIME)),
+}
+
+SEARCH_TYPES = ('track', 'album', 'artist')
+
+
+def load_fixtures(path=FIXTURES_PATH):
+    with open(path, encoding='utf-8') as file:
+        fixtures = json.load(file)
+    return {search_type: fixtures.get(search_type, []) for search_type in SEARCH_TYPES}
+
+
+def _text(search_type, item):
+    """Texten som söktermen matchas mot: namn och artistnamn"""
+    names = [item.get('name', '')]
+    if search_type != 'artist':
+        names += [artist.get('name', '') for artist in item.get('artists', [])]
+    return ' '.join(names).casefold()
+
+
+def create_fake_app(fixtures=None, **settings):
+    """Flask-app som svarar som accounts.spotify.com och api.spotify.com.
+
+    Fördröjning, andel 5xx-fel och andel 429-svar går att ställa in vid start
+    eller under körning via POST /_fake/config.
+    """
+    app = Flask(__name__)
+    fixtures = fixtures if fixtures is not None else load_fixtures()
+    index = {
+        search_type: [(_text(search_type, item), item) for item in items]
+        for search_type, items in fixtures.items()
+    }
+
+    config = dict(DEFAULTS, **settings)
+    tokens = {}
+    stats = Counter()
+    lock = threading.Lock()
+
+    def count(name):
+        with lock:
+            stats[name] += 1
+
+    def delay():
+        seconds = (config['latency_ms'] + random.uniform(0, config['jitter_ms'])) / 1000
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def injected_failure():
+        """Ett 429- eller 5xx-svar enligt inställningarna, annars None"""
+        roll = random.random()
+        if roll < config['rate_limit_rate']:
+            count('rate_limited')
+            response = jsonify({"error": {"status": 429, "message": "API rate limit exceeded"}})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(config['retry_after'])
+            return response
+        if roll < config['rate_limit_rate'] + config['error_rate']:
+            count('errors')
+            status = random.choice((500, 502, 503))
+            return jsonify({"error": {"status": status, "message": "Injected failure"}}), status
+        return None
+
+    @app.post('/api/token')
+    def token():
+        count('token_requests')
+        if request.form.get('grant_type') != 'client_credentials' or \
+                not request.headers.get('Authorization', '').startswith('Basic '):
+            return jsonify({"error": "invalid_client"}), 400
+        delay()
+        access_token = uuid.uuid4().hex
+        with lock:
+            tokens[access_token] = time.time() + config['token_lifetime']
+        return jsonify({
+            "access_token": access_token,
+            "token_type": "Bearer",
+            "expires_in": config['token_lifetime']
+        })
+
+    @app.get('/v1/search')
+    def search():
+        count('search_requests')
+        access_token = request.headers.get('Authorization', '')[len('Bearer '):]
+        with lock:
+            expires_at = tokens.get(access_token)
+        if expires_at is None or expires_at < time.time():
+            count('unauthorized')
+            return jsonify({"error": {"status": 401, "message": "The access token expired"}}), 401
+
+        query = request.args.get('q', '').strip().casefold()
+        search_types = [t for t in request.args.get('type', '').split(',') if t]
+        if not query or not search_types or any(t not in SEARCH_TYPES for t in search_types):
+            return jsonify({"error": {"status": 400, "message": "Bad search type or query"}}), 400
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 50)
+        offset = max(request.args.get('offset', 0, type=int), 0)
+
+        delay()
+        failure = injected_failure()
+        if failure is not None:
+            return failure
+
+        words = query.split()
+        body = {}
+        for search_type in search_types:
+            matches = [item for text, item in index[search_type] if all(word in text for word in words)]
+            body[f"{search_type}s"] = {
+                "href": request.url,
+                "items": matches[offset:offset + limit],
+                "limit": limit,
+                "offset": offset,
+                "total": len(matches),
+                "next": None,
+                "previous": None
+            }
+        count('search_ok')
+        return jsonify(body)
+
+    @app.route('/_fake/config', methods=['GET', 'POST'])
+    def fake_config():
+        for name, value in (request.get_json(silent=True) or {}).items():
+            if name in config:
+                config[name] = type(DEFAULTS[name])(value)
+        return jsonify(config)
+
+    @app.get('/_fake/stats')
+    def fake_stats():
+        with lock:
+            return jsonify(dict(stats))
+
+    app.extensions['fake_spotify'] = {'config': config, 'stats': stats, 'tokens': tokens, 'fixtures': fixtures}
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lokal attrapp av Spotifys sök-API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=int(os.getenv('FAKE_SPOTIFY_PORT', 8765)))
+    parser.add_argument('--latency-ms', type=float, default=DEFAULTS['latency_ms'])
+    parser.add_argument('--jitter-ms', type=float, default=DEFAULTS['jitter_ms'])
+    parser.add_argument('--error-rate', type=float, default=DEFAULTS['error_rate'])
+    parser.add_argument('--rate-limit-rate', type=float, default=DEFAULTS['rate_limit_rate'])
+    parser.add_argument('--retry-after', type=int, default=DEFAULTS['retry_after'])
+    args = parser.parse_args()
+
+    app = create_fake_app(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after
+    )
+    print(f"Fake Spotify på http://{args.host}:{args.port} "
+          f"(SPOTIFY_ACCOUNTS_URL och SPOTIFY_API_URL)")
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
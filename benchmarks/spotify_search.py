@@ -0,0 +1,154 @@
+"""Lasttest av musiksökningen mot den lokala Spotify-attrappen.
+
+Startar benchmarks/fake_spotify.py i en tråd, pekar appen dit och kör
+sökningar parallellt mot /api/search/music och /api/search. Skriver ut
+latens per endpoint, statuskoder och vad attrappen och schemaläggaren såg.
+
+    python benchmarks/spotify_search.py --requests 500 --concurrency 16 --rate-limit-rate 0.05
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency-ms', type=float, default=80)
+    parser.add_argument('--jitter-ms', type=float, default=40)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0)
+    parser.add_argument('--miss-rate', type=float, default=0.2,
+                        help='andel sökningar på termer som inte finns i fixturerna')
+    parser.add_argument('--cache', action='store_true',
+                        help='behåll sökcachen på disk mellan körningar (minnescachen används alltid)')
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+
+def start_fake(args):
+    from werkzeug.serving import make_server
+    from fake_spotify import create_fake_app
+
+    fake = create_fake_app(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                           error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate)
+    # Attrappens anropslogg dränker resultatet
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, fake, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return fake, server, f"http://127.0.0.1:{server.server_port}"
+
+
+def queries(fake, count, miss_rate, rnd):
+    """Söktermer ur fixturerna (låttitlar, album och artister) blandade med missar"""
+    terms = []
+    for items in fake.extensions['fake_spotify']['fixtures'].values():
+        terms += [item['name'] for item in items]
+    result = []
+    for i in range(count):
+        if rnd.random() < miss_rate:
+            result.append(f"okand term {rnd.randint(0, count)}")
+        else:
+            result.append(rnd.choice(terms))
+    return result
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000
+
+
+def main():
+    args = parse_args()
+    rnd = random.Random(args.seed)
+    sys.path.insert(0, ROOT)
+
+    fake, server, base_url = start_fake(args)
+    workdir = tempfile.mkdtemp(prefix='spotify-bench-')
+
+    # Miljön måste sättas innan appens moduler importeras
+    os.environ.update({
+        'SPOTIFY_ACCOUNTS_URL': base_url,
+        'SPOTIFY_API_URL': base_url,
+        'CLIENT_ID': os.getenv('CLIENT_ID', 'bench'),
+        'CLIENT_SECRET': os.getenv('CLIENT_SECRET', 'bench'),
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'JOBS_DB_PATH': '',
+    })
+    if not args.cache:
+        os.environ['SPOTIFY_CACHE_PATH'] = ''
+
+    from __init__ import create_app
+    from services.spotify_api import spotify_client
+    from services.spotify_scheduler import scheduler
+
+    app = create_app()
+    # /api/search/music kräver inloggning; alla klienter loggas in som samma användare
+    from models import db, User
+    with app.app_context():
+        user = User(username='bench', email='bench@example.com')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+    endpoints = [
+        ('/api/search/music', lambda q: {'q': q, 'type': 'track,album,artist', 'limit': 10}),
+        ('/api/search', lambda q: {'q': q, 'types': 'track,album,artist', 'limit': 5}),
+    ]
+    work = [(rnd.choice(endpoints), q) for q in queries(fake, args.requests, args.miss_rate, rnd)]
+
+    latencies = defaultdict(list)
+    statuses = Counter()
+    spotify_states = Counter()
+    lock = threading.Lock()
+    local = threading.local()
+
+    def run(item):
+        (path, params), query = item
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+            with client.session_transaction() as session:
+                session['_user_id'] = str(user_id)
+                session['_fresh'] = True
+        started = time.perf_counter()
+        response = client.get(path, query_string=params(query))
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies[path].append(elapsed)
+            statuses[f"{path} {response.status_code}"] += 1
+            if path == '/api/search':
+                spotify_states[response.get_json().get('spotify')] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(run, work))
+    wall = time.perf_counter() - started
+
+    print(f"{args.requests} anrop, {args.concurrency} parallella, {wall:.2f} s "
+          f"({args.requests / wall:.1f} anrop/s)")
+    for path, samples in sorted(latencies.items()):
+        ordered = sorted(samples)
+        print(f"  {path:<20} n={len(ordered):<5} p50={percentile(ordered, 0.5):7.1f} ms "
+              f"p95={percentile(ordered, 0.95):7.1f} ms p99={percentile(ordered, 0.99):7.1f} ms "
+              f"max={ordered[-1] * 1000:7.1f} ms")
+    print(f"  status: {dict(statuses)}")
+    print(f"  /api/search spotify: {dict(spotify_states)}")
+    print(f"  attrapp: {dict(fake.extensions['fake_spotify']['stats'])}")
+    print(f"  schemaläggare: {scheduler.stats()}")
+    print(f"  sökcache: {spotify_client.cache.info()}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""Samtidiga läsningar och skrivningar mot SQLite, med och utan databasprofilen.
+
+Jämför SQLAlchemys standardinställningar (rollback-journal) med profilen i
+create_app (WAL, synchronous=NORMAL, busy_timeout, cache och mmap). Läsarna
+hämtar senaste inläggen med räknare, skrivarna lägger till kommentarer och
+räknar upp comment_count i samma transaktion, som appen gör.
+
+    python benchmarks/sqlite_concurrency.py --readers 8 --writers 4 --seconds 5
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import create_engine, event, insert, select, update
+from sqlalchemy.exc import OperationalError
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--posts', type=int, default=5000)
+    return parser.parse_args()
+
+
+def make_engine(path, tuned):
+    from __init__ import engine_options, apply_sqlite_pragmas
+
+    url = f'sqlite:///{path}'
+    if not tuned:
+        return create_engine(url)
+    engine = create_engine(url, **engine_options(url))
+    event.listen(engine, 'connect', apply_sqlite_pragmas)
+    return engine
+
+
+def seed(engine, users, posts):
+    from models import db, User, Post
+
+    db.metadata.create_all(engine)
+    now = datetime.utcnow()
+    with engine.begin() as connection:
+        connection.execute(insert(User), [
+            {'username': f'user{i}', 'username_key': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': 'x'}
+            for i in range(users)
+        ])
+        connection.execute(insert(Post), [
+            {'user_id': random.randint(1, users), 'content': f'inlägg {i}', 'created_at': now}
+            for i in range(posts)
+        ])
+
+
+def run(engine, args):
+    from models import Post, Comment
+
+    stop = time.monotonic() + args.seconds
+    counts = Counter()
+    latencies = {'read': [], 'write': []}
+    lock = threading.Lock()
+
+    def reader():
+        while time.monotonic() < stop:
+            started = time.perf_counter()
+            try:
+                with engine.connect() as connection:
+                    connection.execute(
+                        select(Post.id, Post.content, Post.like_count, Post.comment_count)
+                        .where(Post.user_id == random.randint(1, args.users))
+                        .order_by(Post.created_at.desc()).limit(20)
+                    ).all()
+                outcome = 'reads'
+            except OperationalError:
+                outcome = 'read_errors'
+            with lock:
+                counts[outcome] += 1
+                latencies['read'].append(time.perf_counter() - started)
+
+    def writer():
+        while time.monotonic() < stop:
+            post_id = random.randint(1, args.posts)
+            started = time.perf_counter()
+            try:
+                with engine.begin() as connection:
+                    connection.execute(insert(Comment).values(
+                        user_id=random.randint(1, args.users), post_id=post_id,
+                        content='kommentar', created_at=datetime.utcnow()
+                    ))
+                    connection.execute(update(Post).where(Post.id == post_id).values(
+                        comment_count=Post.comment_count + 1
+                    ))
+                outcome = 'writes'
+            except OperationalError:
+                outcome = 'write_errors'
+            with lock:
+                counts[outcome] += 1
+                latencies['write'].append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=reader) for _ in range(args.readers)]
+    threads += [threading.Thread(target=writer) for _ in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts, latencies
+
+
+def summary(samples):
+    if not samples:
+        return '-'
+    ordered = sorted(samples)
+    p50 = ordered[len(ordered) // 2] * 1000
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000
+    return f'p50={p50:6.2f} ms p99={p99:7.2f} ms'
+
+
+def main():
+    args = parse_args()
+    sys.path.insert(0, ROOT)
+    workdir = tempfile.mkdtemp(prefix='sqlite-bench-')
+
+    for tuned in (False, True):
+        name = 'profil' if tuned else 'standard'
+        path = os.path.join(workdir, f'{name}.db')
+        engine = make_engine(path, tuned)
+        random.seed(1)
+        seed(engine, args.users, args.posts)
+        counts, latencies = run(engine, args)
+        engine.dispose()
+        print(f"{name:<9} läsningar {counts['reads'] / args.seconds:8.0f}/s ({counts['read_errors']} fel)  "
+              f"skrivningar {counts['writes'] / args.seconds:6.0f}/s ({counts['write_errors']} fel)")
+        print(f"          läs  {summary(latencies['read'])}")
+        print(f"          skriv {summary(latencies['write'])}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# commands.py
+# Körs från projektkatalogen med: PYTHONPATH=. flask --app main <kommando>
+import click
+
+
+def register_commands(app):
+    """Registrera underhållskommandon för `flask`-CLI:t"""
+
+    @app.cli.command('rebuild-timelines')
+    def rebuild_timelines():
+        """Bygg om alla materialiserade hemflöden"""
+        from services import timeline
+        timeline.rebuild_all()
+        click.echo('Tidslinjerna har byggts om')
+
+    @app.cli.command('recount-posts')
+    def recount_posts():
+        """Räkna om gillnings- och kommentarsräknarna på alla inlägg"""
+        from services import post_counters
+        added = post_counters.ensure_counter_columns()
+        if added:
+            click.echo(f'Lade till kolumner: {", ".join(added)}')
+        updated = post_counters.recount_all()
+        click.echo(f'Räknade om {updated} inlägg')
+
+    @app.cli.command('compact-trending')
+    @click.option('--window', default=None, help='Bara ett fönster (1h, 24h eller 7d)')
+    def compact_trending(window):
+        """Räkna om trendpoängen från inlägg och gillningar (körs periodiskt)"""
+        from services import trending
+        trending.compact(window)
+        click.echo('Trendpoängen har räknats om')
+
+    @app.cli.command('reindex-catalog')
+    def reindex_catalog():
+        """Lägg till och fyll de normaliserade söknycklarna för låtar, album och artister"""
+        from services import music_catalog
+        added, updated = music_catalog.ensure_catalog_keys()
+        if added:
+            click.echo(f'Lade till kolumner: {", ".join(added)}')
+        click.echo(f'Uppdaterade söknycklar för {updated} poster')
+
+    @app.cli.command('dedupe-catalog')
+    def dedupe_catalog():
+        """Fyll Spotify-id:n från länkarna och slå ihop dubbletter i katalogen"""
+        from services import music_catalog, trending
+        added, updated = music_catalog.ensure_spotify_ids()
+        if added:
+            click.echo(f'Lade till kolumner: {", ".join(added)}')
+        removed = music_catalog.merge_duplicates()
+        if removed:
+            trending.compact()
+        click.echo(f'Fyllde Spotify-id för {updated} poster, slog ihop {removed} dubbletter')
+
+    @app.cli.command('migrate')
+    @click.option('--status', 'show_status', is_flag=True, help='Visa bara vilka migreringar som körts')
+    def migrate(show_status):
+        """Kör databasmigreringar som inte körts än"""
+        from services import migrations
+        if not show_status:
+            for version, name in migrations.upgrade():
+                click.echo(f'Körde {version}: {name}')
+        for version, name, applied_at in migrations.status():
+            click.echo(f'{version:>3} {name:<55} {applied_at or "ej körd"}')
+
+    @app.cli.command('explain-queries')
+    def explain_queries():
+        """Kontrollera att de vanligaste frågorna använder index (EXPLAIN QUERY PLAN)"""
+        from services import migrations
+        results = migrations.check_query_plans()
+        if not results:
+            click.echo('Frågeplanerna kontrolleras bara på SQLite')
+            return
+        for name, plan, ok in results:
+            click.echo(f'{"OK " if ok else "FEL"} {name}: {"; ".join(plan)}')
+        if not all(ok for _, _, ok in results):
+            raise SystemExit(1)
+
+    @app.cli.command('sync-replica')
+    @click.option('--interval', default=0.0, help='Upprepa med så här många sekunders mellanrum')
+    def sync_replica(interval):
+        """Kopiera SQLite-primären till de lokala replikerna i DATABASE_REPLICA_URLS"""
+        import time
+        from models import db
+        from services.db_routing import replicas, sync_sqlite_replica
+        primary = db.engines[None].url
+        targets = [db.engines[key].url for key in replicas.keys]
+        if primary.get_backend_name() != 'sqlite' or any(url.get_backend_name() != 'sqlite' for url in targets):
+            raise click.UsageError('Bara SQLite-filer kan kopieras; riktiga repliker sköts av databasen')
+        if not targets:
+            raise click.UsageError('Inga repliker i DATABASE_REPLICA_URLS')
+        while True:
+            for url in targets:
+                sync_sqlite_replica(primary.database, url.database)
+            click.echo(f'Kopierade {primary.database} till {len(targets)} replik(er)')
+            if not interval:
+                break
+            time.sleep(interval)
+
+    @app.cli.command('purge-deleted-posts')
+    def purge_deleted_posts():
+        """Rensa borttagna inlägg som bakgrundsjobbet inte hunnit med (t.ex. efter en omstart)"""
+        from services import post_deletion
+        pending = post_deletion.pending_purges()
+        removed = sum(post_deletion.purge_post(post_id) for post_id in pending)
+        click.echo(f'Rensade {len(pending)} inlägg ({removed} gillningar och kommentarer)')
+
+    @app.cli.command('delete-user')
+    @click.argument('username')
+    @click.option('--yes', is_flag=True, help='Fråga inte om bekräftelse')
+    def delete_user(username, yes):
+        """Ta bort ett konto med allt innehåll, i omgångar utan att läsa in det"""
+        from models import User
+        from services import post_deletion
+        from services.follow_graph import follow_graph
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.UsageError(f'Användaren {username} finns inte')
+        if not yes:
+            click.confirm(f'Ta bort {username} och allt innehåll?', abort=True)
+        user_id = user.id
+        edges = post_deletion.delete_user(user_id)
+        # Serverns smakindex tappar användaren vid nästa ombyggnad (TASTE_INDEX_TTL);
+        # till dess hoppar /api/users/similar över id:n som inte finns
+        follow_graph.record([(follower_id, followed_id, False) for follower_id, followed_id in edges])
+        click.echo(f'Tog bort {username}')
@@ -3,51 +3,92 @@ from flask_login import UserMixin
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 from sqlalchemy.sql import func
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+import re
+import unicodedata
 
-db = SQLAlchemy()
+from services.db_routing import RoutingSession
+
+# Sessionen kan skicka läsningar till en replik, se services/db_routing.py
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+def insert_ignoring_duplicates(table):
+    """INSERT som hoppar över rader som krockar med ett unikt index (SQLite och PostgreSQL)"""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing()
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    return table.insert()
 
 # Relationstabell för följare/följda
 followers = db.Table('followers',
     db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id')),
+    # Unika index i stället för UniqueConstraint, så att de kan läggas till i
+    # befintliga SQLite-tabeller av migreringarna (services/migrations.py)
+    db.Index('uq_followers_pair', 'follower_id', 'followed_id', unique=True),
+    db.Index('ix_followers_followed', 'followed_id', 'follower_id')
 )
 
-# Relationstabell för favoritlåtar
+# Relationstabell för favoritlåtar. position är användarens ordning och
+# skrivs av services/favorites.py
 user_favorite_songs = db.Table('user_favorite_songs',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('song_id', db.Integer, db.ForeignKey('song.id'))
+    db.Column('song_id', db.Integer, db.ForeignKey('song.id')),
+    db.Column('position', db.Integer, nullable=False, server_default='0'),
+    db.Index('uq_user_favorite_songs', 'user_id', 'song_id', unique=True),
+    db.Index('ix_user_favorite_songs_item', 'song_id', 'user_id'),
+    db.Index('ix_user_favorite_songs_order', 'user_id', 'position')
 )
 
 # Relationstabell för favoritalbum
 user_favorite_albums = db.Table('user_favorite_albums',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('album_id', db.Integer, db.ForeignKey('album.id'))
+    db.Column('album_id', db.Integer, db.ForeignKey('album.id')),
+    db.Column('position', db.Integer, nullable=False, server_default='0'),
+    db.Index('uq_user_favorite_albums', 'user_id', 'album_id', unique=True),
+    db.Index('ix_user_favorite_albums_item', 'album_id', 'user_id'),
+    db.Index('ix_user_favorite_albums_order', 'user_id', 'position')
 )
 
 # Relationstabell för favoritartister
 user_favorite_artists = db.Table('user_favorite_artists',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('artist_id', db.Integer, db.ForeignKey('artist.id'))
+    db.Column('artist_id', db.Integer, db.ForeignKey('artist.id')),
+    db.Column('position', db.Integer, nullable=False, server_default='0'),
+    db.Index('uq_user_favorite_artists', 'user_id', 'artist_id', unique=True),
+    db.Index('ix_user_favorite_artists_item', 'artist_id', 'user_id'),
+    db.Index('ix_user_favorite_artists_order', 'user_id', 'position')
 )
 
 class User(UserMixin, db.Model):
     """Användarmodell med inloggning och relationsinformation"""
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
+    # Casefoldat användarnamn för sökning (se username_key), sätts automatiskt vid sparning
+    username_key = db.Column(db.String(80), nullable=True, index=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(128))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    # Relationer
+    # Relationer. Inlägg, kommentarer och gillningar läses aldrig in vid
+    # borttagning (passive_deletes); de tas bort i omgångar av
+    # services/post_deletion.py, och av databasen där ON DELETE CASCADE gäller
     profile = db.relationship('Profile', backref='user', uselist=False, cascade="all, delete-orphan")
-    posts = db.relationship('Post', backref='author', lazy='dynamic', cascade="all, delete-orphan")
-    comments = db.relationship('Comment', backref='author', lazy='dynamic', cascade="all, delete-orphan")
-    likes = db.relationship('Like', backref='user', lazy='dynamic', cascade="all, delete-orphan")
+    posts = db.relationship('Post', backref='author', lazy='dynamic', cascade="all, delete-orphan", passive_deletes=True)
+    comments = db.relationship('Comment', backref='author', lazy='dynamic', cascade="all, delete-orphan", passive_deletes=True)
+    likes = db.relationship('Like', backref='user', lazy='dynamic', cascade="all, delete-orphan", passive_deletes=True)
     
     # Relationer för musikdata
-    favorite_songs = db.relationship('Song', secondary=user_favorite_songs, backref=db.backref('liked_by_users', lazy='dynamic'))
-    favorite_albums = db.relationship('Album', secondary=user_favorite_albums, backref=db.backref('liked_by_users', lazy='dynamic'))
-    favorite_artists = db.relationship('Artist', secondary=user_favorite_artists, backref=db.backref('liked_by_users', lazy='dynamic'))
+    favorite_songs = db.relationship('Song', secondary=user_favorite_songs, order_by=user_favorite_songs.c.position,
+                                     backref=db.backref('liked_by_users', lazy='dynamic'))
+    favorite_albums = db.relationship('Album', secondary=user_favorite_albums, order_by=user_favorite_albums.c.position,
+                                      backref=db.backref('liked_by_users', lazy='dynamic'))
+    favorite_artists = db.relationship('Artist', secondary=user_favorite_artists, order_by=user_favorite_artists.c.position,
+                                       backref=db.backref('liked_by_users', lazy='dynamic'))
     
     # Följare/följer-relation
     following = db.relationship(
@@ -65,15 +106,25 @@ class User(UserMixin, db.Model):
         return check_password_hash(self.password_hash, password)
     
     def follow(self, user):
-        if not self.is_following(user):
-            self.following.append(user)
+        # Följgrafen i minnet kan ligga efter; det unika indexet avgör
+        db.session.execute(insert_ignoring_duplicates(followers).values(
+            follower_id=self.id, followed_id=user.id
+        ))
+        _pending_follows()[(self.id, user.id)] = True
     
     def unfollow(self, user):
-        if self.is_following(user):
-            self.following.remove(user)
+        db.session.execute(followers.delete().where(
+            followers.c.follower_id == self.id, followers.c.followed_id == user.id
+        ))
+        _pending_follows()[(self.id, user.id)] = False
     
     def is_following(self, user):
-        return self.following.filter(followers.c.followed_id == user.id).count() > 0
+        # Osparade ändringar i sessionen först, annars följgrafen i minnet (ingen fråga)
+        pending = db.session.info.get('follow_changes', {}).get((self.id, user.id))
+        if pending is not None:
+            return pending
+        from services.follow_graph import follow_graph
+        return follow_graph.is_following(self.id, user.id)
     
     def __repr__(self):
         return f'<User {self.username}>'
@@ -104,9 +155,22 @@ class Song(db.Model):
     spotify_url = db.Column(db.String(500), nullable=True)
     embed_url = db.Column(db.String(500), nullable=True)
     
+    # Normaliserade söknycklar (se catalog_key), sätts automatiskt vid sparning
+    title_key = db.Column(db.String(200), nullable=True)
+    artist_key = db.Column(db.String(200), nullable=True)
+    
+    # Spotifys id (naturlig nyckel); läses ur spotify_url om det inte anges
+    spotify_id = db.Column(db.String(64), nullable=True)
+    
     # Relationer
     posts = db.relationship('Post', backref='song', lazy='dynamic')
     
+    __table_args__ = (
+        db.Index('ix_song_keys', 'title_key', 'artist_key'),
+        db.Index('ix_song_artist_key', 'artist_key'),
+        db.Index('uq_song_spotify_id', 'spotify_id', unique=True),
+    )
+    
     def __repr__(self):
         return f'<Song {self.title} by {self.artist}>'
 
@@ -118,9 +182,20 @@ class Album(db.Model):
     cover_url = db.Column(db.String(500), nullable=True)
     spotify_url = db.Column(db.String(500), nullable=False)
     
+    title_key = db.Column(db.String(200), nullable=True)
+    artist_key = db.Column(db.String(200), nullable=True)
+    
+    spotify_id = db.Column(db.String(64), nullable=True)
+    
     # Relationer
     posts = db.relationship('Post', backref='album', lazy='dynamic')
     
+    __table_args__ = (
+        db.Index('ix_album_keys', 'title_key', 'artist_key'),
+        db.Index('ix_album_artist_key', 'artist_key'),
+        db.Index('uq_album_spotify_id', 'spotify_id', unique=True),
+    )
+    
     def __repr__(self):
         return f'<Album {self.title} by {self.artist}>'
 
@@ -131,27 +206,49 @@ class Artist(db.Model):
     cover_url = db.Column(db.String(500), nullable=True)
     spotify_url = db.Column(db.String(500), nullable=False)
     
+    name_key = db.Column(db.String(200), nullable=True, index=True)
+    
+    spotify_id = db.Column(db.String(64), nullable=True)
+    
     # Relationer
     posts = db.relationship('Post', backref='artist', lazy='dynamic')
     
+    __table_args__ = (
+        db.Index('uq_artist_spotify_id', 'spotify_id', unique=True),
+    )
+    
     def __repr__(self):
         return f'<Artist {self.name}>'
 
 class Post(db.Model):
     """Inläggsmodell för användares innehåll"""
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Satt för borttagna inlägg vars gillningar och kommentarer ännu inte
+    # rensats i bakgrunden; sådana inlägg visas inte någonstans
+    deleted_at = db.Column(db.DateTime, nullable=True)
+    
     # Relaterad musikdata (bara en kan vara kopplad till ett inlägg)
     song_id = db.Column(db.Integer, db.ForeignKey('song.id'), nullable=True)
     album_id = db.Column(db.Integer, db.ForeignKey('album.id'), nullable=True)
     artist_id = db.Column(db.Integer, db.ForeignKey('artist.id'), nullable=True)
     
+    # Denormaliserade räknare, hålls uppdaterade av händelserna längst ned i filen
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
     # Relationer
-    likes = db.relationship('Like', backref='post', lazy='dynamic', cascade="all, delete-orphan")
-    comments = db.relationship('Comment', backref='post', lazy='dynamic', cascade="all, delete-orphan")
+    likes = db.relationship('Like', backref='post', lazy='dynamic', cascade="all, delete-orphan", passive_deletes=True)
+    comments = db.relationship('Comment', backref='post', lazy='dynamic', cascade="all, delete-orphan", passive_deletes=True)
+    
+    __table_args__ = (
+        # Profilsidans inlägg och det globala flödet, nyast först
+        db.Index('ix_post_user_created', 'user_id', 'created_at'),
+        db.Index('ix_post_created', 'created_at'),
+    )
     
     def __repr__(self):
         return f'<Post {self.id} by User {self.user_id}>'
@@ -159,20 +256,163 @@ class Post(db.Model):
 class Like(db.Model):
     """Gillamarkeringar på inlägg"""
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        # En gillning per användare och inlägg
+        db.Index('uq_like_user_post', 'user_id', 'post_id', unique=True),
+        db.Index('ix_like_post', 'post_id'),
+    )
+    
     def __repr__(self):
         return f'<Like by User {self.user_id} on Post {self.post_id}>'
 
 class Comment(db.Model):
     """Kommentarer på inlägg"""
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), nullable=False)
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_comment_post_created', 'post_id', 'created_at'),
+        db.Index('ix_comment_user', 'user_id'),
+    )
+    
     def __repr__(self):
-        return f'<Comment by User {self.user_id} on Post {self.post_id}>'
\ No newline at end of file
+        return f'<Comment by User {self.user_id} on Post {self.post_id}>'
+
+class TimelineEntry(db.Model):
+    """Materialiserat hemflöde: ett inlägg i en användares tidslinje"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    
+    __table_args__ = (
+        # Tidslinjen läses som ett intervall per användare, nyast först
+        db.Index('ix_timeline_user_created', 'user_id', 'created_at', 'post_id'),
+        db.Index('ix_timeline_post', 'post_id'),
+        db.Index('ix_timeline_user_author', 'user_id', 'author_id'),
+        db.UniqueConstraint('user_id', 'post_id', name='uq_timeline_user_post'),
+    )
+    
+    def __repr__(self):
+        return f'<TimelineEntry Post {self.post_id} for User {self.user_id}>'
+
+class TrendingScore(db.Model):
+    """Tidsavklingande popularitet för en låt, ett album eller en artist.
+
+    Poängen lagras logaritmiskt relativt en fast epok, så att alla poster
+    avklingar lika fort och topplistan blir en vanlig indexerad ORDER BY.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    window = db.Column(db.String(8), nullable=False)
+    item_type = db.Column(db.String(10), nullable=False)
+    item_id = db.Column(db.Integer, nullable=False)
+    log_score = db.Column(db.Float, nullable=False)
+    
+    __table_args__ = (
+        db.UniqueConstraint('window', 'item_type', 'item_id', name='uq_trending_item'),
+        db.Index('ix_trending_rank', 'window', 'item_type', 'log_score'),
+    )
+    
+    def __repr__(self):
+        return f'<TrendingScore {self.item_type} {self.item_id} ({self.window})>'
+
+def _adjust_post_counter(connection, column, post_id, delta):
+    """Justera en räknare på inlägget i samma transaktion som ändringen"""
+    post_table = Post.__table__
+    connection.execute(
+        post_table.update().where(post_table.c.id == post_id).values(
+            {column: post_table.c[column] + delta}
+        )
+    )
+
+@event.listens_for(Like, 'after_insert')
+def _like_inserted(mapper, connection, target):
+    _adjust_post_counter(connection, 'like_count', target.post_id, 1)
+
+@event.listens_for(Like, 'after_delete')
+def _like_deleted(mapper, connection, target):
+    _adjust_post_counter(connection, 'like_count', target.post_id, -1)
+
+@event.listens_for(Comment, 'after_insert')
+def _comment_inserted(mapper, connection, target):
+    _adjust_post_counter(connection, 'comment_count', target.post_id, 1)
+
+@event.listens_for(Comment, 'after_delete')
+def _comment_deleted(mapper, connection, target):
+    _adjust_post_counter(connection, 'comment_count', target.post_id, -1)
+
+def _pending_follows():
+    """Följändringar i den aktuella transaktionen, som (följare, följd) -> följer"""
+    return db.session.info.setdefault('follow_changes', {})
+
+@event.listens_for(Session, 'after_commit')
+def _follows_committed(session):
+    changes = session.info.pop('follow_changes', None)
+    if changes:
+        from services.follow_graph import follow_graph
+        follow_graph.record([(follower_id, followed_id, added)
+                             for (follower_id, followed_id), added in changes.items()])
+
+@event.listens_for(Session, 'after_transaction_end')
+def _follows_discarded(session, transaction):
+    # Ändringar som inte sparades (rollback eller stängd session) glöms
+    if transaction.parent is None:
+        session.info.pop('follow_changes', None)
+
+def catalog_key(value):
+    """Söknyckel för titlar och namn: utan accenter, casefold och enkla mellanslag"""
+    if value is None:
+        return None
+    decomposed = unicodedata.normalize('NFKD', value)
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(stripped.casefold().split())
+
+def username_key(value):
+    """Söknyckel för användarnamn: casefold, så att även å/Å och ß/SS matchar"""
+    if value is None:
+        return None
+    return value.casefold()
+
+_SPOTIFY_URL = re.compile(r'(?:open\.spotify\.com/(?:intl-[\w-]+/)?(?:embed/)?|spotify:)(track|album|artist)[/:]([A-Za-z0-9]+)')
+
+def spotify_id_from_url(url, kind):
+    """Spotify-id:t ur en länk eller URI av rätt typ (track, album, artist), annars None"""
+    match = _SPOTIFY_URL.search(url or '')
+    if match and match.group(1) == kind:
+        return match.group(2)
+    return None
+
+_SPOTIFY_KINDS = {'song': 'track', 'album': 'album', 'artist': 'artist'}
+
+def _set_spotify_id(target):
+    if not target.spotify_id:
+        url = target.spotify_url or getattr(target, 'embed_url', None)
+        target.spotify_id = spotify_id_from_url(url, _SPOTIFY_KINDS[target.__tablename__])
+
+@event.listens_for(User, 'before_insert')
+@event.listens_for(User, 'before_update')
+def _set_username_key(mapper, connection, target):
+    target.username_key = username_key(target.username)
+
+@event.listens_for(Song, 'before_insert')
+@event.listens_for(Song, 'before_update')
+@event.listens_for(Album, 'before_insert')
+@event.listens_for(Album, 'before_update')
+def _set_title_keys(mapper, connection, target):
+    target.title_key = catalog_key(target.title)
+    target.artist_key = catalog_key(target.artist)
+    _set_spotify_id(target)
+
+@event.listens_for(Artist, 'before_insert')
+@event.listens_for(Artist, 'before_update')
+def _set_name_key(mapper, connection, target):
+    target.name_key = catalog_key(target.name)
+    _set_spotify_id(target)
@@ -6,6 +6,8 @@ import os
 from datetime import datetime
 
 from models import db, User, Profile
+from services.follow_graph import follow_graph
+from services.job_handlers import stage_upload, save_upload_later
 
 # Skapa en Blueprint
 auth = Blueprint('auth', __name__)
@@ -69,15 +71,6 @@ def register():
             flash('E-postadressen är redan registrerad')
             return render_template('register.html')
         
-        # Hantera profilbild (om den finns)
-        profile_pic = 'default.jpg'
-        if request.files and 'profile_picture' in request.files:
-            file = request.files['profile_picture']
-            if file.filename != '' and allowed_file(file.filename):
-                filename = secure_filename(f"{username}_{int(datetime.utcnow().timestamp())}_profile.{file.filename.rsplit('.', 1)[1].lower()}")
-                file.save(os.path.join(PROFILE_PICS_FOLDER, filename))
-                profile_pic = filename
-        
         # Skapa användare och profil
         new_user = User(username=username, email=email)
         new_user.set_password(password)
@@ -86,12 +79,21 @@ def register():
         
         new_profile = Profile(
             user_id=new_user.id,
-            profile_picture=profile_pic,
+            profile_picture='default.jpg',
             favorite_genre=favorite_genre
         )
         db.session.add(new_profile)
         db.session.commit()
         
+        # Hantera profilbild (om den finns); profilen pekas om när filen sparats
+        if request.files and 'profile_picture' in request.files:
+            file = request.files['profile_picture']
+            if file.filename != '' and allowed_file(file.filename):
+                filename = secure_filename(f"{username}_{int(datetime.utcnow().timestamp())}_profile.{file.filename.rsplit('.', 1)[1].lower()}")
+                path = os.path.join(PROFILE_PICS_FOLDER, filename)
+                save_upload_later(stage_upload(file, path), path, new_user.id, 'profile_picture')
+        follow_graph.set_genre(new_user.id, favorite_genre)
+        
         # Logga in användaren direkt
         login_user(new_user)
         
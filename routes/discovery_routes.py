@@ -1,8 +1,16 @@
-from flask import Blueprint, request, jsonify, render_template, redirect
+from flask import Blueprint, request, jsonify, render_template
 from flask_login import login_required, current_user
-from sqlalchemy import func, desc
 
-from models import db, User, Profile, Post, Like, Comment, Song, Album, Artist
+from models import db, User
+from services.pagination import InvalidCursor, keyset_paginate, wants_total
+from services import trending
+from services import user_search
+from services.follow_graph import follow_graph
+from services.taste import taste_index, METRICS
+from services import music_catalog
+from services import federated_search
+from services.spotify_api import SpotifySearch, SEARCH_TYPES, MAX_LIMIT, MAX_OFFSET
+from services.db_routing import replica_reads
 
 # Skapa en Blueprint
 discovery = Blueprint('discovery', __name__)
@@ -13,25 +21,49 @@ def discovery_page():
     return render_template('discovery.html')
 
 @discovery.route('/api/users/search')
+@replica_reads
 def search_users():
     """Sök efter användare baserat på användarnamn"""
     query = request.args.get('q', '')
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 10, type=int)
+    cursor = request.args.get('cursor')
     
-    if not query:
+    term = user_search.normalize(query)
+    if not term:
         return jsonify({"error": "Sökterm krävs"}), 400
     
-    # Sök efter användare vars användarnamn innehåller söktermen
-    users = User.query.filter(User.username.ilike(f'%{query}%')).paginate(page=page, per_page=per_page)
+    # Sök i användarnamnsindexet; exakta träffar och prefix först, sedan delsträngar
+    matches, sort_keys = user_search.search(term)
+    
+    if cursor is not None:
+        # Keyset-paginering på relevansordningen; den inloggade användaren filtreras bort i frågan
+        if current_user.is_authenticated:
+            matches = matches.filter(User.id != current_user.id)
+        try:
+            users = keyset_paginate(
+                matches, sort_keys, cursor, per_page,
+                key_func=lambda user: user_search.relevance_key(user, term), count=wants_total()
+            )
+        except InvalidCursor:
+            return jsonify({"error": "Ogiltig cursor"}), 400
+    else:
+        users = matches.order_by(*sort_keys).paginate(page=page, per_page=per_page)
+    
+    # Skippa den inloggade användaren i resultaten
+    page_users = [
+        user for user in users.items
+        if not (current_user.is_authenticated and user.id == current_user.id)
+    ]
+    
+    # Profiler och följstatus för hela sidan hämtas i varsin fråga
+    user_ids = [user.id for user in page_users]
+    profiles = user_search.profiles_for(user_ids)
+    followed = user_search.followed_among(current_user.id, user_ids) if current_user.is_authenticated else set()
     
     users_data = []
-    for user in users.items:
-        # Skippa den inloggade användaren i resultaten
-        if current_user.is_authenticated and user.id == current_user.id:
-            continue
-            
-        profile = Profile.query.filter_by(user_id=user.id).first()
+    for user in page_users:
+        profile = profiles.get(user.id)
         
         user_data = {
             "id": user.id,
@@ -43,10 +75,21 @@ def search_users():
         
         # Kolla om den inloggade användaren följer denna användare
         if current_user.is_authenticated:
-            user_data["is_following"] = current_user.is_following(user)
+            user_data["is_following"] = user.id in followed
             
         users_data.append(user_data)
     
+    if cursor is not None:
+        response = {
+            "users": users_data,
+            "has_next": users.has_next,
+            "next_cursor": users.next_cursor,
+            "per_page": users.per_page
+        }
+        if users.total is not None:
+            response["total_items"] = users.total
+        return jsonify(response)
+    
     return jsonify({
         "users": users_data,
         "has_next": users.has_next,
@@ -60,141 +103,153 @@ def search_users():
 @login_required
 def suggested_users():
     """Hämta föreslagna användare som den inloggade användaren kan vara intresserad av att följa"""
-    # Användare med samma genrepreferenser
-    current_profile = Profile.query.filter_by(user_id=current_user.id).first()
-    favorite_genre = current_profile.favorite_genre if current_profile else None
+    # Användare som följs av användare som den inloggade användaren följer, viktade
+    # med antal gemensamma kontakter och liknande musiksmak (beräknas i minnet)
+    suggestions = follow_graph.suggest(current_user.id, limit=5)
     
-    # Användare som följs av användare som den inloggade användaren följer
-    following_users = [user.id for user in current_user.following]
+    # Användardata och profiler för förslagen hämtas i varsin fråga
+    user_ids = [user_id for user_id, _, _, _ in suggestions]
+    users = {user.id: user for user in User.query.filter(User.id.in_(user_ids)).all()} if user_ids else {}
+    profiles = user_search.profiles_for(user_ids)
     
     suggested = []
-    
-    # Om användaren har en favoritgenre, hitta andra med samma preferens
-    if favorite_genre:
-        genre_profiles = Profile.query.filter_by(favorite_genre=favorite_genre).limit(5).all()
+    for user_id, shared, genre_match, source in suggestions:
+        user = users.get(user_id)
+        if not user:
+            continue
+        profile = profiles.get(user_id)
         
-        for profile in genre_profiles:
-            user = User.query.get(profile.user_id)
-            
-            # Skippa den inloggade användaren och användare som redan följs
-            if user.id == current_user.id or user.id in following_users:
-                continue
-                
-            suggested.append({
-                "id": user.id,
-                "username": user.username,
-                "profile_picture": profile.profile_picture or "default.jpg",
-                "bio": profile.bio or "",
-                "favorite_genre": profile.favorite_genre or "",
-                "reason": "Liknande musiksmak"
-            })
-    
-    # Om vi har färre än 5 förslag, lägg till populära användare
-    if len(suggested) < 5:
-        # Hitta populära användare (de med flest följare)
-        popular_users = User.query.join(User.followers).group_by(User.id).order_by(db.func.count().desc()).limit(10).all()
+        if source == 'friends':
+            reason = f"Följs av {shared} som du följer"
+        elif source == 'genre' or genre_match:
+            reason = "Liknande musiksmak"
+        else:
+            reason = "Populär användare"
         
-        for user in popular_users:
-            # Skippa användare som redan finns i förslagen
-            if any(s["id"] == user.id for s in suggested):
-                continue
-                
-            # Skippa den inloggade användaren och användare som redan följs
-            if user.id == current_user.id or user.id in following_users:
-                continue
-                
-            profile = Profile.query.filter_by(user_id=user.id).first()
-            
-            suggested.append({
-                "id": user.id,
-                "username": user.username,
-                "profile_picture": profile.profile_picture if profile else "default.jpg",
-                "bio": profile.bio if profile and profile.bio else "",
-                "favorite_genre": profile.favorite_genre if profile and profile.favorite_genre else "",
-                "reason": "Populär användare"
-            })
-            
-            # Sluta när vi har 5 förslag
-            if len(suggested) >= 5:
-                break
+        suggested.append({
+            "id": user.id,
+            "username": user.username,
+            "profile_picture": profile.profile_picture if profile else "default.jpg",
+            "bio": profile.bio if profile and profile.bio else "",
+            "favorite_genre": profile.favorite_genre if profile and profile.favorite_genre else "",
+            "reason": reason
+        })
     
     return jsonify({
-        "suggested_users": suggested[:5]  # Returnera max 5 förslag
+        "suggested_users": suggested
+    })
+
+@discovery.route('/api/users/similar')
+@login_required
+def similar_users():
+    """Hämta användare med liknande musiksmak utifrån gemensamma favoriter"""
+    metric = request.args.get('metric', 'cosine')
+    if metric not in METRICS:
+        return jsonify({"error": "Ogiltigt likhetsmått"}), 400
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 20)
+    
+    # Grannlistorna räknas fram vektoriserat över favorittabellerna och cachas
+    neighbours = taste_index.neighbours(current_user.id, metric=metric, limit=limit)
+    
+    user_ids = [user_id for user_id, _ in neighbours]
+    users = {user.id: user for user in User.query.filter(User.id.in_(user_ids)).all()} if user_ids else {}
+    profiles = user_search.profiles_for(user_ids)
+    
+    similar = []
+    for user_id, similarity in neighbours:
+        user = users.get(user_id)
+        if not user:
+            continue
+        profile = profiles.get(user_id)
+        
+        similar.append({
+            "id": user.id,
+            "username": user.username,
+            "profile_picture": profile.profile_picture if profile else "default.jpg",
+            "bio": profile.bio if profile and profile.bio else "",
+            "favorite_genre": profile.favorite_genre if profile and profile.favorite_genre else "",
+            "similarity": round(similarity, 3),
+            "shared": taste_index.shared_counts(current_user.id, user_id)
+        })
+    
+    return jsonify({
+        "metric": metric,
+        "similar_users": similar
     })
 
 @discovery.route('/api/trending')
+@replica_reads
 def trending_music():
     """Hämta trendande musik baserat på användarnas inlägg och aktivitet"""
-    # Hitta de mest populära låtarna (baserat på inlägg och gillningar)
-    trending_songs = db.session.query(
-        Song, func.count(Post.id).label('post_count'), func.count(Like.id).label('like_count')
-    ).join(Post, Post.song_id == Song.id).join(Like, Like.post_id == Post.id, isouter=True).group_by(
-        Song.id
-    ).order_by(desc('post_count'), desc('like_count')).limit(5).all()
-    
-    songs_data = []
-    for song, post_count, like_count in trending_songs:
-        songs_data.append({
-            "id": song.id,
-            "title": song.title,
-            "artist": song.artist,
-            "cover_url": song.cover_url,
-            "spotify_url": song.spotify_url,
-            "embed_url": song.embed_url,
-            "popularity_score": post_count + like_count
-        })
+    window = request.args.get('window', trending.DEFAULT_WINDOW)
     
-    # Hitta de mest populära albumen
-    trending_albums = db.session.query(
-        Album, func.count(Post.id).label('post_count'), func.count(Like.id).label('like_count')
-    ).join(Post, Post.album_id == Album.id).join(Like, Like.post_id == Post.id, isouter=True).group_by(
-        Album.id
-    ).order_by(desc('post_count'), desc('like_count')).limit(5).all()
-    
-    albums_data = []
-    for album, post_count, like_count in trending_albums:
-        albums_data.append({
-            "id": album.id,
-            "title": album.title,
-            "artist": album.artist,
-            "cover_url": album.cover_url,
-            "spotify_url": album.spotify_url,
-            "popularity_score": post_count + like_count
-        })
+    if window not in trending.WINDOWS:
+        return jsonify({"error": "Ogiltigt tidsfönster", "windows": list(trending.WINDOWS)}), 400
     
-    # Hitta de mest populära artisterna
-    trending_artists = db.session.query(
-        Artist, func.count(Post.id).label('post_count'), func.count(Like.id).label('like_count')
-    ).join(Post, Post.artist_id == Artist.id).join(Like, Like.post_id == Post.id, isouter=True).group_by(
-        Artist.id
-    ).order_by(desc('post_count'), desc('like_count')).limit(5).all()
-    
-    artists_data = []
-    for artist, post_count, like_count in trending_artists:
-        artists_data.append({
-            "id": artist.id,
-            "name": artist.name,
-            "cover_url": artist.cover_url,
-            "spotify_url": artist.spotify_url,
-            "popularity_score": post_count + like_count
-        })
+    # Topplistorna läses från de förberäknade, tidsavklingande poängen
+    top = trending.top(window)
     
     return jsonify({
-        "trending_songs": songs_data,
-        "trending_albums": albums_data,
-        "trending_artists": artists_data
+        "window": window,
+        "trending_songs": top["song"],
+        "trending_albums": top["album"],
+        "trending_artists": top["artist"]
     })
 
+@discovery.route('/api/search')
+def search_all():
+    """Sök användare, musik i katalogen och på Spotify i ett anrop"""
+    query = request.args.get('q', '').strip()
+    types = [t for t in request.args.get('types', ','.join(federated_search.RESULT_TYPES)).split(',') if t]
+    limit = min(max(request.args.get('limit', 5, type=int), 1), 20)
+    include_spotify = request.args.get('spotify', '1').lower() not in ('0', 'false', 'no')
+    
+    if not query:
+        return jsonify({"error": "Sökterm krävs"}), 400
+    
+    if not types or any(t not in federated_search.RESULT_TYPES for t in types):
+        return jsonify({"error": "Ogiltig söktyp"}), 400
+    
+    viewer_id = current_user.id if current_user.is_authenticated else None
+    return jsonify(federated_search.search(
+        query, viewer_id, list(dict.fromkeys(types)), limit, include_spotify
+    ))
+
 @discovery.route('/api/search/music')
+@login_required
 def search_music():
-    """Sök efter låtar, album eller artister via Spotify API"""
+    """Sök efter låtar, album eller artister via Spotify API.
+
+    Med flera typer (type=track,album,artist) eller en angiven limit hämtas
+    sidor med träffar för alla typer i ett anrop till Spotify. Annars svarar
+    endpointen som tidigare med den bästa träffen, från katalogen i första hand.
+    Kräver inloggning som tidigare, eftersom Spotify-träffar sparas i katalogen.
+    """
     query = request.args.get('q', '')
-    search_type = request.args.get('type', 'track')  # track, album, eller artist
+    search_types = [t for t in request.args.get('type', 'track').split(',') if t]  # track, album, artist
     
     if not query:
         return jsonify({"error": "Sökterm krävs"}), 400
     
-    # Här skulle du använda SpotifyAPI för att söka, men vi skickar vidare till
-    # profil-rutterna som redan har implementerat denna funktionalitet
-    redirect_url = f"/api/profile/music-search?q={query}&type={search_type}"
-    return redirect(redirect_url)
\ No newline at end of file
+    if not search_types or any(t not in SEARCH_TYPES for t in search_types):
+        return jsonify({"error": "Ogiltig söktyp"}), 400
+    
+    if len(search_types) == 1 and 'limit' not in request.args:
+        result = music_catalog.search(query, search_types[0])
+        db.session.commit()
+        if not result:
+            return jsonify({"error": "Inga resultat hittades"}), 404
+        return jsonify(result)
+    
+    limit = min(max(request.args.get('limit', 10, type=int), 1), MAX_LIMIT)
+    offset = min(max(request.args.get('offset', 0, type=int), 0), MAX_OFFSET)
+    
+    results = SpotifySearch(query).search(list(dict.fromkeys(search_types)), limit, offset)
+    if results is None:
+        return jsonify({"error": "Musiksökningen är inte tillgänglig just nu"}), 503
+    
+    for page in results.values():
+        next_offset = page["offset"] + page["limit"]
+        page["next_offset"] = next_offset if next_offset < page["total"] and next_offset <= MAX_OFFSET else None
+    
+    return jsonify({"query": query, **results})
@@ -1,8 +1,12 @@
 # routes/main_routes.py
-from flask import Blueprint, render_template, redirect, url_for, send_from_directory
+from flask import Blueprint, render_template, redirect, url_for, send_from_directory, jsonify, current_app, abort
 from flask_login import current_user
 import os
 
+from services.jobs import jobs
+from services.spotify_api import spotify_client
+from services.spotify_scheduler import scheduler
+
 # Skapa en Blueprint
 main = Blueprint('main', __name__)
 
@@ -26,4 +30,20 @@ def static_files(filename):
 @main.route('/about')
 def about():
     """Visa information om webbplatsen"""
-    return render_template('about.html')
\ No newline at end of file
+    return render_template('about.html')
+
+@main.route('/api/metrics')
+def metrics():
+    """Mätvärden för jobbkön och Spotify-integrationen (per process).
+
+    Bara tillgänglig med METRICS_ENABLED=1, för intern övervakning.
+    """
+    if not current_app.config.get('METRICS_ENABLED'):
+        abort(404)
+    return jsonify({
+        "jobs": jobs.metrics(),
+        "spotify": {
+            "search_cache": spotify_client.cache.info(),
+            **scheduler.stats()
+        }
+    })
@@ -2,157 +2,104 @@ from flask import Blueprint, request, jsonify, render_template, redirect, url_fo
 from flask_login import login_required, current_user
 from datetime import datetime
 import json
+from sqlalchemy.exc import IntegrityError
 
 from models import db, User, Post, Like, Comment, Song, Album, Artist
+from services.post_hydration import hydrate_posts
+from services import timeline
+from services.pagination import InvalidCursor, keyset_paginate, wants_total
+from services import feed_cache
+from services import trending
+from services import post_deletion
+from services.job_handlers import record_like_later, purge_post_later
+from services.db_routing import replica_reads
 
 # Skapa en Blueprint
 posts = Blueprint('posts', __name__)
 
+def keyset_response(keyset_page, viewer_id, **extra):
+    """Svarsdata för en inläggssida hämtad med cursor"""
+    data = dict(extra)
+    data.update({
+        "posts": hydrate_posts(keyset_page.items, viewer_id),
+        "has_next": keyset_page.has_next,
+        "next_cursor": keyset_page.next_cursor,
+        "per_page": keyset_page.per_page
+    })
+    
+    # Totalt antal räknas bara när klienten uttryckligen ber om det
+    if keyset_page.total is not None:
+        data["total_items"] = keyset_page.total
+    
+    return data
+
 @posts.route('/api/posts')
+@replica_reads
 def get_posts():
     """Hämta inlägg för hemflödet"""
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 10, type=int)
-    
-    # För inloggade användare, visa inlägg från användaren och användare som användaren följer
-    following_ids = []
-    if current_user.is_authenticated:
-        following_ids = [user.id for user in current_user.following]
-        following_ids.append(current_user.id)  # Inkludera egna inlägg
-        feed_posts = Post.query.filter(Post.user_id.in_(following_ids))
-    else:
-        # För icke-inloggade användare, visa de senaste inläggen
-        feed_posts = Post.query
-    
-    # Sortera efter datum (nyast först) och paginera
-    paginated_posts = feed_posts.order_by(Post.created_at.desc()).paginate(page=page, per_page=per_page)
-    
-    posts_data = []
-    for post in paginated_posts.items:
-        user = User.query.get(post.user_id)
+    cursor = request.args.get('cursor')
+    include_total = wants_total()
+    viewer_id = current_user.id if current_user.is_authenticated else None
+    
+    # Svara från cachen om sidan inte påverkats av någon skrivning sedan den byggdes
+    position = ('cursor', cursor) if cursor is not None else ('page', page)
+    cache_key = (viewer_id, position, per_page, include_total)
+    cached = feed_cache.lookup(cache_key)
+    if cached is not None:
+        return feed_cache.respond(cached, request)
+    
+    tick = feed_cache.begin()
+    celebrity_ids = timeline.followed_celebrity_ids(viewer_id) if viewer_id is not None else []
+    
+    # Keyset-paginering om klienten skickar en cursor (tom cursor = första sidan)
+    if cursor is not None:
+        try:
+            if current_user.is_authenticated:
+                feed_page = timeline.timeline_after(current_user.id, cursor, per_page, count=include_total)
+            else:
+                feed_page = keyset_paginate(
+                    Post.query.filter(Post.deleted_at.is_(None)), [Post.created_at, Post.id], cursor, per_page,
+                    descending=True, key_func=timeline.post_cursor_key, count=include_total
+                )
+        except InvalidCursor:
+            return jsonify({"error": "Ogiltig cursor"}), 400
         
-        # Grundläggande inläggsdata
-        post_data = {
-            "id": post.id,
-            "content": post.content,
-            "created_at": post.created_at.strftime("%Y-%m-%d %H:%M:%S"),
-            "user": {
-                "id": user.id,
-                "username": user.username,
-                "profile_picture": user.profile.profile_picture if user.profile else "default.jpg"
-            },
-            "likes_count": post.likes.count(),
-            "comments_count": post.comments.count(),
-            "liked_by_user": False
-        }
-        
-        # Kolla om inloggad användare har gillat inlägget
+        data = keyset_response(feed_page, viewer_id)
+        page_posts = feed_page.items
+    else:
+        # För inloggade användare, läs det materialiserade hemflödet (egna inlägg och
+        # inlägg från användare som användaren följer)
         if current_user.is_authenticated:
-            post_data["liked_by_user"] = post.likes.filter_by(user_id=current_user.id).first() is not None
+            paginated_posts = timeline.paginate_timeline(current_user.id, page, per_page)
+        else:
+            # För icke-inloggade användare, visa de senaste inläggen (nyast först)
+            paginated_posts = Post.query.filter(Post.deleted_at.is_(None)).order_by(
+                Post.created_at.desc()).paginate(page=page, per_page=per_page)
         
-        # Lägg till relaterad musikdata om det finns
-        if post.song_id:
-            song = Song.query.get(post.song_id)
-            if song:
-                post_data["song"] = {
-                    "id": song.id,
-                    "title": song.title,
-                    "artist": song.artist,
-                    "cover_url": song.cover_url,
-                    "spotify_url": song.spotify_url,
-                    "embed_url": song.embed_url
-                }
-                
-        if post.album_id:
-            album = Album.query.get(post.album_id)
-            if album:
-                post_data["album"] = {
-                    "id": album.id,
-                    "title": album.title,
-                    "artist": album.artist,
-                    "cover_url": album.cover_url,
-                    "spotify_url": album.spotify_url
-                }
-                
-        if post.artist_id:
-            artist = Artist.query.get(post.artist_id)
-            if artist:
-                post_data["artist"] = {
-                    "id": artist.id,
-                    "name": artist.name,
-                    "cover_url": artist.cover_url,
-                    "spotify_url": artist.spotify_url
-                }
-                
-        posts_data.append(post_data)
+        data = {
+            "posts": hydrate_posts(paginated_posts.items, viewer_id),
+            "has_next": paginated_posts.has_next,
+            "has_prev": paginated_posts.has_prev,
+            "page": paginated_posts.page,
+            "total_pages": paginated_posts.pages,
+            "total_items": paginated_posts.total
+        }
+        page_posts = paginated_posts.items
     
-    return jsonify({
-        "posts": posts_data,
-        "has_next": paginated_posts.has_next,
-        "has_prev": paginated_posts.has_prev,
-        "page": paginated_posts.page,
-        "total_pages": paginated_posts.pages,
-        "total_items": paginated_posts.total
-    })
+    subjects = feed_cache.feed_subjects(viewer_id, page_posts, celebrity_ids)
+    entry = feed_cache.store(cache_key, tick, data, subjects)
+    return feed_cache.respond(entry, request)
 
 @posts.route('/api/posts/<int:post_id>')
 def get_post(post_id):
     """Hämta ett specifikt inlägg"""
-    post = Post.query.get_or_404(post_id)
-    user = User.query.get(post.user_id)
+    post = Post.query.filter_by(id=post_id, deleted_at=None).first_or_404()
     
     # Skapa svarsdata
-    post_data = {
-        "id": post.id,
-        "content": post.content,
-        "created_at": post.created_at.strftime("%Y-%m-%d %H:%M:%S"),
-        "user": {
-            "id": user.id,
-            "username": user.username,
-            "profile_picture": user.profile.profile_picture if user.profile else "default.jpg"
-        },
-        "likes_count": post.likes.count(),
-        "comments_count": post.comments.count(),
-        "liked_by_user": False
-    }
-    
-    # Kolla om inloggad användare har gillat inlägget
-    if current_user.is_authenticated:
-        post_data["liked_by_user"] = post.likes.filter_by(user_id=current_user.id).first() is not None
-    
-    # Lägg till relaterad musikdata om det finns
-    if post.song_id:
-        song = Song.query.get(post.song_id)
-        if song:
-            post_data["song"] = {
-                "id": song.id,
-                "title": song.title,
-                "artist": song.artist,
-                "cover_url": song.cover_url,
-                "spotify_url": song.spotify_url,
-                "embed_url": song.embed_url
-            }
-            
-    if post.album_id:
-        album = Album.query.get(post.album_id)
-        if album:
-            post_data["album"] = {
-                "id": album.id,
-                "title": album.title,
-                "artist": album.artist,
-                "cover_url": album.cover_url,
-                "spotify_url": album.spotify_url
-            }
-            
-    if post.artist_id:
-        artist = Artist.query.get(post.artist_id)
-        if artist:
-            post_data["artist"] = {
-                "id": artist.id,
-                "name": artist.name,
-                "cover_url": artist.cover_url,
-                "spotify_url": artist.spotify_url
-            }
+    viewer_id = current_user.id if current_user.is_authenticated else None
+    post_data = hydrate_posts([post], viewer_id)[0]
     
     return jsonify(post_data)
 
@@ -193,8 +140,15 @@ def create_post():
         new_post.artist_id = artist_id
     
     db.session.add(new_post)
+    db.session.flush()
+    
+    # Lägg inlägget i följarnas hemflöden i samma transaktion
+    follower_ids = timeline.fan_out_post(new_post)
+    trending.record_post(new_post)
     db.session.commit()
     
+    feed_cache.invalidate_feed_membership(current_user.id, follower_ids)
+    
     return jsonify({
         "success": True,
         "message": "Inlägget har skapats",
@@ -205,7 +159,7 @@ def create_post():
 @login_required
 def update_post(post_id):
     """Uppdatera ett inlägg"""
-    post = Post.query.get_or_404(post_id)
+    post = Post.query.filter_by(id=post_id, deleted_at=None).first_or_404()
     
     # Kolla att det är användarens egna inlägg
     if post.user_id != current_user.id:
@@ -220,6 +174,8 @@ def update_post(post_id):
     post.content = content
     db.session.commit()
     
+    feed_cache.invalidate_post(post_id)
+    
     return jsonify({
         "success": True,
         "message": "Inlägget har uppdaterats"
@@ -229,14 +185,21 @@ def update_post(post_id):
 @login_required
 def delete_post(post_id):
     """Ta bort ett inlägg"""
-    post = Post.query.get_or_404(post_id)
+    post = Post.query.filter_by(id=post_id, deleted_at=None).first_or_404()
     
     # Kolla att det är användarens egna inlägg
     if post.user_id != current_user.id:
         return jsonify({"error": "Du kan bara ta bort dina egna inlägg"}), 403
     
-    db.session.delete(post)
+    author_id = post.user_id
+    affected_ids = timeline.remove_post(post.id)
+    # Gillningar och kommentarer läses inte in; stora inlägg rensas i bakgrunden
+    needs_purge = post_deletion.delete_post(post)
     db.session.commit()
+    if needs_purge:
+        purge_post_later(post_id)
+    
+    feed_cache.invalidate_feed_membership(author_id, affected_ids, post_id)
     
     return jsonify({
         "success": True,
@@ -247,7 +210,7 @@ def delete_post(post_id):
 @login_required
 def like_post(post_id):
     """Gilla/ogilla ett inlägg"""
-    post = Post.query.get_or_404(post_id)
+    post = Post.query.filter_by(id=post_id, deleted_at=None).first_or_404()
     
     # Kolla om användaren redan gillat inlägget
     existing_like = Like.query.filter_by(user_id=current_user.id, post_id=post_id).first()
@@ -255,7 +218,7 @@ def like_post(post_id):
     if existing_like:
         # Ta bort gillamarkeringen om den redan finns
         db.session.delete(existing_like)
-        action = "unliked"
+        like, action = existing_like, "unliked"
     else:
         # Lägg till en gillamarkering
         new_like = Like(
@@ -264,20 +227,36 @@ def like_post(post_id):
             created_at=datetime.utcnow()
         )
         db.session.add(new_like)
-        action = "liked"
+        like, action = new_like, "liked"
+    
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # En samtidig begäran från samma användare hann före (uq_like_user_post),
+        # eller så togs inlägget bort under tiden; svara med läget som det är nu
+        db.session.rollback()
+        post = Post.query.filter_by(id=post_id, deleted_at=None).first_or_404()
+        liked = Like.query.filter_by(user_id=current_user.id, post_id=post_id).first() is not None
+        return jsonify({
+            "success": True,
+            "action": "liked" if liked else "unliked",
+            "likes_count": post.like_count
+        })
+    feed_cache.invalidate_post(post_id)
     
-    db.session.commit()
+    # Trendpoängen uppdateras i bakgrunden
+    record_like_later(post, like, removed=action == "unliked")
     
     return jsonify({
         "success": True,
         "action": action,
-        "likes_count": post.likes.count()
+        "likes_count": post.like_count
     })
 
 @posts.route('/api/posts/<int:post_id>/comments')
 def get_comments(post_id):
     """Hämta kommentarer för ett inlägg"""
-    post = Post.query.get_or_404(post_id)
+    post = Post.query.filter_by(id=post_id, deleted_at=None).first_or_404()
     
     # Hämta kommentarer sorterade efter datum
     comments = post.comments.order_by(Comment.created_at).all()
@@ -307,7 +286,7 @@ def get_comments(post_id):
 @login_required
 def create_comment(post_id):
     """Skapa en ny kommentar på ett inlägg"""
-    post = Post.query.get_or_404(post_id)
+    post = Post.query.filter_by(id=post_id, deleted_at=None).first_or_404()
     data = request.json
     content = data.get('content')
     
@@ -324,6 +303,7 @@ def create_comment(post_id):
     
     db.session.add(new_comment)
     db.session.commit()
+    feed_cache.invalidate_post(post_id)
     
     # Hämta användardata för svaret
     user = current_user
@@ -357,6 +337,7 @@ def delete_comment(comment_id):
     
     db.session.delete(comment)
     db.session.commit()
+    feed_cache.invalidate_post(post_id)
     
     return jsonify({
         "success": True,
@@ -370,66 +351,25 @@ def get_user_posts(username):
     user = User.query.filter_by(username=username).first_or_404()
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 10, type=int)
+    cursor = request.args.get('cursor')
+    viewer_id = current_user.id if current_user.is_authenticated else None
+    
+    # Keyset-paginering om klienten skickar en cursor (tom cursor = första sidan)
+    if cursor is not None:
+        try:
+            user_page = keyset_paginate(
+                Post.query.filter_by(user_id=user.id, deleted_at=None), [Post.created_at, Post.id], cursor, per_page,
+                descending=True, key_func=timeline.post_cursor_key, count=wants_total()
+            )
+        except InvalidCursor:
+            return jsonify({"error": "Ogiltig cursor"}), 400
+        
+        return jsonify(keyset_response(user_page, viewer_id, username=user.username))
     
     # Hämta användarens inlägg
-    user_posts = Post.query.filter_by(user_id=user.id).order_by(Post.created_at.desc()).paginate(page=page, per_page=per_page)
-    
-    posts_data = []
-    for post in user_posts.items:
-        # Grundläggande inläggsdata
-        post_data = {
-            "id": post.id,
-            "content": post.content,
-            "created_at": post.created_at.strftime("%Y-%m-%d %H:%M:%S"),
-            "user": {
-                "id": user.id,
-                "username": user.username,
-                "profile_picture": user.profile.profile_picture if user.profile else "default.jpg"
-            },
-            "likes_count": post.likes.count(),
-            "comments_count": post.comments.count(),
-            "liked_by_user": False
-        }
-        
-        # Kolla om inloggad användare har gillat inlägget
-        if current_user.is_authenticated:
-            post_data["liked_by_user"] = post.likes.filter_by(user_id=current_user.id).first() is not None
-        
-        # Lägg till relaterad musikdata om det finns
-        if post.song_id:
-            song = Song.query.get(post.song_id)
-            if song:
-                post_data["song"] = {
-                    "id": song.id,
-                    "title": song.title,
-                    "artist": song.artist,
-                    "cover_url": song.cover_url,
-                    "spotify_url": song.spotify_url,
-                    "embed_url": song.embed_url
-                }
-                
-        if post.album_id:
-            album = Album.query.get(post.album_id)
-            if album:
-                post_data["album"] = {
-                    "id": album.id,
-                    "title": album.title,
-                    "artist": album.artist,
-                    "cover_url": album.cover_url,
-                    "spotify_url": album.spotify_url
-                }
-                
-        if post.artist_id:
-            artist = Artist.query.get(post.artist_id)
-            if artist:
-                post_data["artist"] = {
-                    "id": artist.id,
-                    "name": artist.name,
-                    "cover_url": artist.cover_url,
-                    "spotify_url": artist.spotify_url
-                }
-                
-        posts_data.append(post_data)
+    user_posts = Post.query.filter_by(user_id=user.id, deleted_at=None).order_by(Post.created_at.desc()).paginate(page=page, per_page=per_page)
+    
+    posts_data = hydrate_posts(user_posts.items, viewer_id)
     
     return jsonify({
         "username": user.username,
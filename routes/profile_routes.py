@@ -5,8 +5,16 @@ import os
 from datetime import datetime
 
 # Importera modellerna med relativ import
-from models import db, User, Profile, Song, Album, Artist
-from services.spotify_api import SpotifySearch
+from models import db, User, Profile
+from services import timeline
+from services import feed_cache
+from services.follow_graph import follow_graph
+from services.taste import taste_index
+from services import music_catalog
+from services import favorites
+from services.job_handlers import stage_upload, save_upload_later, enrich_favorites_later
+from services.db_routing import replica_reads
+from services.spotify_api import SEARCH_TYPES
 
 # Skapa en Blueprint
 profile = Blueprint('profile', __name__)
@@ -30,10 +38,10 @@ def view_profile(username):
     user = User.query.filter_by(username=username).first_or_404()
     profile_data = Profile.query.filter_by(user_id=user.id).first_or_404()
     
-    # Hämta favoritlåtar, album och artister
-    favorite_songs = Song.query.join(user.favorite_songs).all() if hasattr(user, 'favorite_songs') else []
-    favorite_albums = Album.query.join(user.favorite_albums).all() if hasattr(user, 'favorite_albums') else []
-    favorite_artists = Artist.query.join(user.favorite_artists).all() if hasattr(user, 'favorite_artists') else []
+    # Hämta favoritlåtar, album och artister (i användarens ordning)
+    favorite_songs = user.favorite_songs
+    favorite_albums = user.favorite_albums
+    favorite_artists = user.favorite_artists
     
     # Kolla om den inloggade användaren följer profilanvändaren
     is_following = False
@@ -49,6 +57,7 @@ def view_profile(username):
                           is_following=is_following)
 
 @profile.route('/api/profile/<username>')
+@replica_reads
 def get_profile_api(username):
     """API-rutt för att hämta profildata"""
     user = User.query.filter_by(username=username).first()
@@ -71,7 +80,7 @@ def get_profile_api(username):
             "cover_url": song.cover_url,
             "spotify_url": song.spotify_url if hasattr(song, 'spotify_url') else None,
             "embed_url": song.embed_url if hasattr(song, 'embed_url') else None
-        } for song in Song.query.join(user.favorite_songs).all()]
+        } for song in user.favorite_songs]
     
     # Hämta favoritalbum
     favorite_albums = []
@@ -82,7 +91,7 @@ def get_profile_api(username):
             "artist": album.artist,
             "cover_url": album.cover_url,
             "spotify_url": album.spotify_url if hasattr(album, 'spotify_url') else None
-        } for album in Album.query.join(user.favorite_albums).all()]
+        } for album in user.favorite_albums]
     
     # Hämta favoritartister
     favorite_artists = []
@@ -92,7 +101,7 @@ def get_profile_api(username):
             "name": artist.name,
             "cover_url": artist.cover_url,
             "spotify_url": artist.spotify_url if hasattr(artist, 'spotify_url') else None
-        } for artist in Artist.query.join(user.favorite_artists).all()]
+        } for artist in user.favorite_artists]
     
     # Kolla om användaren som tittar följer profilanvändaren
     is_following = False
@@ -159,56 +168,48 @@ def edit_profile():
             profile_data.sotd_artist = request.form.get('sotd_artist', '')
         
         # Hantera favoritlåtar
+        missing_songs = []
         if hasattr(user, 'favorite_songs'):
-            # Rensa befintliga kopplingar
-            user.favorite_songs = []
-            
-            # Lägg till nya låtar
+            pairs = []
             for i in range(5):  # Upp till 5 favoritlåtar
                 title = request.form.get(f'song_title_{i}')
                 artist = request.form.get(f'song_artist_{i}')
                 
                 if title and artist:
-                    # Sök efter låten i databasen eller via Spotify API
-                    song = Song.query.filter_by(title=title, artist=artist).first()
-                    
-                    if not song:
-                        # Sök via Spotify API
-                        spotify_search = SpotifySearch(f"{title} {artist}")
-                        song_data = spotify_search.get_track()
-                        
-                        if song_data:
-                            song = Song(
-                                title=song_data["name"],
-                                artist=song_data["artist"],
-                                album=song_data.get("album", ""),
-                                cover_url=song_data["cover_url"],
-                                spotify_url=song_data.get("spotify_url", ""),
-                                embed_url=song_data.get("embed_link", "")
-                            )
-                            db.session.add(song)
-                            db.session.commit()
-                    
-                    if song:
-                        user.favorite_songs.append(song)
+                    pairs.append((title, artist))
+            
+            # Alla låtar slås upp lokalt i en fråga; de som saknas hämtas från
+            # Spotify av ett bakgrundsjobb efter att profilen sparats
+            songs, missing_songs = music_catalog.resolve_local_songs(pairs)
+            favorites.replace(user.id, 'song', [song.id for song in songs])
+        
+        # Bilderna sparas till temporära filer nu men flyttas på plats av jobb
+        # som köas efter commit; profilen pekas om av jobbet när filen finns
+        uploads = []
         
         # Hantera profilbild
         if 'profile_picture' in request.files and request.files['profile_picture'].filename:
             file = request.files['profile_picture']
             if file and allowed_file(file.filename):
                 filename = secure_filename(f"{user.username}_{int(datetime.utcnow().timestamp())}_profile.{file.filename.rsplit('.', 1)[1].lower()}")
-                file.save(os.path.join(PROFILE_PICS_FOLDER, filename))
-                profile_data.profile_picture = filename
+                path = os.path.join(PROFILE_PICS_FOLDER, filename)
+                uploads.append((stage_upload(file, path), path, 'profile_picture'))
         
         # Hantera Song of the Day-bild
         if 'song_picture' in request.files and request.files['song_picture'].filename and hasattr(profile_data, 'song_picture'):
             file = request.files['song_picture']
             if file and allowed_file(file.filename):
                 filename = secure_filename(f"{user.username}_{int(datetime.utcnow().timestamp())}_song.{file.filename.rsplit('.', 1)[1].lower()}")
-                file.save(os.path.join(SONG_PICS_FOLDER, filename))
-                profile_data.song_picture = filename
+                path = os.path.join(SONG_PICS_FOLDER, filename)
+                uploads.append((stage_upload(file, path), path, 'song_picture'))
         
         db.session.commit()
+        follow_graph.set_genre(user.id, profile_data.favorite_genre)
+        taste_index.refresh_user(user.id)
+        for temporary, path, column in uploads:
+            save_upload_later(temporary, path, user.id, column)
+        if missing_songs:
+            enrich_favorites_later(user.id, missing_songs)
         flash('Profilen uppdaterad!')
         return redirect(url_for('profile.view_profile', username=user.username))
     
@@ -217,145 +218,105 @@ def edit_profile():
 @profile.route('/api/profile/music-search', methods=['GET'])
 @login_required
 def search_music():
-    """Sök efter musik via Spotify API"""
+    """Sök efter musik i den lokala katalogen och via Spotify API"""
     query = request.args.get('q', '')
     search_type = request.args.get('type', 'track')  # track, album, eller artist
     
     if not query:
         return jsonify({"error": "Sökterm krävs"}), 400
     
-    spotify_search = SpotifySearch(query)
-    
-    if search_type == 'track':
-        result = spotify_search.get_track()
-    elif search_type == 'album':
-        result = spotify_search.get_album()
-    elif search_type == 'artist':
-        result = spotify_search.get_artist()
-    else:
+    if search_type not in SEARCH_TYPES:
         return jsonify({"error": "Ogiltig söktyp"}), 400
     
+    # Katalogen först; Spotify bara vid miss, och träffar därifrån sparas i katalogen
+    result = music_catalog.search(query, search_type)
+    db.session.commit()
+    
     if not result:
         return jsonify({"error": "Inga resultat hittades"}), 404
     
     return jsonify(result)
 
+# Svar för add-favorite och remove-favorite per typ
+_ADDED_MESSAGES = {
+    'song': "Låt tillagd som favorit",
+    'album': "Album tillagt som favorit",
+    'artist': "Artist tillagd som favorit",
+}
+_REMOVED_MESSAGES = {
+    'song': "Låt borttagen från favoriter",
+    'album': "Album borttaget från favoriter",
+    'artist': "Artist borttagen från favoriter",
+}
+_NOT_FOUND_MESSAGES = {
+    'song': "Låten hittades inte",
+    'album': "Albumet hittades inte",
+    'artist': "Artisten hittades inte",
+}
+
+def _save_favorites(user, add=(), remove=(), order=None):
+    """Genomför en favoritbatch i en transaktion och uppdatera smakindexet"""
+    result = favorites.apply(user.id, add, remove, order)
+    db.session.commit()
+    if favorites.changed(result):
+        taste_index.refresh_user(user.id)
+    return result
+
+@profile.route('/api/profile/favorites/batch', methods=['POST'])
+@login_required
+def batch_favorites():
+    """Lägg till, ta bort och ordna om flera favoriter av blandade typer i en transaktion"""
+    try:
+        add, remove, order = favorites.parse_batch(request.get_json(silent=True))
+    except favorites.InvalidBatch as e:
+        return jsonify({"error": str(e)}), 400
+    
+    result = _save_favorites(current_user, add, remove, order)
+    return jsonify({"success": True, **result})
+
 @profile.route('/api/profile/add-favorite', methods=['POST'])
 @login_required
 def add_favorite():
     """Lägg till en låt, album eller artist som favorit"""
-    data = request.json
+    data = request.get_json(silent=True) or {}
     item_type = data.get('type')  # 'song', 'album', eller 'artist'
     item_data = data.get('data')
     
     if not item_type or not item_data:
         return jsonify({"error": "Typ och data krävs"}), 400
     
-    user = current_user
-    
-    # Hantera de olika typerna
-    if item_type == 'song' and hasattr(user, 'favorite_songs'):
-        # Sök efter låten eller skapa den
-        song = Song.query.filter_by(title=item_data.get('title'), artist=item_data.get('artist')).first()
-        
-        if not song:
-            song = Song(
-                title=item_data.get('title'),
-                artist=item_data.get('artist'),
-                album=item_data.get('album', ''),
-                cover_url=item_data.get('cover_url'),
-                spotify_url=item_data.get('spotify_url'),
-                embed_url=item_data.get('embed_url')
-            )
-            db.session.add(song)
-            db.session.commit()
-        
-        # Lägg till i favoriter om den inte redan finns
-        if song not in user.favorite_songs:
-            user.favorite_songs.append(song)
-            db.session.commit()
-            
-        return jsonify({"success": True, "message": "Låt tillagd som favorit"})
+    try:
+        add, _, _ = favorites.parse_batch({"add": [{"type": item_type, "data": item_data}]})
+    except favorites.InvalidBatch:
+        return jsonify({"error": "Ogiltig typ eller funktionaliteten stöds inte"}), 400
     
-    elif item_type == 'album' and hasattr(user, 'favorite_albums'):
-        # Sök efter albumet eller skapa det
-        album = Album.query.filter_by(title=item_data.get('title'), artist=item_data.get('artist')).first()
-        
-        if not album:
-            album = Album(
-                title=item_data.get('title'),
-                artist=item_data.get('artist'),
-                cover_url=item_data.get('cover_url'),
-                spotify_url=item_data.get('spotify_url')
-            )
-            db.session.add(album)
-            db.session.commit()
-        
-        # Lägg till i favoriter om det inte redan finns
-        if album not in user.favorite_albums:
-            user.favorite_albums.append(album)
-            db.session.commit()
-            
-        return jsonify({"success": True, "message": "Album tillagt som favorit"})
+    result = _save_favorites(current_user, add=add)
+    if result['not_found']:
+        return jsonify({"error": _NOT_FOUND_MESSAGES[item_type]}), 404
     
-    elif item_type == 'artist' and hasattr(user, 'favorite_artists'):
-        # Sök efter artisten eller skapa den
-        artist = Artist.query.filter_by(name=item_data.get('name')).first()
-        
-        if not artist:
-            artist = Artist(
-                name=item_data.get('name'),
-                cover_url=item_data.get('cover_url'),
-                spotify_url=item_data.get('spotify_url')
-            )
-            db.session.add(artist)
-            db.session.commit()
-        
-        # Lägg till i favoriter om den inte redan finns
-        if artist not in user.favorite_artists:
-            user.favorite_artists.append(artist)
-            db.session.commit()
-            
-        return jsonify({"success": True, "message": "Artist tillagd som favorit"})
-    
-    return jsonify({"error": "Ogiltig typ eller funktionaliteten stöds inte"}), 400
+    return jsonify({"success": True, "message": _ADDED_MESSAGES[item_type]})
 
 @profile.route('/api/profile/remove-favorite', methods=['POST'])
 @login_required
 def remove_favorite():
     """Ta bort en låt, album eller artist från favoriter"""
-    data = request.json
+    data = request.get_json(silent=True) or {}
     item_type = data.get('type')  # 'song', 'album', eller 'artist'
     item_id = data.get('id')
     
     if not item_type or not item_id:
         return jsonify({"error": "Typ och ID krävs"}), 400
     
-    user = current_user
+    try:
+        _, remove, _ = favorites.parse_batch({"remove": [{"type": item_type, "id": item_id}]})
+    except favorites.InvalidBatch:
+        return jsonify({"error": "Objektet hittades inte"}), 404
+    
+    result = _save_favorites(current_user, remove=remove)
+    if result['not_found']:
+        return jsonify({"error": "Objektet hittades inte"}), 404
     
-    # Hantera de olika typerna
-    if item_type == 'song' and hasattr(user, 'favorite_songs'):
-        song = Song.query.get(item_id)
-        if song and song in user.favorite_songs:
-            user.favorite_songs.remove(song)
-            db.session.commit()
-            return jsonify({"success": True, "message": "Låt borttagen från favoriter"})
-    
-    elif item_type == 'album' and hasattr(user, 'favorite_albums'):
-        album = Album.query.get(item_id)
-        if album and album in user.favorite_albums:
-            user.favorite_albums.remove(album)
-            db.session.commit()
-            return jsonify({"success": True, "message": "Album borttaget från favoriter"})
-    
-    elif item_type == 'artist' and hasattr(user, 'favorite_artists'):
-        artist = Artist.query.get(item_id)
-        if artist and artist in user.favorite_artists:
-            user.favorite_artists.remove(artist)
-            db.session.commit()
-            return jsonify({"success": True, "message": "Artist borttagen från favoriter"})
-    
-    return jsonify({"error": "Objektet hittades inte"}, 404)
+    return jsonify({"success": True, "message": _REMOVED_MESSAGES[item_type]})
 
 @profile.route('/follow/<username>', methods=['POST'])
 @login_required
@@ -373,7 +334,9 @@ def follow_user(username):
     
     if hasattr(current_user, 'follow'):
         current_user.follow(user_to_follow)
+        timeline.backfill(current_user.id, user_to_follow.id)
         db.session.commit()
+        feed_cache.invalidate_viewer(current_user.id)
     
     flash(f'Du följer nu {username}')
     return redirect(url_for('profile.view_profile', username=username))
@@ -390,7 +353,9 @@ def unfollow_user(username):
     
     if hasattr(current_user, 'unfollow'):
         current_user.unfollow(user_to_unfollow)
+        timeline.prune(current_user.id, user_to_unfollow.id)
         db.session.commit()
+        feed_cache.invalidate_viewer(current_user.id)
     
     flash(f'Du följer inte längre {username}')
     return redirect(url_for('profile.view_profile', username=username))
@@ -415,14 +380,17 @@ def follow_user_api(username):
     
     if is_following:
         current_user.unfollow(user_to_follow)
+        timeline.prune(current_user.id, user_to_follow.id)
         message = f"Du följer inte längre {username}"
         action = "unfollow"
     else:
         current_user.follow(user_to_follow)
+        timeline.backfill(current_user.id, user_to_follow.id)
         message = f"Du följer nu {username}"
         action = "follow"
         
     db.session.commit()
+    feed_cache.invalidate_viewer(current_user.id)
     
     followers_count = user_to_follow.followers.count() if hasattr(user_to_follow, 'followers') else 0
     
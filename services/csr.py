@@ -0,0 +1,60 @@
+import numpy as np
+
+EMPTY = np.empty(0, dtype=np.int64)
+
+
+class Csr:
+    """Gles, oföränderlig rad → värden-struktur (CSR) över godtyckliga heltals-id:n.
+
+    Värdena för rad rows[i] ligger sorterade i indices[indptr[i]:indptr[i + 1]].
+    Id:n förutsätts rymmas i 32 bitar.
+    """
+
+    def __init__(self, row_ids, values):
+        # Sortera och ta bort dubbletter via en packad 64-bitarsnyckel per par
+        keys = np.unique((np.asarray(row_ids, dtype=np.int64) << 32) | np.asarray(values, dtype=np.int64))
+        rows = keys >> 32
+        self.indices = keys & 0xFFFFFFFF
+
+        self.rows, counts = np.unique(rows, return_counts=True)
+        self.indptr = np.zeros(len(self.rows) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.indptr[1:])
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        array = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        return cls(array[:, 0], array[:, 1])
+
+    def transpose(self):
+        """Samma relation åt andra hållet (värde → rader)"""
+        return Csr(self.indices, np.repeat(self.rows, np.diff(self.indptr)))
+
+    def row_slices(self, row_ids):
+        """(start, slut) i indices för varje rad; tomt intervall om raden saknas"""
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+        if not len(self.rows):
+            zeros = np.zeros(len(row_ids), dtype=np.int64)
+            return zeros, zeros
+        positions = np.minimum(np.searchsorted(self.rows, row_ids), len(self.rows) - 1)
+        found = self.rows[positions] == row_ids
+        starts = np.where(found, self.indptr[positions], 0)
+        ends = np.where(found, self.indptr[positions + 1], 0)
+        return starts, ends
+
+    def row(self, row_id):
+        starts, ends = self.row_slices([row_id])
+        return self.indices[starts[0]:ends[0]]
+
+    def lengths(self, row_ids):
+        starts, ends = self.row_slices(row_ids)
+        return ends - starts
+
+    def gather(self, row_ids):
+        """Alla värden för flera rader efter varandra, i en vektoriserad operation"""
+        starts, ends = self.row_slices(row_ids)
+        lengths = ends - starts
+        total = int(lengths.sum())
+        if total == 0:
+            return EMPTY
+        offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        return self.indices[offsets + np.arange(total)]
@@ -0,0 +1,195 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import g, has_request_context, session as flask_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import Column, Float, Integer, MetaData, Table, event, select, update, insert
+from sqlalchemy.exc import SQLAlchemyError
+
+# Läsningar i rutter märkta med @replica_reads kan gå till en läsreplik
+# (DATABASE_REPLICA_URLS, kommaseparerade). Skrivningar, SELECT ... FOR UPDATE
+# och allt efter en skrivning i samma session går till primären.
+
+# En replik som ligger längre efter än så här används inte. Lika länge efter
+# en egen skrivning läser klienten från primären (read-your-writes).
+MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', 5))
+
+# Hur ofta en repliks eftersläpning mäts (per process)
+LAG_CHECK_INTERVAL = 1.0
+
+# Hur ofta primärens hjärtslag högst skrivs vid skrivtrafik (per process). En
+# skrivning inom intervallet schemalägger ett hjärtslag när det gått ut, så
+# att ingen skrivning blir utan ett senare hjärtslag.
+HEARTBEAT_INTERVAL = 1.0
+
+_heartbeat = Table(
+    'replica_heartbeat', MetaData(),
+    Column('id', Integer, primary_key=True),
+    Column('written_at', Float, nullable=False),
+)
+
+
+def replica_binds(urls, engine_options):
+    """SQLALCHEMY_BINDS för replikerna; nycklarna saknar modeller så create_all rör dem inte"""
+    return {f'replica_{i}': {'url': url, **engine_options(url)} for i, url in enumerate(urls)}
+
+
+class RoutingSession(Session):
+    """Session som skickar läsningar till replikan som valts för anropet"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self._reads_from_replica(clause):
+            return self._db.engines[g.db_replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _reads_from_replica(self, clause):
+        if not has_request_context() or g.get('db_replica') is None:
+            return False
+        if self._flushing or self.info.get('wrote'):
+            return False
+        return (clause is not None and getattr(clause, 'is_select', False)
+                and getattr(clause, '_for_update_arg', None) is None)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _flushed(session, flush_context):
+    # Resten av sessionen läser från primären, så att den ser sina egna skrivningar
+    session.info['wrote'] = True
+    session.info['wrote_in_transaction'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _committed(session):
+    if session.info.pop('wrote_in_transaction', False):
+        replicas.note_write(session._db)
+
+
+@event.listens_for(RoutingSession, 'after_soft_rollback')
+def _rolled_back(session, previous_transaction):
+    session.info.pop('wrote_in_transaction', None)
+
+
+class ReplicaRouter:
+    """Väljer replik per anrop och håller koll på repliksernas eftersläpning"""
+
+    def __init__(self):
+        self.keys = []
+        self._lag = {}
+        self._heartbeat_at = 0.0
+        self._heartbeat_lock = threading.Lock()
+        self._heartbeat_timer = None
+        self._primary = None
+        self._logger = None
+
+    def init_app(self, app, db):
+        self.keys = sorted(key for key in app.config.get('SQLALCHEMY_BINDS', {}) if key.startswith('replica_'))
+        self._logger = app.logger
+        if self.keys:
+            with app.app_context():
+                self._primary = db.engines[None]
+                _heartbeat.create(self._primary, checkfirst=True)
+                for key in self.keys:
+                    engine = db.engines[key]
+                    if engine.dialect.name == 'sqlite':
+                        # Skydd mot skrivningar som av misstag hamnar på en kopia
+                        event.listen(engine, 'connect', _sqlite_query_only)
+        app.extensions['db_replicas'] = self
+
+    @property
+    def enabled(self):
+        return bool(self.keys)
+
+    def lag(self, db, key):
+        """Sekunder som repliken ligger efter primären (inf om den inte går att läsa)"""
+        now = time.monotonic()
+        checked = self._lag.get(key)
+        if checked and now - checked[0] < LAG_CHECK_INTERVAL:
+            return checked[1]
+        try:
+            with db.engines[None].connect() as connection:
+                primary = connection.execute(select(_heartbeat.c.written_at)).scalar()
+            with db.engines[key].connect() as connection:
+                replica = connection.execute(select(_heartbeat.c.written_at)).scalar()
+            lag = 0.0 if primary is None else max(0.0, primary - (replica or 0.0))
+        except SQLAlchemyError:
+            lag = float('inf')
+        self._lag[key] = (now, lag)
+        return lag
+
+    def choose(self, db):
+        """Repliken för det här anropet, eller None för primären"""
+        if not self.keys:
+            return None
+        wrote_at = flask_session.get('db_wrote_at')
+        if wrote_at and time.time() - wrote_at < MAX_LAG:
+            return None
+        healthy = [key for key in self.keys if self.lag(db, key) <= MAX_LAG]
+        return random.choice(healthy) if healthy else None
+
+    def note_write(self, db):
+        if not self.keys:
+            return
+        if has_request_context():
+            flask_session['db_wrote_at'] = time.time()
+
+        with self._heartbeat_lock:
+            if self._heartbeat_timer is not None:
+                # Ett schemalagt hjärtslag skrivs efter den här skrivningen
+                return
+            wait = self._heartbeat_at + HEARTBEAT_INTERVAL - time.monotonic()
+            if wait > 0:
+                self._heartbeat_timer = threading.Timer(wait, self._scheduled_heartbeat)
+                self._heartbeat_timer.daemon = True
+                self._heartbeat_timer.start()
+                return
+            self._heartbeat_at = time.monotonic()
+        self._write_heartbeat()
+
+    def _scheduled_heartbeat(self):
+        with self._heartbeat_lock:
+            self._heartbeat_timer = None
+            self._heartbeat_at = time.monotonic()
+        self._write_heartbeat()
+
+    def _write_heartbeat(self):
+        try:
+            with self._primary.begin() as connection:
+                written = connection.execute(
+                    update(_heartbeat).where(_heartbeat.c.id == 1).values(written_at=time.time())
+                ).rowcount
+                if not written:
+                    connection.execute(insert(_heartbeat).values(id=1, written_at=time.time()))
+        except SQLAlchemyError:
+            self._logger.exception("Kunde inte skriva replikhjärtslaget")
+
+
+def _sqlite_query_only(dbapi_connection, connection_record):
+    dbapi_connection.execute('PRAGMA query_only = ON')
+
+
+replicas = ReplicaRouter()
+
+
+def replica_reads(view):
+    """Låt rutten läsa från en replik när det går"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        from models import db
+        g.db_replica = replicas.choose(db)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def sync_sqlite_replica(primary_path, replica_path):
+    """Kopiera primären till en lokal SQLite-replik (för test utan riktig replikering)"""
+    source = sqlite3.connect(primary_path)
+    target = sqlite3.connect(replica_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
@@ -0,0 +1,259 @@
+import os
+from collections import defaultdict
+
+from sqlalchemy import bindparam, func, inspect, literal_column, select, text
+
+from models import db, Song, Album, Artist, insert_ignoring_duplicates, user_favorite_songs, user_favorite_albums, user_favorite_artists
+from services import music_catalog
+
+# Favorittyper: relationstabell, katalogmodell och objektkolumn
+KINDS = {
+    'song': (user_favorite_songs, Song, 'song_id'),
+    'album': (user_favorite_albums, Album, 'album_id'),
+    'artist': (user_favorite_artists, Artist, 'artist_id'),
+}
+
+# Största antal ändringar (tillägg, borttagningar och id:n i order) per anrop
+MAX_BATCH = int(os.getenv('FAVORITES_MAX_BATCH', 200))
+
+
+class InvalidBatch(ValueError):
+    """Batchen har fel form, en okänd typ eller för många ändringar"""
+
+
+def _item_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise InvalidBatch(f"Ogiltigt id: {value!r}")
+
+
+def _kind(entry):
+    if not isinstance(entry, dict) or entry.get('type') not in KINDS:
+        raise InvalidBatch("Varje post behöver en typ: song, album eller artist")
+    return entry['type']
+
+
+def parse_batch(data):
+    """Kontrollera en batch från klienten och returnera (add, remove, order).
+
+    Formen är {"add": [...], "remove": [...], "order": {...}}. Poster i add är
+    {"type", "id"} för en befintlig katalogpost eller {"type", "data"} som i
+    add-favorite, poster i remove är {"type", "id"} och order är typ → id:n i
+    önskad ordning.
+    """
+    if not isinstance(data, dict):
+        raise InvalidBatch("JSON-objekt krävs")
+    add, remove, order = data.get('add') or [], data.get('remove') or [], data.get('order') or {}
+    if not isinstance(add, list) or not isinstance(remove, list) or not isinstance(order, dict):
+        raise InvalidBatch("add och remove ska vara listor och order ett objekt")
+
+    parsed_add = []
+    for entry in add:
+        kind = _kind(entry)
+        if entry.get('id') is not None:
+            parsed_add.append({'type': kind, 'id': _item_id(entry['id'])})
+        elif isinstance(entry.get('data'), dict) and entry['data']:
+            parsed_add.append({'type': kind, 'data': entry['data']})
+        else:
+            raise InvalidBatch("Poster i add behöver id eller data")
+    parsed_remove = [{'type': _kind(entry), 'id': _item_id(entry.get('id'))} for entry in remove]
+
+    parsed_order = {}
+    for kind, ids in order.items():
+        if kind not in KINDS or not isinstance(ids, list):
+            raise InvalidBatch("order ska vara typ → lista med id:n")
+        parsed_order[kind] = [_item_id(item_id) for item_id in ids]
+
+    if len(parsed_add) + len(parsed_remove) + sum(map(len, parsed_order.values())) > MAX_BATCH:
+        raise InvalidBatch(f"Högst {MAX_BATCH} ändringar per anrop")
+    return parsed_add, parsed_remove, parsed_order
+
+
+def _member_ids(user_id, kind, ids):
+    """De av id:na som redan är användarens favoriter, via det unika indexet"""
+    table, _, column = KINDS[kind]
+    return set(db.session.execute(
+        select(table.c[column]).where(table.c.user_id == user_id, table.c[column].in_(ids))
+    ).scalars())
+
+
+def add(user_id, kind, ids):
+    """Lägg till katalogposter sist i användarens lista (utan commit); returnerar de nya id:na"""
+    table, _, column = KINDS[kind]
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return []
+    present = _member_ids(user_id, kind, ids)
+    new = [item_id for item_id in ids if item_id not in present]
+    if not new:
+        return []
+    last = db.session.execute(
+        select(func.max(table.c.position)).where(table.c.user_id == user_id)
+    ).scalar()
+    start = 0 if last is None else last + 1
+    # Samtidiga anrop kan lägga till samma favorit; dubbletten hoppas då över
+    db.session.execute(insert_ignoring_duplicates(table), [
+        {'user_id': user_id, column: item_id, 'position': start + n} for n, item_id in enumerate(new)
+    ])
+    return new
+
+
+def remove(user_id, kind, ids):
+    """Ta bort favoriter (utan commit); returnerar id:na som faktiskt togs bort"""
+    table, _, column = KINDS[kind]
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return []
+    present = _member_ids(user_id, kind, ids)
+    if present:
+        db.session.execute(table.delete().where(
+            table.c.user_id == user_id, table.c[column].in_(list(present))
+        ))
+    return [item_id for item_id in ids if item_id in present]
+
+
+def reorder(user_id, kind, ids):
+    """Ställ favoriterna i id:nas ordning (utan commit).
+
+    Favoriter som inte nämns behåller sin inbördes ordning efter de nämnda;
+    id:n som inte är favoriter ignoreras. Bara rader som flyttas skrivs, i en
+    sats. Returnerar antalet flyttade rader.
+    """
+    table, _, column = KINDS[kind]
+    current = db.session.execute(
+        select(table.c[column], table.c.position).where(table.c.user_id == user_id).order_by(table.c.position)
+    ).all()
+    positions = dict(current)
+    wanted = [item_id for item_id in dict.fromkeys(ids) if item_id in positions]
+    listed = set(wanted)
+    ordered = wanted + [item_id for item_id, _ in current if item_id not in listed]
+
+    changes = [
+        {'row_item': item_id, 'new_position': n}
+        for n, item_id in enumerate(ordered) if positions[item_id] != n
+    ]
+    if changes:
+        db.session.execute(
+            table.update().where(
+                table.c.user_id == user_id, table.c[column] == bindparam('row_item')
+            ).values(position=bindparam('new_position')),
+            changes
+        )
+    return len(changes)
+
+
+def replace(user_id, kind, ids):
+    """Gör id:na till användarens hela lista av typen, i den ordningen (utan commit)"""
+    table, _, column = KINDS[kind]
+    ids = list(dict.fromkeys(ids))
+    current = db.session.execute(select(table.c[column]).where(table.c.user_id == user_id)).scalars().all()
+    keep = set(ids)
+    remove(user_id, kind, [item_id for item_id in current if item_id not in keep])
+    add(user_id, kind, ids)
+    reorder(user_id, kind, ids)
+
+
+def _resolve(entries, not_found):
+    """Katalog-id:n per typ för add-posterna, i postordning.
+
+    Poster med data slås upp eller skapas som i add-favorite, poster med id
+    kontrolleras mot katalogen med en fråga per typ.
+    """
+    resolved = defaultdict(list)
+    for entry in entries:
+        if 'id' in entry:
+            resolved[entry['type']].append(entry['id'])
+            continue
+        item = music_catalog.favorite_item(entry['type'], entry['data'])
+        if item is None:
+            not_found.append(entry)
+        else:
+            resolved[entry['type']].append(item)
+
+    # Nya katalogposter behöver sina id:n
+    if any(not isinstance(item, int) and item.id is None for items in resolved.values() for item in items):
+        db.session.flush()
+
+    result = {}
+    for kind, items in resolved.items():
+        _, model, _ = KINDS[kind]
+        ids = [item if isinstance(item, int) else item.id for item in items]
+        requested = [item for item in items if isinstance(item, int)]
+        existing = set(db.session.execute(
+            select(model.id).where(model.id.in_(requested))
+        ).scalars()) if requested else set()
+        not_found.extend({'type': kind, 'id': item} for item in requested if item not in existing)
+        result[kind] = [
+            item_id for item, item_id in zip(items, ids)
+            if not isinstance(item, int) or item in existing
+        ]
+    return result
+
+
+def apply(user_id, add_entries=(), remove_entries=(), order=None):
+    """Genomför en batch från parse_batch i anroparens transaktion (utan commit).
+
+    Borttagningar görs först, sedan läggs nya favoriter sist i respektive
+    lista och till sist ordnas listorna om. Medlemskap kontrolleras med en
+    fråga per typ mot relationstabellens unika index, så listorna laddas
+    aldrig in i minnet. Returnerar vad som ändrades och posterna som inte
+    fanns.
+    """
+    result = {'added': {}, 'removed': {}, 'reordered': {}, 'not_found': []}
+
+    to_remove = defaultdict(list)
+    for entry in remove_entries:
+        to_remove[entry['type']].append(entry['id'])
+    for kind, ids in to_remove.items():
+        removed = remove(user_id, kind, ids)
+        if removed:
+            result['removed'][kind] = removed
+        result['not_found'].extend({'type': kind, 'id': item_id} for item_id in ids if item_id not in removed)
+
+    for kind, ids in _resolve(add_entries, result['not_found']).items():
+        added = add(user_id, kind, ids)
+        if added:
+            result['added'][kind] = added
+
+    for kind, ids in (order or {}).items():
+        moved = reorder(user_id, kind, ids)
+        if moved:
+            result['reordered'][kind] = moved
+    return result
+
+
+def changed(result):
+    return bool(result['added'] or result['removed'] or result['reordered'])
+
+
+def ensure_position_columns():
+    """Lägg till position i befintliga favorittabeller; returnerar tabellerna som fick kolumnen"""
+    added = []
+    for table, _, _ in KINDS.values():
+        existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+        if 'position' not in existing:
+            db.session.execute(text(f'ALTER TABLE {table.name} ADD COLUMN position INTEGER NOT NULL DEFAULT 0'))
+            added.append(table.name)
+    db.session.commit()
+    return added
+
+
+def number_positions(tables=None):
+    """Numrera befintliga favoriter per användare, med en UPDATE per tabell.
+
+    På SQLite följer numreringen rowid, alltså ordningen favoriterna lades
+    till i; andra databaser saknar en sådan kolumn och numrerar i
+    katalog-id-ordning.
+    """
+    for table, _, column in KINDS.values():
+        if tables is not None and table.name not in tables:
+            continue
+        earlier = table.alias('earlier')
+        if db.engine.dialect.name == 'sqlite':
+            before = literal_column('earlier.rowid') < literal_column(f'{table.name}.rowid')
+        else:
+            before = earlier.c[column] < table.c[column]
+        rank = select(func.count()).where(earlier.c.user_id == table.c.user_id, before).scalar_subquery()
+        db.session.execute(table.update().values(position=rank))
+    db.session.commit()
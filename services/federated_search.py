@@ -0,0 +1,140 @@
+import os
+import time
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from flask import current_app
+
+from models import User, catalog_key
+from services import music_catalog
+from services import user_search
+from services.spotify_api import SpotifySearch
+
+# Så länge väntar vi på Spotify innan de lokala resultaten skickas utan dem
+TIME_BUDGET = float(os.getenv('SEARCH_TIME_BUDGET', 0.8))
+
+RESULT_TYPES = ('user', 'track', 'album', 'artist')
+
+
+def _spotify_key(search_type, result):
+    if search_type == 'artist':
+        return catalog_key(result["name"])
+    title = result["name"] if search_type == 'track' else result["title"]
+    return catalog_key(title), catalog_key(result["artist"])
+
+
+def _catalog_key(search_type, item):
+    if search_type == 'artist':
+        return item.name_key
+    return item.title_key, item.artist_key
+
+
+def _users(term, viewer_id, limit):
+    matches, sort_keys = user_search.search(term)
+    if viewer_id is not None:
+        matches = matches.filter(User.id != viewer_id)
+    users = matches.order_by(*sort_keys).limit(limit).all()
+
+    user_ids = [user.id for user in users]
+    profiles = user_search.profiles_for(user_ids)
+    followed = user_search.followed_among(viewer_id, user_ids) if viewer_id is not None else set()
+
+    results = []
+    for user in users:
+        profile = profiles.get(user.id)
+        result = {
+            "type": "user",
+            "id": user.id,
+            "username": user.username,
+            "profile_picture": profile.profile_picture if profile else "default.jpg",
+            "bio": profile.bio if profile and profile.bio else "",
+            "favorite_genre": profile.favorite_genre if profile and profile.favorite_genre else ""
+        }
+        if viewer_id is not None:
+            result["is_following"] = user.id in followed
+        results.append(result)
+    return results
+
+
+def _catalog(query, search_type, limit):
+    """Katalogträffar som svarsposter och deras söknycklar"""
+    items = music_catalog.search_local(query, search_type, limit)
+    results = [
+        {"type": search_type, "id": item.id, "source": "catalog", **music_catalog.to_result(item, search_type)}
+        for item in items
+    ]
+    return results, {_catalog_key(search_type, item) for item in items}
+
+
+def _in_app_context(app, fn, *args):
+    """Kör fn i pooltråden med en egen app-kontext och databassession"""
+    with app.app_context():
+        return fn(*args)
+
+
+def search(query, viewer_id=None, types=RESULT_TYPES, limit=5, include_spotify=True, budget=TIME_BUDGET):
+    """Användare, katalogen och Spotify i ett svar.
+
+    Spotify-anropet och de lokala sökningarna (användare och en per musiktyp)
+    körs samtidigt i den delade trådpoolen, de lokala med var sin
+    app-kontext, och alla delar samma tidsbudget. Blir Spotify inte klart
+    inom budgeten skickas de lokala resultaten ändå; anropet får då bli klart
+    i bakgrunden och hamnar i sökcachen till nästa gång. En lokal sökning som
+    inte hinner klart ger en tom lista och "local": "timeout".
+    """
+    deadline = time.monotonic() + budget
+    music_types = [t for t in types if t != 'user']
+    app = current_app._get_current_object()
+
+    future = None
+    if include_spotify and music_types:
+        future = music_catalog.submit(SpotifySearch(query).search, music_types, limit)
+
+    local_futures = {}
+    term = user_search.normalize(query) if 'user' in types else None
+    if term:
+        local_futures['user'] = music_catalog.submit(_in_app_context, app, _users, term, viewer_id, limit)
+    for search_type in music_types:
+        local_futures[search_type] = music_catalog.submit(
+            _in_app_context, app, _catalog, query, search_type, limit
+        )
+
+    response = {"query": query}
+    if 'user' in types:
+        response["users"] = []
+    seen = {search_type: set() for search_type in music_types}
+    for search_type, local_future in local_futures.items():
+        try:
+            result = local_future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FutureTimeout:
+            response["local"] = "timeout"
+            result = [] if search_type == 'user' else ([], set())
+        if search_type == 'user':
+            response["users"] = result
+        else:
+            response[f"{search_type}s"], seen[search_type] = result
+
+    if future is None:
+        response["spotify"] = "skipped"
+        return response
+
+    try:
+        pages = future.result(timeout=max(0.0, deadline - time.monotonic()))
+    except FutureTimeout:
+        response["spotify"] = "timeout"
+        return response
+    if pages is None:
+        response["spotify"] = "unavailable"
+        return response
+
+    # Slå ihop: katalogträffar först, Spotify-träffar som redan finns lokalt hoppas över
+    for search_type in music_types:
+        results = response[f"{search_type}s"]
+        for result in pages[f"{search_type}s"]["items"]:
+            if len(results) >= limit:
+                break
+            key = _spotify_key(search_type, result)
+            if key not in seen[search_type]:
+                seen[search_type].add(key)
+                results.append({"type": search_type, "source": "spotify", **result})
+    response["spotify"] = "ok"
+    return response
@@ -0,0 +1,157 @@
+import hashlib
+import os
+import threading
+
+from cachetools import LRUCache, TTLCache
+from flask import current_app, jsonify
+
+# Ämnen som en cachad flödessida beror på. En skrivning "rör" ämnen, och en
+# sida som byggdes innan något av dess ämnen rördes är inaktuell.
+PUBLIC = ("public",)
+
+
+def viewer_subject(viewer_id):
+    return ("viewer", viewer_id) if viewer_id is not None else PUBLIC
+
+
+def post_subject(post_id):
+    return ("post", post_id)
+
+
+def author_subject(author_id):
+    return ("author", author_id)
+
+
+class _TouchLog(LRUCache):
+    """Senaste ändringstick per ämne, med ett golv för bortglömda ämnen.
+
+    När ett ämne trängs ut ur loggen höjs golvet till dess tick, så att alla
+    sidor byggda före det räknas som inaktuella i stället för att felaktigt
+    se färska ut.
+    """
+
+    def __init__(self, maxsize):
+        super().__init__(maxsize)
+        self.floor = 0
+
+    def popitem(self):
+        key, tick = super().popitem()
+        self.floor = max(self.floor, tick)
+        return key, tick
+
+
+class FeedEntry:
+    """En cachad, färdigserialiserad flödessida"""
+
+    def __init__(self, tick, body, subjects):
+        self.tick = tick
+        self.body = body
+        self.subjects = subjects
+        self.etag = hashlib.sha256(body).hexdigest()
+
+
+class FeedCache:
+    """Begränsad LRU/TTL-cache för flödessidor per tittare, cursor och sidstorlek"""
+
+    def __init__(self, maxsize=2048, ttl=60, touch_log_size=100000):
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._touched = _TouchLog(touch_log_size)
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    def begin(self):
+        """Tick att spara med en sida som börjar byggas nu"""
+        with self._lock:
+            return self._tick
+
+    def _is_fresh(self, entry):
+        if entry.tick < self._touched.floor:
+            return False
+        return all(self._touched.get(subject, 0) <= entry.tick for subject in entry.subjects)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if not self._is_fresh(entry):
+                del self._entries[key]
+                return None
+            return entry
+
+    def put(self, key, tick, body, subjects):
+        entry = FeedEntry(tick, body, frozenset(subjects))
+        with self._lock:
+            # Sparas inte om något ändrades medan sidan byggdes
+            if self._is_fresh(entry):
+                self._entries[key] = entry
+        return entry
+
+    def touch(self, *subjects):
+        """Markera ämnen som ändrade; sidor som beror på dem byggs om vid nästa läsning"""
+        with self._lock:
+            self._tick += 1
+            for subject in subjects:
+                self._touched[subject] = self._tick
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+feed_cache = FeedCache(
+    maxsize=int(os.getenv('FEED_CACHE_SIZE', 2048)),
+    ttl=int(os.getenv('FEED_CACHE_TTL', 60))
+)
+
+
+def lookup(key):
+    """Hämta en färsk cachad sida, eller None"""
+    return feed_cache.get(key)
+
+
+def begin():
+    """Starta bygget av en sida; returnerar ticket som ska skickas till store()"""
+    return feed_cache.begin()
+
+
+def feed_subjects(viewer_id, posts, celebrity_ids=()):
+    """Ämnen som en flödessida beror på"""
+    subjects = {viewer_subject(viewer_id)}
+    subjects.update(post_subject(post.id) for post in posts)
+    subjects.update(author_subject(author_id) for author_id in celebrity_ids)
+    return subjects
+
+
+def store(key, tick, data, subjects):
+    """Serialisera svarsdata och spara dem i cachen"""
+    body = jsonify(data).get_data()
+    return feed_cache.put(key, tick, body, subjects)
+
+
+def respond(entry, request):
+    """Bygg ett svar med stark ETag; 304 om klienten redan har samma version"""
+    response = current_app.response_class(entry.body, mimetype='application/json')
+    response.set_etag(entry.etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
+
+def invalidate_post(post_id):
+    """Ett inläggs innehåll, gillningar eller kommentarer har ändrats"""
+    feed_cache.touch(post_subject(post_id))
+
+
+def invalidate_feed_membership(author_id, viewer_ids, post_id=None):
+    """Ett inlägg har lagts till i eller tagits bort ur flera flöden"""
+    subjects = [PUBLIC, viewer_subject(author_id), author_subject(author_id)]
+    subjects.extend(viewer_subject(viewer_id) for viewer_id in viewer_ids)
+    if post_id is not None:
+        subjects.append(post_subject(post_id))
+    feed_cache.touch(*subjects)
+
+
+def invalidate_viewer(viewer_id):
+    """Tittarens flöde har ändrats, t.ex. efter följ/avfölj"""
+    feed_cache.touch(viewer_subject(viewer_id))
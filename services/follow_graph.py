@@ -0,0 +1,361 @@
+import os
+import threading
+import time
+
+import numpy as np
+from cachetools import LRUCache
+from sqlalchemy import select
+
+from models import db, Profile, followers
+from services.csr import Csr
+
+# Hur länge en uppbyggd graf används innan den läses om från databasen
+REBUILD_INTERVAL = int(os.getenv('FOLLOW_GRAPH_TTL', 300))
+
+# Följändringar delas mellan processer via en loggfil som alla läser ikapp;
+# tom sträng stänger av delningen (då syns andra processers ändringar först
+# efter omläsning)
+LOG_PATH = os.getenv(
+    'FOLLOW_GRAPH_LOG',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'follow_graph.log')
+)
+
+# Hur ofta loggfilen kontrolleras (os.stat) efter andra processers ändringar;
+# egna ändringar syns direkt
+LOG_CHECK_INTERVAL = float(os.getenv('FOLLOW_GRAPH_LOG_INTERVAL', 0.2))
+
+# Loggen börjar om när den blir så här stor; övriga processer läser då om grafen
+MAX_LOG_BYTES = 1 << 20
+
+# Antal användare vars följmängd hålls som set för uppslag i konstant tid
+FOLLOW_SET_CACHE = int(os.getenv('FOLLOW_SET_CACHE', 10000))
+
+# Bygg om grafen när så här många ändringar samlats i deltalagret
+MAX_DELTA = 10000
+
+# Vikt för gemensam favoritgenre jämfört med en gemensam kontakt
+GENRE_WEIGHT = 0.5
+
+# Antal förberäknade utfyllnadskandidater per genre och bland populära användare
+FILL_CANDIDATES = 200
+
+class _Snapshot:
+    """Oföränderlig ögonblicksbild av följgrafen.
+
+    edges är en CSR där rad u innehåller de (sorterade) id:n som u följer.
+    """
+
+    def __init__(self, follower_ids, followed_ids, genre_by_user):
+        keep = follower_ids != followed_ids
+        self.edges = Csr(follower_ids[keep], followed_ids[keep])
+
+        # De mest följda användarna, för "populära användare"
+        users, in_degree = np.unique(self.edges.indices, return_counts=True)
+        self.popular = users[np.argsort(-in_degree, kind='stable')][:FILL_CANDIDATES].tolist()
+
+        # Genre som heltalskod per användare (-1 = ingen genre)
+        self.genre_codes = {}
+        self.genre_user_ids = np.array(sorted(genre_by_user), dtype=np.int64)
+        self.genre_values = np.array([
+            self.genre_codes.setdefault(genre_by_user[user_id], len(self.genre_codes))
+            for user_id in self.genre_user_ids.tolist()
+        ], dtype=np.int64)
+        self.users_by_genre = {
+            code: self.genre_user_ids[self.genre_values == code][:FILL_CANDIDATES].tolist()
+            for code in self.genre_codes.values()
+        }
+
+    def following(self, user_id):
+        return self.edges.row(user_id)
+
+    def gather(self, user_ids):
+        """Alla utgående kanter från flera användare, i en vektoriserad operation"""
+        return self.edges.gather(user_ids)
+
+    def genres_of(self, user_ids):
+        if not len(self.genre_user_ids):
+            return np.full(len(user_ids), -1)
+        positions = np.minimum(np.searchsorted(self.genre_user_ids, user_ids), len(self.genre_user_ids) - 1)
+        found = self.genre_user_ids[positions] == user_ids
+        return np.where(found, self.genre_values[positions], -1)
+
+
+class _ChangeLog:
+    """Fil med en rad per följändring ("+ följare följd" eller "- ...").
+
+    Varje process lägger till sina ändringar efter commit och läser ikapp
+    andras innan grafen används. Börjar filen om (ny inod eller kortare än
+    där vi var) läses hela grafen om från databasen.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._inode = None
+        self._offset = 0
+        self._checked_at = 0.0
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None, 0
+        return stat.st_ino, stat.st_size
+
+    def mark(self):
+        """Börja läsa från filens nuvarande slut (anropas före en omläsning från databasen)"""
+        with self._lock:
+            self._inode, self._offset = self._stat()
+
+    def append(self, changes):
+        lines = ''.join(f"{'+' if added else '-'} {follower_id} {followed_id}\n"
+                        for follower_id, followed_id, added in changes)
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                # Ett write i append-läge, så att rader från olika processer inte blandas
+                with open(self.path, 'a') as file:
+                    file.write(lines)
+                inode, size = self._stat()
+                if size > MAX_LOG_BYTES:
+                    temporary = f'{self.path}.{os.getpid()}'
+                    open(temporary, 'w').close()
+                    os.replace(temporary, self.path)
+            except OSError as e:
+                print(f"Error: kunde inte skriva följloggen ({e})")
+
+    def read_new(self):
+        """Ändringar från andra processer sedan förra läsningen, eller None om grafen måste läsas om"""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._checked_at < LOG_CHECK_INTERVAL:
+                return []
+            self._checked_at = now
+            inode, size = self._stat()
+            if inode == self._inode and size == self._offset:
+                return []
+            if inode != self._inode or size < self._offset:
+                return None
+            try:
+                with open(self.path, 'rb') as file:
+                    file.seek(self._offset)
+                    data = file.read(size - self._offset)
+            except OSError:
+                return None
+            # En halvskriven sista rad läses nästa gång
+            end = data.rfind(b'\n') + 1
+            self._offset += end
+
+        changes = []
+        for line in data[:end].decode('ascii').splitlines():
+            op, follower_id, followed_id = line.split()
+            changes.append((int(follower_id), int(followed_id), op == '+'))
+        return changes
+
+
+class FollowGraph:
+    """Följgrafen i minnet, med inkrementella uppdateringar vid följ/avfölj"""
+
+    def __init__(self, log_path=LOG_PATH):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._built_at = 0.0
+        self._added = {}
+        self._removed = {}
+        self._genres = {}
+        self._delta_size = 0
+        self._sets = LRUCache(maxsize=FOLLOW_SET_CACHE)
+        self._log = _ChangeLog(log_path) if log_path else None
+
+    def _load(self):
+        rows = db.session.execute(select(followers.c.follower_id, followers.c.followed_id)).all()
+        edges = np.array(rows, dtype=np.int64).reshape(-1, 2)
+        genres = dict(db.session.execute(
+            select(Profile.user_id, Profile.favorite_genre).where(
+                Profile.favorite_genre.isnot(None), Profile.favorite_genre != ''
+            )
+        ).all())
+        return _Snapshot(edges[:, 0], edges[:, 1], genres)
+
+    def _sync(self):
+        """Läs ikapp följändringar från andra processer"""
+        if self._log is None or self._snapshot is None:
+            # Utan ögonblicksbild läses allt ändå från databasen
+            return
+        changes = self._log.read_new()
+        if changes is None:
+            self.invalidate()
+            return
+        for follower_id, followed_id, added in changes:
+            if added:
+                self.add_edge(follower_id, followed_id)
+            else:
+                self.remove_edge(follower_id, followed_id)
+
+    def snapshot(self):
+        """Aktuell ögonblicksbild; läser om grafen vid behov"""
+        self._sync()
+        with self._lock:
+            stale = (
+                self._snapshot is None
+                or time.monotonic() - self._built_at > REBUILD_INTERVAL
+                or self._delta_size > MAX_DELTA
+            )
+        if stale:
+            self.rebuild()
+        return self._snapshot
+
+    def rebuild(self):
+        # Ändringar som loggas under inläsningen spelas upp efteråt
+        if self._log is not None:
+            self._log.mark()
+        snapshot = self._load()
+        with self._lock:
+            self._snapshot = snapshot
+            self._built_at = time.monotonic()
+            self._added = {}
+            self._removed = {}
+            self._genres = {}
+            self._delta_size = 0
+            self._sets.clear()
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+            self._sets.clear()
+
+    def add_edge(self, follower_id, followed_id):
+        with self._lock:
+            self._removed.get(follower_id, set()).discard(followed_id)
+            self._added.setdefault(follower_id, set()).add(followed_id)
+            self._sets.pop(follower_id, None)
+            self._delta_size += 1
+
+    def remove_edge(self, follower_id, followed_id):
+        with self._lock:
+            self._added.get(follower_id, set()).discard(followed_id)
+            self._removed.setdefault(follower_id, set()).add(followed_id)
+            self._sets.pop(follower_id, None)
+            self._delta_size += 1
+
+    def record(self, changes):
+        """Sparade följändringar som (följare, följd, True om följ): uppdatera grafen och dela dem"""
+        for follower_id, followed_id, added in changes:
+            if added:
+                self.add_edge(follower_id, followed_id)
+            else:
+                self.remove_edge(follower_id, followed_id)
+        if self._log is not None and changes:
+            self._log.append(changes)
+
+    def set_genre(self, user_id, genre):
+        with self._lock:
+            self._genres[user_id] = genre or None
+            self._delta_size += 1
+
+    def _apply_delta(self, user_id, base):
+        added = self._added.get(user_id)
+        removed = self._removed.get(user_id)
+        if not added and not removed:
+            return base
+        result = set(base.tolist())
+        result.difference_update(removed or ())
+        result.update(added or ())
+        return np.array(sorted(result), dtype=np.int64)
+
+    def following(self, user_id):
+        """Sorterad array med id:n som användaren följer"""
+        snapshot = self.snapshot()
+        with self._lock:
+            return self._apply_delta(user_id, snapshot.following(user_id))
+
+    def following_ids(self, user_id):
+        """Id:n som användaren följer, som frozenset (hålls i en LRU-cache)"""
+        snapshot = self.snapshot()
+        with self._lock:
+            ids = self._sets.get(user_id)
+            if ids is None:
+                snapshot = self._snapshot or snapshot
+                ids = frozenset(self._apply_delta(user_id, snapshot.following(user_id)).tolist())
+                self._sets[user_id] = ids
+            return ids
+
+    def is_following(self, follower_id, followed_id):
+        return followed_id in self.following_ids(follower_id)
+
+    def followed_among(self, follower_id, user_ids):
+        """Vilka av användarna som följaren följer"""
+        return self.following_ids(follower_id).intersection(user_ids)
+
+    def _genre(self, snapshot, user_id):
+        if user_id in self._genres:
+            genre = self._genres[user_id]
+            return snapshot.genre_codes.get(genre, -2) if genre else -1
+        return int(snapshot.genres_of(np.array([user_id], dtype=np.int64))[0])
+
+    def suggest(self, user_id, limit=5):
+        """Föreslå användare att följa som (id, antal gemensamma, genrematch, skäl).
+
+        Kandidater två steg bort poängsätts efter hur många man följer som
+        följer dem, plus en bonus för samma favoritgenre. Räcker det inte fylls
+        listan på med användare med samma genre och sedan populära användare.
+        """
+        snapshot = self.snapshot()
+        with self._lock:
+            direct = self._apply_delta(user_id, snapshot.following(user_id))
+            touched = [v for v in direct.tolist() if v in self._added or v in self._removed]
+            second = snapshot.gather(direct)
+            if touched:
+                # Rader med osparade ändringar räknas om från deltalagret
+                untouched = np.setdiff1d(direct, np.array(touched, dtype=np.int64))
+                second = np.concatenate([snapshot.gather(untouched)] + [
+                    self._apply_delta(v, snapshot.following(v)) for v in touched
+                ])
+            own_genre = self._genre(snapshot, user_id)
+            genre_overrides = dict(self._genres)
+
+        excluded = np.append(direct, user_id)
+        candidates, shared = np.unique(second, return_counts=True)
+        keep = ~np.isin(candidates, excluded)
+        candidates, shared = candidates[keep], shared[keep]
+
+        genre_match = np.zeros(len(candidates), dtype=bool)
+        if own_genre >= 0 and len(candidates):
+            genre_match = snapshot.genres_of(candidates) == own_genre
+            for candidate, genre in genre_overrides.items():
+                i = np.searchsorted(candidates, candidate)
+                if i < len(candidates) and candidates[i] == candidate:
+                    genre_match[i] = snapshot.genre_codes.get(genre, -2) == own_genre
+
+        scores = shared + GENRE_WEIGHT * genre_match
+        if len(scores) > limit:
+            top = np.argpartition(-scores, limit)[:limit]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.lexsort((candidates[top], -scores[top]))]
+
+        suggestions = [
+            (int(candidates[i]), int(shared[i]), bool(genre_match[i]), 'friends')
+            for i in top
+        ]
+
+        # Fyll på med samma genre och sedan populära användare
+        seen = set(excluded.tolist()) | {s[0] for s in suggestions}
+        if len(suggestions) < limit and own_genre >= 0:
+            for candidate in snapshot.users_by_genre.get(own_genre, []):
+                if len(suggestions) >= limit:
+                    break
+                if candidate not in seen:
+                    seen.add(candidate)
+                    suggestions.append((candidate, 0, True, 'genre'))
+        for candidate in snapshot.popular:
+            if len(suggestions) >= limit:
+                break
+            if candidate not in seen:
+                seen.add(candidate)
+                suggestions.append((candidate, 0, False, 'popular'))
+
+        return suggestions
+
+
+follow_graph = FollowGraph()
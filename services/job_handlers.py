@@ -0,0 +1,89 @@
+import os
+from datetime import datetime
+
+from models import db, User, Profile
+from services import favorites
+from services import music_catalog
+from services import post_deletion
+from services import trending
+from services.jobs import jobs
+from services.taste import taste_index
+
+# Sidoarbete som rutterna lägger på jobbkön i stället för att göra i anropet
+
+
+# Profilkolumner som en uppladdning får peka om
+UPLOAD_COLUMNS = ('profile_picture', 'song_picture')
+
+
+@jobs.handler('save_upload')
+def save_upload(temporary, path, user_id, column):
+    """Flytta en uppladdad fil på plats och peka profilen på den först när filen finns"""
+    if os.path.exists(temporary):
+        os.replace(temporary, path)
+    elif not os.path.exists(path):
+        # Den temporära filen är borta; profilen behåller sin gamla bild
+        return
+    profile = Profile.query.filter_by(user_id=user_id).first()
+    if profile is not None:
+        setattr(profile, column, os.path.basename(path))
+        db.session.commit()
+
+
+def stage_upload(file, path):
+    """Strömma uppladdningen till en temporär fil bredvid målet; returnerar dess sökväg"""
+    temporary = f"{path}.part"
+    file.save(temporary)
+    return temporary
+
+
+def save_upload_later(temporary, path, user_id, column):
+    """Flytta en uppladdning från stage_upload på plats i bakgrunden.
+
+    Anropas efter anroparens commit: jobbet kan köras direkt i samma tråd
+    och skriver själv till profilen.
+    """
+    if column not in UPLOAD_COLUMNS:
+        raise ValueError(f"Okänd bildkolumn: {column}")
+    jobs.enqueue('save_upload', temporary=temporary, path=path, user_id=user_id, column=column)
+
+
+@jobs.handler('enrich_favorite_songs')
+def enrich_favorite_songs(user_id, pairs):
+    """Hämta favoritlåtar som saknades i katalogen från Spotify och lägg till dem"""
+    if db.session.get(User, user_id) is None:
+        return
+    songs = music_catalog.resolve_songs([tuple(pair) for pair in pairs])
+    db.session.flush()
+    favorites.add(user_id, 'song', [song.id for song in songs])
+    db.session.commit()
+    taste_index.refresh_user(user_id)
+
+
+def enrich_favorites_later(user_id, pairs):
+    jobs.enqueue('enrich_favorite_songs', user_id=user_id, pairs=[list(pair) for pair in pairs])
+
+
+@jobs.handler('purge_post')
+def purge_post(post_id):
+    """Rensa ett stort borttaget inlägg i omgångar"""
+    post_deletion.purge_post(post_id)
+
+
+def purge_post_later(post_id):
+    jobs.enqueue('purge_post', post_id=post_id)
+
+
+@jobs.handler('record_trending')
+def record_trending(item_type, item_id, weight, at):
+    trending.record(item_type, item_id, weight, datetime.fromisoformat(at))
+    db.session.commit()
+
+
+def record_like_later(post, like, removed=False):
+    """Trendpoängen för en gillning uppdateras utanför gillningens transaktion"""
+    item = trending.music_item(post)
+    if item:
+        weight = -trending.LIKE_WEIGHT if removed else trending.LIKE_WEIGHT
+        jobs.enqueue('record_trending', item_type=item[0], item_id=item[1],
+                     weight=weight, at=like.created_at.isoformat())
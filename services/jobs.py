@@ -0,0 +1,323 @@
+import json
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from contextlib import nullcontext
+
+# Jobbkö i processen för arbete som inte behöver göras innan svaret skickas.
+# Med en databasfil (JOBS_DB_PATH) sparas jobben också på disk och körs
+# vidare efter en omstart; tom sträng ger en ren minneskö.
+QUEUE_SIZE = int(os.getenv('JOBS_QUEUE_SIZE', 1000))
+WORKERS = int(os.getenv('JOBS_WORKERS', 4))
+MAX_ATTEMPTS = int(os.getenv('JOBS_MAX_ATTEMPTS', 5))
+RETRY_BASE = 1.0
+RETRY_MAX = 300.0
+
+DB_PATH = os.getenv(
+    'JOBS_DB_PATH',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'jobs.db')
+)
+
+# Ett jobb som "körs" längre än så här anses övergivet (t.ex. kraschad process)
+LEASE_SECONDS = 300
+
+# Hur ofta lediga arbetare letar efter jobb på disk (omförsök, överflöd, andra processer)
+POLL_INTERVAL = 2.0
+
+# Antal senaste jobb som latensmåtten räknas på
+LATENCY_SAMPLES = 1000
+
+
+class Job:
+    def __init__(self, name, payload, job_id=None, attempts=0, enqueued_at=None):
+        self.id = job_id
+        self.name = name
+        self.payload = payload
+        self.attempts = attempts
+        self.enqueued_at = enqueued_at or time.time()
+
+
+class _Store:
+    """Jobben på disk i SQLite, så att de överlever omstarter"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, payload TEXT NOT NULL, '
+                "status TEXT NOT NULL DEFAULT 'queued', attempts INTEGER NOT NULL DEFAULT 0, "
+                'run_after REAL NOT NULL, leased_until REAL, enqueued_at REAL NOT NULL, last_error TEXT)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_jobs_status_run_after ON jobs (status, run_after)')
+            self._local.connection = connection
+        return connection
+
+    def add(self, job):
+        cursor = self._connection().execute(
+            'INSERT INTO jobs (name, payload, run_after, enqueued_at) VALUES (?, ?, ?, ?)',
+            (job.name, json.dumps(job.payload), job.enqueued_at, job.enqueued_at)
+        )
+        job.id = cursor.lastrowid
+
+    def claim(self, job):
+        """Markera jobbet som pågående; False om en annan arbetare redan tagit det"""
+        now = time.time()
+        cursor = self._connection().execute(
+            "UPDATE jobs SET status = 'running', leased_until = ? "
+            "WHERE id = ? AND (status = 'queued' OR (status = 'running' AND leased_until < ?))",
+            (now + LEASE_SECONDS, job.id, now)
+        )
+        return cursor.rowcount == 1
+
+    def done(self, job):
+        self._connection().execute('DELETE FROM jobs WHERE id = ?', (job.id,))
+
+    def retry(self, job, run_after, error):
+        self._connection().execute(
+            "UPDATE jobs SET status = 'queued', attempts = ?, run_after = ?, last_error = ? WHERE id = ?",
+            (job.attempts, run_after, error, job.id)
+        )
+
+    def fail(self, job, error):
+        # Misslyckade jobb ligger kvar för felsökning
+        self._connection().execute(
+            "UPDATE jobs SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+            (job.attempts, error, job.id)
+        )
+
+    def due(self, limit):
+        """Köade jobb vars väntetid gått ut, och övergivna pågående jobb"""
+        now = time.time()
+        rows = self._connection().execute(
+            "SELECT id, name, payload, attempts, enqueued_at FROM jobs "
+            "WHERE (status = 'queued' AND run_after <= ?) OR (status = 'running' AND leased_until < ?) "
+            'ORDER BY run_after LIMIT ?',
+            (now, now, limit)
+        ).fetchall()
+        return [Job(name, json.loads(payload), job_id, attempts, enqueued_at)
+                for job_id, name, payload, attempts, enqueued_at in rows]
+
+    def counts(self):
+        return dict(self._connection().execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+
+class JobQueue:
+    """Begränsad jobbkö med en pool av arbetartrådar, omförsök och mätvärden.
+
+    Hanterare registreras med @jobs.handler('namn') och anropas med jobbets
+    payload som nyckelordsargument, inuti en applikationskontext. Payload
+    måste gå att spara som JSON.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.inline = False
+        self._handlers = {}
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._store = None
+        self._threads = []
+        self._started = False
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._metrics = Counter()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._durations = deque(maxlen=LATENCY_SAMPLES)
+
+    def init_app(self, app):
+        self.app = app
+        # I tester och med JOBS_INLINE=1 körs jobben direkt i anropet
+        self.inline = app.config.get('TESTING', False) or os.getenv('JOBS_INLINE') == '1'
+        if DB_PATH and not self.inline:
+            self._store = _Store(DB_PATH)
+            try:
+                # Jobb som blev kvar vid förra avslutet körs vidare direkt
+                if self._store.due(1):
+                    self._start()
+            except sqlite3.Error as e:
+                print(f"Error: jobbkön på disk är avstängd ({e})")
+                self._store = None
+        app.extensions['jobs'] = self
+
+    def handler(self, name):
+        def register(fn):
+            self._handlers[name] = fn
+            return fn
+        return register
+
+    def _start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for i in range(WORKERS):
+            thread = threading.Thread(target=self._work, name=f'jobs-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def enqueue(self, name, **payload):
+        """Lägg ett jobb på kön och returnera direkt.
+
+        Är kön full körs jobbet i stället direkt i anropet (mottryck), så att
+        inget arbete tappas.
+        """
+        if name not in self._handlers:
+            raise KeyError(f'Okänt jobb: {name}')
+        job = Job(name, payload)
+        self._metrics['enqueued'] += 1
+
+        if self.inline or self.app is None:
+            self._run(job)
+            return job
+
+        if self._store is not None:
+            self._store.add(job)
+        self._start()
+        try:
+            self._put(job)
+        except queue.Full:
+            self._metrics['ran_inline'] += 1
+            self._execute(job)
+        return job
+
+    def _put(self, job):
+        with self._lock:
+            if job.id is not None and job.id in self._pending:
+                return
+            self._queue.put_nowait(job)
+            if job.id is not None:
+                self._pending.add(job.id)
+
+    def _work(self):
+        while True:
+            try:
+                job = self._queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                self._refill()
+                continue
+            with self._lock:
+                self._pending.discard(job.id)
+            try:
+                self._execute(job)
+            finally:
+                self._queue.task_done()
+
+    def _refill(self):
+        """Hämta förfallna jobb från disk: omförsök, överflöd och jobb från före en omstart"""
+        if self._store is None:
+            return
+        free = self._queue.maxsize - self._queue.qsize()
+        if free <= 0:
+            return
+        try:
+            for job in self._store.due(free):
+                self._put(job)
+        except (sqlite3.Error, queue.Full):
+            pass
+
+    def _execute(self, job):
+        if self._store is not None:
+            try:
+                if not self._store.claim(job):
+                    return
+            except sqlite3.Error:
+                pass
+
+        error = self._run(job)
+        if self._store is None:
+            if error and job.attempts < MAX_ATTEMPTS:
+                timer = threading.Timer(self._retry_delay(job), self._retry_in_memory, [job])
+                timer.daemon = True
+                timer.start()
+            return
+
+        try:
+            if error is None:
+                self._store.done(job)
+            elif job.attempts < MAX_ATTEMPTS:
+                self._store.retry(job, time.time() + self._retry_delay(job), error)
+            else:
+                self._store.fail(job, error)
+        except sqlite3.Error:
+            pass
+
+    def _retry_in_memory(self, job):
+        try:
+            self._put(job)
+        except queue.Full:
+            self._execute(job)
+
+    def _retry_delay(self, job):
+        # Exponentiell backoff med jitter
+        return random.uniform(0.5, 1.0) * min(RETRY_MAX, RETRY_BASE * 2 ** (job.attempts - 1))
+
+    def _run(self, job):
+        """Kör hanteraren; returnerar felet som text, eller None om jobbet lyckades"""
+        job.attempts += 1
+        started = time.time()
+        error = None
+        with self.app.app_context() if self.app else nullcontext():
+            try:
+                self._handlers[job.name](**job.payload)
+            except Exception:
+                error = traceback.format_exc()
+                print(f"Error: jobbet {job.name} misslyckades (försök {job.attempts})\n{error}")
+                from models import db
+                db.session.rollback()
+
+        finished = time.time()
+        self._durations.append(finished - started)
+        if error is None:
+            self._latencies.append(finished - job.enqueued_at)
+            self._metrics['completed'] += 1
+            self._metrics[f'completed.{job.name}'] += 1
+        elif job.attempts < MAX_ATTEMPTS:
+            self._metrics['retried'] += 1
+        else:
+            self._metrics['failed'] += 1
+            self._metrics[f'failed.{job.name}'] += 1
+        return error
+
+    def metrics(self):
+        """Ködjup, räknare och latens (från köläggning till klart) för de senaste jobben"""
+        def summary(samples):
+            if not samples:
+                return None
+            ordered = sorted(samples)
+            return {
+                'avg_ms': round(sum(ordered) / len(ordered) * 1000, 1),
+                'p50_ms': round(ordered[len(ordered) // 2] * 1000, 1),
+                'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+                'max_ms': round(ordered[-1] * 1000, 1),
+            }
+
+        result = {
+            'queue_depth': self._queue.qsize(),
+            'queue_size': self._queue.maxsize,
+            'workers': len(self._threads),
+            'durable': self._store is not None,
+            'counters': dict(self._metrics),
+            'latency': summary(list(self._latencies)),
+            'run_time': summary(list(self._durations)),
+        }
+        if self._store is not None:
+            try:
+                result['stored'] = self._store.counts()
+            except sqlite3.Error:
+                pass
+        return result
+
+
+jobs = JobQueue()
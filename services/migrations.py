@@ -0,0 +1,291 @@
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: ingen fillåsning, processerna får inte starta samtidigt
+    fcntl = None
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, literal_column, select, text
+from sqlalchemy.exc import IntegrityError
+
+from models import (
+    db, User, Post, Like, Comment, Song, TimelineEntry,
+    followers, user_favorite_songs, user_favorite_albums, user_favorite_artists
+)
+
+# Versionerade schemaändringar för befintliga databaser. db.create_all()
+# skapar bara tabeller som saknas; kolumner, index och unika villkor i
+# befintliga tabeller läggs till här. Varje steg är idempotent, så att en
+# ny databas (där create_all redan skapat allt) bara får versionerna noterade.
+MIGRATIONS = []
+
+_version_table = Table(
+    'schema_version', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('name', String(100), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+def migration(version, name):
+    def register(fn):
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return register
+
+
+def applied_versions():
+    _version_table.create(db.engine, checkfirst=True)
+    rows = db.session.execute(select(_version_table.c.version, _version_table.c.applied_at)).all()
+    return dict(rows)
+
+
+# Godtycklig nyckel för PostgreSQL:s rådgivande lås kring schemaändringar
+_ADVISORY_LOCK_KEY = 727400119
+
+
+@contextmanager
+def schema_lock():
+    """Låt bara en process i taget skapa tabeller och köra migreringar.
+
+    Alla arbetsprocesser kör create_app samtidigt vid start. SQLite låses
+    med en låsfil bredvid databasfilen (låset på själva databasen kan inte
+    hållas över stegen, som använder flera anslutningar), PostgreSQL med
+    ett rådgivande lås. Minnesdatabaser och andra databaser låses inte.
+    """
+    url = db.engine.url
+    if url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:') and fcntl:
+        with open(f'{url.database}.migrate-lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    elif url.get_backend_name() == 'postgresql':
+        with db.engine.connect() as connection:
+            connection.execute(text('SELECT pg_advisory_lock(:key)'), {'key': _ADVISORY_LOCK_KEY})
+            connection.commit()
+            try:
+                yield
+            finally:
+                connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': _ADVISORY_LOCK_KEY})
+                connection.commit()
+    else:
+        yield
+
+
+def upgrade():
+    """Skapa tabeller som saknas och kör de migreringar som inte körts än, i versionsordning.
+
+    Körs under schema_lock(), och vilka steg som redan körts läses först
+    när låset är taget, så en process som väntat hoppar över stegen som
+    en annan hann köra. Versionsraden skrivs i samma transaktion som
+    stegets sista ändringar; steg som själva committar är idempotenta och
+    körs om ifall processen dör däremellan. Returnerar (version, namn) för
+    stegen som kördes.
+    """
+    with schema_lock():
+        db.create_all()
+        applied = applied_versions()
+        ran = []
+        for version, name, step in sorted(MIGRATIONS, key=lambda m: m[0]):
+            if version in applied:
+                continue
+            step()
+            try:
+                db.session.execute(_version_table.insert().values(
+                    version=version, name=name, applied_at=datetime.utcnow()
+                ))
+                db.session.commit()
+            except IntegrityError:
+                # En annan process utan lås (se schema_lock) körde samma steg
+                db.session.rollback()
+            ran.append((version, name))
+        return ran
+
+
+def status():
+    """(version, namn, körd när eller None) för alla migreringar"""
+    applied = applied_versions()
+    return [(version, name, applied.get(version)) for version, name, _ in sorted(MIGRATIONS, key=lambda m: m[0])]
+
+
+def _dedupe(table, columns):
+    """Ta bort dubbletter av kolumnkombinationen; returnerar antalet borttagna rader"""
+    cols = [table.c[name] for name in columns]
+    if 'id' in table.c:
+        # Den äldsta raden behålls
+        keep = select(func.min(table.c.id)).group_by(*cols).scalar_subquery()
+        return db.session.execute(table.delete().where(table.c.id.notin_(keep))).rowcount
+
+    if db.engine.dialect.name == 'sqlite':
+        # Relationstabeller utan id: raden med lägst rowid (den äldsta) behålls
+        rowid = literal_column('rowid')
+        keep = select(func.min(rowid)).select_from(table).group_by(*cols).scalar_subquery()
+        return db.session.execute(table.delete().where(rowid.notin_(keep))).rowcount
+
+    # Andra databaser: ersätt varje dubblettgrupp med en av dess rader, med
+    # övriga kolumner (t.ex. position) orörda
+    removed = 0
+    groups = db.session.execute(
+        select(*cols, func.count()).group_by(*cols).having(func.count() > 1)
+    ).all()
+    for *values, count in groups:
+        match = [col == value for col, value in zip(cols, values)]
+        kept = db.session.execute(select(table).where(*match).limit(1)).mappings().one()
+        db.session.execute(table.delete().where(*match))
+        db.session.execute(table.insert().values(dict(kept)))
+        removed += count - 1
+    return removed
+
+
+def _create_indexes():
+    """Skapa modellernas index som saknas.
+
+    Index på kolumner som en senare migrering lägger till hoppas över; de
+    skapas av den migreringen.
+    """
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            if {column.name for column in index.columns} <= existing:
+                index.create(db.engine, checkfirst=True)
+
+
+@migration(1, 'post counters')
+def _post_counters():
+    from services import post_counters
+    if post_counters.ensure_counter_columns():
+        post_counters.recount_all()
+
+
+@migration(2, 'catalog search keys')
+def _catalog_keys():
+    from services import music_catalog
+    music_catalog.ensure_catalog_keys()
+
+
+@migration(3, 'unique likes, follows and favorites, hot query indexes')
+def _constraints_and_indexes():
+    # Favoriterna numreras innan dubbletter tas bort eller katalogposter slås
+    # ihop (version 5), medan rowid fortfarande följer insättningsordningen
+    _number_favorites()
+
+    removed_likes = _dedupe(Like.__table__, ('user_id', 'post_id'))
+    _dedupe(followers, ('follower_id', 'followed_id'))
+    _dedupe(user_favorite_songs, ('user_id', 'song_id'))
+    _dedupe(user_favorite_albums, ('user_id', 'album_id'))
+    _dedupe(user_favorite_artists, ('user_id', 'artist_id'))
+    db.session.commit()
+
+    if removed_likes:
+        # Borttagningen gick förbi räknarhändelserna
+        from services import post_counters
+        post_counters.recount_all()
+
+    _create_indexes()
+
+
+@migration(4, 'timeline backfill')
+def _timeline_backfill():
+    has_entries = db.session.execute(select(TimelineEntry.id).limit(1)).first()
+    has_posts = db.session.execute(select(Post.id).limit(1)).first()
+    if has_posts and not has_entries:
+        from services import timeline
+        timeline.rebuild_all()
+
+
+@migration(5, 'spotify ids and merged catalog duplicates')
+def _spotify_ids():
+    from services import music_catalog
+    music_catalog.ensure_spotify_ids()
+    if music_catalog.merge_duplicates():
+        # Dubbletternas trendpoäng togs bort; räkna om från inläggen. compact
+        # hoppar över borttagna inlägg, så deleted_at (version 7) behövs redan här
+        from services import post_deletion, trending
+        post_deletion.ensure_tombstone_column()
+        trending.compact()
+    _create_indexes()
+
+
+def _number_favorites():
+    from services import favorites
+    added = favorites.ensure_position_columns()
+    if added:
+        favorites.number_positions(added)
+
+
+@migration(6, 'favorite positions')
+def _favorite_positions():
+    # Oftast redan gjort av version 3; kvar för databaser där den redan kördes
+    _number_favorites()
+    _create_indexes()
+
+
+@migration(7, 'post tombstones')
+def _post_tombstones():
+    from services import post_deletion
+    post_deletion.ensure_tombstone_column()
+
+
+@migration(8, 'username search keys')
+def _username_keys():
+    from services import user_search
+    user_search.ensure_username_keys()
+
+
+def _hot_queries():
+    """De vanligaste frågorna, i samma form som rutterna ställer dem"""
+    return {
+        'like for user and post': select(Like.id).where(Like.user_id == 1, Like.post_id == 1),
+        'likes on post': select(Like.user_id).where(Like.post_id == 1),
+        'purge batch of likes': select(Like.id).where(Like.post_id == 1).limit(2000),
+        'user posts, newest first': select(Post.id).where(Post.user_id == 1).order_by(
+            Post.created_at.desc(), Post.id.desc()).limit(20),
+        'all posts, newest first': select(Post.id).order_by(Post.created_at.desc()).limit(20),
+        'comments on post': select(Comment.id).where(Comment.post_id == 1).order_by(Comment.created_at),
+        'is following': select(followers.c.follower_id).where(
+            followers.c.follower_id == 1, followers.c.followed_id == 2),
+        'followers of user': select(followers.c.follower_id).where(followers.c.followed_id == 1),
+        'following of user': select(followers.c.followed_id).where(followers.c.follower_id == 1),
+        'fans of song': select(user_favorite_songs.c.user_id).where(user_favorite_songs.c.song_id == 1),
+        'fans of album': select(user_favorite_albums.c.user_id).where(user_favorite_albums.c.album_id == 1),
+        'fans of artist': select(user_favorite_artists.c.user_id).where(user_favorite_artists.c.artist_id == 1),
+        'favorite songs of user, in order': select(user_favorite_songs.c.song_id).where(
+            user_favorite_songs.c.user_id == 1).order_by(user_favorite_songs.c.position),
+        'song by title and artist': select(Song.id).where(Song.title_key == 'a', Song.artist_key == 'b'),
+        'users by username prefix': select(User.id).where(
+            User.username_key >= 'a', User.username_key < 'b'),
+        'song by spotify id': select(Song.id).where(Song.spotify_id == 'a'),
+        'home timeline': select(TimelineEntry.post_id).where(TimelineEntry.user_id == 1).order_by(
+            TimelineEntry.created_at.desc(), TimelineEntry.post_id.desc()).limit(20),
+    }
+
+
+def _uses_index(plan):
+    for detail in plan:
+        if detail.startswith('SCAN') and 'INDEX' not in detail:
+            return False
+        if 'TEMP B-TREE' in detail:
+            return False
+    return True
+
+
+def check_query_plans():
+    """EXPLAIN QUERY PLAN för de vanligaste frågorna (bara SQLite).
+
+    Returnerar (namn, planrader, ok) där ok betyder att frågan går via ett
+    index utan tabellskanning eller extra sortering.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return []
+    results = []
+    for name, statement in _hot_queries().items():
+        sql = str(statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+        plan = [row[-1] for row in db.session.execute(text(f'EXPLAIN QUERY PLAN {sql}')).all()]
+        results.append((name, plan, _uses_index(plan)))
+    return results
@@ -0,0 +1,552 @@
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import bindparam, case, delete, exists, func, inspect, or_, select, text, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import (
+    db, Song, Album, Artist, Post, TrendingScore, catalog_key, spotify_id_from_url,
+    user_favorite_songs, user_favorite_albums, user_favorite_artists
+)
+from services.spotify_api import SpotifySearch
+
+# Delad trådpool för Spotify-uppslag; begränsar antalet samtidiga anrop per process
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('SPOTIFY_WORKERS', 8)), thread_name_prefix='spotify'
+)
+
+_KEY_COLUMNS = {
+    'song': ('title_key', 'artist_key'),
+    'album': ('title_key', 'artist_key'),
+    'artist': ('name_key',),
+}
+
+_MODELS = {'track': Song, 'album': Album, 'artist': Artist}
+
+_FAVORITE_TABLES = {
+    'song': user_favorite_songs,
+    'album': user_favorite_albums,
+    'artist': user_favorite_artists,
+}
+
+# Rader per INSERT ... ON CONFLICT (håller antalet parametrar under SQLites gräns)
+UPSERT_BATCH = 500
+
+
+def submit(fn, *args):
+    """Kör ett anrop i den delade trådpoolen (Spotify och federerad sökning)"""
+    return _executor.submit(fn, *args)
+
+
+def _prefix(column, key):
+    """Prefixmatchning som intervall, så att indexet på nyckelkolumnen används"""
+    return column.between(key, key + '\U0010ffff')
+
+
+def search_local(query, search_type, limit=1):
+    """Låtar, album eller artister i katalogen som matchar söktermen som prefix.
+
+    Låtar och album matchar på titel eller artist, artister på namn. Exakta
+    träffar kommer först, sedan titelprefix, och kortare titlar före längre.
+    """
+    key = catalog_key(query)
+    if not key:
+        return []
+
+    if search_type == 'artist':
+        exact = case((Artist.name_key == key, 0), else_=1)
+        return Artist.query.filter(_prefix(Artist.name_key, key)).order_by(
+            exact, func.length(Artist.name_key), Artist.id
+        ).limit(limit).all()
+
+    model = Song if search_type == 'track' else Album
+    rank = case((model.title_key == key, 0), (_prefix(model.title_key, key), 1), else_=2)
+    return model.query.filter(
+        or_(_prefix(model.title_key, key), _prefix(model.artist_key, key))
+    ).order_by(rank, func.length(model.title_key), model.id).limit(limit).all()
+
+
+def to_result(item, search_type):
+    """Katalogpost i samma format som SpotifySearch returnerar"""
+    if search_type == 'track':
+        return {
+            "name": item.title,
+            "artist": item.artist,
+            "album": item.album or "",
+            "cover_url": item.cover_url,
+            "spotify_url": item.spotify_url or "",
+            "embed_link": item.embed_url or "",
+            "spotify_id": item.spotify_id
+        }
+    if search_type == 'album':
+        return {
+            "spotify_id": item.spotify_id,
+            "title": item.title,
+            "artist": item.artist,
+            "release_date": None,
+            "cover_url": item.cover_url,
+            "spotify_url": item.spotify_url
+        }
+    return {
+        "spotify_id": item.spotify_id,
+        "name": item.name,
+        "genres": [],
+        "cover_url": item.cover_url,
+        "spotify_url": item.spotify_url
+    }
+
+
+def _spotify_id(search_type, result):
+    return result.get("spotify_id") or spotify_id_from_url(
+        result.get("spotify_url") or result.get("embed_link"), search_type
+    )
+
+
+def find(search_type, result):
+    """Befintlig katalogpost för ett sökresultat, via Spotify-id:t eller de normaliserade nycklarna"""
+    model = _MODELS[search_type]
+    spotify_id = _spotify_id(search_type, result)
+    if spotify_id:
+        item = model.query.filter_by(spotify_id=spotify_id).first()
+        if item is not None:
+            return item
+
+    if search_type == 'track':
+        query = Song.query.filter_by(
+            title_key=catalog_key(result.get("name")), artist_key=catalog_key(result.get("artist"))
+        )
+    elif search_type == 'album':
+        query = Album.query.filter_by(
+            title_key=catalog_key(result.get("title")), artist_key=catalog_key(result.get("artist"))
+        )
+    else:
+        query = Artist.query.filter_by(name_key=catalog_key(result.get("name")))
+    if spotify_id:
+        # En post med ett annat Spotify-id är en annan inspelning eller utgåva
+        query = query.filter(model.spotify_id.is_(None))
+    return query.first()
+
+
+def save_result(search_type, result):
+    """Hämta eller lägg till katalogposten för ett Spotify-resultat (utan commit)"""
+    if _spotify_id(search_type, result):
+        return upsert(search_type, [result])[0]
+    item = find(search_type, result)
+    if item is None:
+        item = _new_item(search_type, result)
+    return item
+
+
+def _new_item(search_type, result):
+    if search_type == 'track':
+        item = Song(
+            title=result["name"],
+            artist=result["artist"],
+            album=result.get("album", ""),
+            cover_url=result.get("cover_url"),
+            spotify_url=result.get("spotify_url", ""),
+            embed_url=result.get("embed_link", "")
+        )
+    elif search_type == 'album':
+        item = Album(
+            title=result["title"],
+            artist=result["artist"],
+            cover_url=result.get("cover_url"),
+            spotify_url=result["spotify_url"]
+        )
+    else:
+        item = Artist(
+            name=result["name"],
+            cover_url=result.get("cover_url"),
+            spotify_url=result["spotify_url"]
+        )
+    db.session.add(item)
+    return item
+
+
+def _row(search_type, result):
+    """Tabellraden för ett Spotify-resultat; nycklarna räknas här eftersom ORM-händelserna inte körs"""
+    if search_type == 'artist':
+        return {
+            'name': result["name"],
+            'name_key': catalog_key(result["name"]),
+            'cover_url': result.get("cover_url"),
+            'spotify_url': result["spotify_url"],
+            'spotify_id': _spotify_id(search_type, result),
+        }
+    title = result["name"] if search_type == 'track' else result["title"]
+    row = {
+        'title': title,
+        'artist': result["artist"],
+        'title_key': catalog_key(title),
+        'artist_key': catalog_key(result["artist"]),
+        'cover_url': result.get("cover_url"),
+        'spotify_url': result.get("spotify_url", ""),
+        'spotify_id': _spotify_id(search_type, result),
+    }
+    if search_type == 'track':
+        row.update(album=result.get("album", ""), embed_url=result.get("embed_link", ""))
+    return row
+
+
+def _by_spotify_id(model, spotify_ids):
+    if not spotify_ids:
+        return {}
+    items = model.query.filter(model.spotify_id.in_(list(spotify_ids))).all()
+    return {item.spotify_id: item for item in items}
+
+
+def _claim_by_key(search_type, results):
+    """Äldre poster utan Spotify-id som matchar resultaten på nycklarna får id:t.
+
+    results är {spotify_id: resultat}; returnerar {spotify_id: post}.
+    """
+    model = _MODELS[search_type]
+    if search_type == 'artist':
+        keys = {catalog_key(result["name"]): spotify_id for spotify_id, result in results.items()}
+        candidates = Artist.query.filter(Artist.spotify_id.is_(None), Artist.name_key.in_(list(keys))).all()
+    else:
+        title_field = "name" if search_type == 'track' else "title"
+        keys = {
+            (catalog_key(result[title_field]), catalog_key(result["artist"])): spotify_id
+            for spotify_id, result in results.items()
+        }
+        candidates = model.query.filter(
+            model.spotify_id.is_(None), tuple_(model.title_key, model.artist_key).in_(list(keys))
+        ).all()
+
+    claimed = {}
+    for item in candidates:
+        key = item.name_key if search_type == 'artist' else (item.title_key, item.artist_key)
+        spotify_id = keys.get(key)
+        if spotify_id and spotify_id not in claimed:
+            item.spotify_id = spotify_id
+            claimed[spotify_id] = item
+    return claimed
+
+
+def _insert_ignoring_conflicts(model, rows):
+    """INSERT ... ON CONFLICT (spotify_id) DO NOTHING, en sats per batch; False om dialekten saknar stöd"""
+    dialect = db.session.get_bind(mapper=model).dialect.name
+    if dialect == 'sqlite':
+        insert = sqlite.insert
+    elif dialect == 'postgresql':
+        insert = postgresql.insert
+    else:
+        return False
+    for start in range(0, len(rows), UPSERT_BATCH):
+        statement = insert(model.__table__).values(rows[start:start + UPSERT_BATCH])
+        db.session.execute(statement.on_conflict_do_nothing(index_elements=['spotify_id']))
+    return True
+
+
+def upsert(search_type, results):
+    """Katalogposterna för en lista Spotify-resultat, i samma ordning (utan commit).
+
+    Poster hittas via Spotify-id:t, och äldre poster utan id via nycklarna.
+    Resten läggs till i en sats per batch med ON CONFLICT DO NOTHING, så att
+    samtidiga anrop inte kan skapa dubbletter.
+    """
+    model = _MODELS[search_type]
+    spotify_ids = [_spotify_id(search_type, result) for result in results]
+    found = _by_spotify_id(model, {spotify_id for spotify_id in spotify_ids if spotify_id})
+
+    missing = {
+        spotify_id: result
+        for spotify_id, result in zip(spotify_ids, results)
+        if spotify_id and spotify_id not in found
+    }
+    if missing:
+        found.update(_claim_by_key(search_type, missing))
+        new = {spotify_id: result for spotify_id, result in missing.items() if spotify_id not in found}
+        if new:
+            if _insert_ignoring_conflicts(model, [_row(search_type, result) for result in new.values()]):
+                found.update(_by_spotify_id(model, set(new)))
+            else:
+                for spotify_id, result in new.items():
+                    found[spotify_id] = _new_item(search_type, result)
+
+    items = []
+    for spotify_id, result in zip(spotify_ids, results):
+        if spotify_id:
+            items.append(found[spotify_id])
+        else:
+            items.append(find(search_type, result) or _new_item(search_type, result))
+    return items
+
+
+def fetch_from_spotify(query, search_type):
+    spotify_search = SpotifySearch(query)
+    if search_type == 'track':
+        return spotify_search.get_track()
+    if search_type == 'album':
+        return spotify_search.get_album()
+    return spotify_search.get_artist()
+
+
+def search(query, search_type):
+    """Sök i katalogen först och fråga Spotify bara vid miss.
+
+    Träffar från Spotify skrivs tillbaka till katalogen; anroparen sparar
+    dem med commit.
+    """
+    local = search_local(query, search_type)
+    if local:
+        return to_result(local[0], search_type)
+
+    result = fetch_from_spotify(query, search_type)
+    if result:
+        save_result(search_type, result)
+    return result
+
+
+def favorite_item(item_type, item_data):
+    """Katalogposten för en favorit som lagts till från klienten (utan commit).
+
+    Befintliga poster hittas via nycklarna. Saknas posten och klienten inte
+    skickat någon Spotify-länk kompletteras den från Spotify.
+    """
+    search_type = 'track' if item_type == 'song' else item_type
+    if item_type == 'artist':
+        result = {"name": item_data.get('name'), "cover_url": item_data.get('cover_url'),
+                  "spotify_url": item_data.get('spotify_url')}
+        query = result["name"]
+    else:
+        result = {"title": item_data.get('title'), "artist": item_data.get('artist'),
+                  "cover_url": item_data.get('cover_url'), "spotify_url": item_data.get('spotify_url')}
+        query = f"{result['title']} {result['artist']}"
+        if item_type == 'song':
+            result.update(name=result.pop("title"), album=item_data.get('album', ''),
+                          embed_link=item_data.get('embed_url'))
+
+    item = find(search_type, result)
+    if item is not None:
+        return item
+
+    if not result["spotify_url"]:
+        fetched = fetch_from_spotify(query, search_type)
+        if fetched:
+            return save_result(search_type, fetched)
+        if item_type != 'song':
+            # Album och artister kräver en Spotify-länk
+            return None
+    if _spotify_id(search_type, result):
+        return upsert(search_type, [result])[0]
+    return _new_item(search_type, result)
+
+
+def _songs_by_key(pairs):
+    """Befintliga låtar för (titel, artist)-par, i en fråga via de normaliserade nycklarna"""
+    keys = {(catalog_key(title), catalog_key(artist)) for title, artist in pairs}
+    if not keys:
+        return {}
+    songs = Song.query.filter(tuple_(Song.title_key, Song.artist_key).in_(list(keys))).all()
+    found = {}
+    for song in songs:
+        found.setdefault((song.title_key, song.artist_key), song)
+    return {
+        pair: found[(catalog_key(pair[0]), catalog_key(pair[1]))]
+        for pair in pairs
+        if (catalog_key(pair[0]), catalog_key(pair[1])) in found
+    }
+
+
+def resolve_local_songs(pairs):
+    """Låtarna för de par som redan finns i katalogen (i en fråga), och paren som saknas"""
+    pairs = list(dict.fromkeys(pairs))
+    local = _songs_by_key(pairs)
+    songs = []
+    for pair in pairs:
+        song = local.get(pair)
+        if song is not None and song not in songs:
+            songs.append(song)
+    return songs, [pair for pair in pairs if pair not in local]
+
+
+def _fetch_track(pair):
+    title, artist = pair
+    return SpotifySearch(f"{title} {artist}").get_track()
+
+
+def resolve_songs(pairs):
+    """Låtar för en lista (titel, artist)-par, i samma ordning.
+
+    Alla par slås upp lokalt i en fråga. De som saknas hämtas från Spotify
+    parallellt, och nya låtar läggs till i sessionen utan commit så att
+    anroparen sparar allt i en transaktion. Par som inte hittas hoppas över.
+    """
+    pairs = list(dict.fromkeys(pairs))
+    local = _songs_by_key(pairs)
+
+    misses = [pair for pair in pairs if pair not in local]
+    fetched = dict(zip(misses, _executor.map(_fetch_track, misses))) if misses else {}
+
+    # Alla träffar sparas i en sats; Spotify kan returnera en låt som redan finns lokalt
+    results = [data for data in fetched.values() if data]
+    saved = dict(zip(map(id, results), upsert('track', results)))
+
+    songs = []
+    for pair in pairs:
+        song = local.get(pair)
+        if song is None and fetched.get(pair):
+            song = saved[id(fetched[pair])]
+        if song is not None and song not in songs:
+            songs.append(song)
+    return songs
+
+
+def _keys(model, row):
+    if model is Artist:
+        return {'name_key': catalog_key(row.name)}
+    return {'title_key': catalog_key(row.title), 'artist_key': catalog_key(row.artist)}
+
+
+def ensure_catalog_keys():
+    """Lägg till och fyll söknycklarna i en befintlig katalog.
+
+    db.create_all() lägger inte till kolumner i befintliga tabeller, och
+    nycklarna för gamla rader måste räknas fram i Python (accentborttagning).
+    """
+    added = []
+    for model in (Song, Album, Artist):
+        table = model.__table__
+        existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+        for column in _KEY_COLUMNS[table.name]:
+            if column not in existing:
+                db.session.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column} VARCHAR(200)'))
+                added.append(f'{table.name}.{column}')
+        db.session.commit()
+        for index in table.indexes:
+            if {column.name for column in index.columns} <= set(_KEY_COLUMNS[table.name]):
+                index.create(db.engine, checkfirst=True)
+
+    updated = 0
+    for model in (Song, Album, Artist):
+        table = model.__table__
+        columns = [table.c.id] + [table.c[name] for name in ('name', 'title', 'artist') if name in table.c]
+        key_columns = _KEY_COLUMNS[table.name]
+        rows = db.session.execute(
+            select(*columns, *[table.c[name] for name in key_columns])
+        ).all()
+        changes = []
+        for row in rows:
+            keys = _keys(model, row)
+            if any(getattr(row, name) != value for name, value in keys.items()):
+                changes.append({'row_id': row.id, **{f'new_{name}': value for name, value in keys.items()}})
+        if changes:
+            db.session.execute(
+                table.update().where(table.c.id == bindparam('row_id')).values(
+                    {name: bindparam(f'new_{name}') for name in key_columns}
+                ),
+                changes
+            )
+            updated += len(changes)
+    db.session.commit()
+    return added, updated
+
+
+def ensure_spotify_ids():
+    """Lägg till spotify_id i en befintlig katalog och fyll det från Spotify-länkarna"""
+    added = []
+    updated = 0
+    for model in (Song, Album, Artist):
+        table = model.__table__
+        existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+        if 'spotify_id' not in existing:
+            db.session.execute(text(f'ALTER TABLE {table.name} ADD COLUMN spotify_id VARCHAR(64)'))
+            added.append(f'{table.name}.spotify_id')
+        db.session.commit()
+
+        kind = 'track' if model is Song else table.name
+        url_columns = [table.c.spotify_url] + ([table.c.embed_url] if 'embed_url' in table.c else [])
+        rows = db.session.execute(
+            select(table.c.id, *url_columns).where(table.c.spotify_id.is_(None))
+        ).all()
+        changes = []
+        for row in rows:
+            spotify_id = spotify_id_from_url(row[1] or (row[2] if len(row) > 2 else None), kind)
+            if spotify_id:
+                changes.append({'row_id': row.id, 'new_spotify_id': spotify_id})
+        if changes:
+            db.session.execute(
+                table.update().where(table.c.id == bindparam('row_id')).values(spotify_id=bindparam('new_spotify_id')),
+                changes
+            )
+            updated += len(changes)
+    db.session.commit()
+    return added, updated
+
+
+def _repoint(name, merged):
+    """Flytta inlägg och favoriter från dubbletterna till posterna som behålls och ta bort dubbletterna"""
+    table = _MODELS['track' if name == 'song' else name].__table__
+    post_column = Post.__table__.c[f'{name}_id']
+    db.session.execute(
+        Post.__table__.update().where(post_column == bindparam('old_id')).values({post_column.name: bindparam('new_id')}),
+        [{'old_id': old_id, 'new_id': new_id} for old_id, new_id in merged.items()]
+    )
+
+    # Favoriterna flyttas på plats så att användarens ordning behålls; har
+    # användaren redan posten som behålls tas dubbletten bort nedan
+    favorites = _FAVORITE_TABLES[name]
+    item_column = favorites.c[f'{name}_id']
+    taken = favorites.alias('taken')
+    db.session.execute(
+        favorites.update().where(
+            item_column == bindparam('old_id'),
+            ~exists().where(taken.c.user_id == favorites.c.user_id, taken.c[item_column.name] == bindparam('new_id'))
+        ).values({item_column.name: bindparam('new_id')}),
+        [{'old_id': old_id, 'new_id': new_id} for old_id, new_id in merged.items()]
+    )
+    db.session.execute(favorites.delete().where(item_column.in_(list(merged))))
+
+    # Trendpoängen för dubbletterna räknas om av anroparen
+    db.session.execute(delete(TrendingScore).where(
+        TrendingScore.item_type == name, TrendingScore.item_id.in_(list(merged))
+    ))
+    db.session.execute(table.delete().where(table.c.id.in_(list(merged))))
+
+
+def merge_duplicates():
+    """Slå ihop dubbletter i katalogen och returnera antalet borttagna poster.
+
+    Poster med samma Spotify-id slås ihop, liksom poster med samma nycklar
+    så länge högst en av dem har ett Spotify-id. Den äldsta posten (eller
+    den med Spotify-id) behålls och får dubbletternas inlägg och favoriter.
+    """
+    removed = 0
+    for model in (Song, Album, Artist):
+        table = model.__table__
+        key_columns = [table.c[name] for name in _KEY_COLUMNS[table.name]]
+        rows = db.session.execute(
+            select(table.c.id, table.c.spotify_id, *key_columns).order_by(table.c.id)
+        ).all()
+
+        merged = {}
+        kept_by_spotify_id = {}
+        for row in rows:
+            if row.spotify_id:
+                kept = kept_by_spotify_id.setdefault(row.spotify_id, row.id)
+                if kept != row.id:
+                    merged[row.id] = kept
+
+        groups = defaultdict(list)
+        for row in rows:
+            key = tuple(row[2:])
+            if row.id not in merged and None not in key:
+                groups[key].append(row)
+        for group in groups.values():
+            spotify_ids = {row.spotify_id for row in group if row.spotify_id}
+            if len(group) < 2 or len(spotify_ids) > 1:
+                continue
+            kept = next((row.id for row in group if row.spotify_id), group[0].id)
+            for row in group:
+                if row.id != kept:
+                    merged[row.id] = kept
+
+        if merged:
+            _repoint(table.name, merged)
+            removed += len(merged)
+    db.session.commit()
+    return removed
@@ -0,0 +1,101 @@
+import base64
+import json
+from datetime import datetime
+
+from flask import request
+from sqlalchemy import and_, or_
+
+# Samma övre gräns för sidstorlek som Flask-SQLAlchemys paginate()
+MAX_PER_PAGE = 100
+
+# Markör för datum i cursor-värden så att de kan återskapas vid avkodning
+_DATETIME_TAG = "$dt"
+
+
+class InvalidCursor(ValueError):
+    """Cursor-parametern kunde inte avkodas"""
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {_DATETIME_TAG: value.isoformat()}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict) and _DATETIME_TAG in value:
+        return datetime.fromisoformat(value[_DATETIME_TAG])
+    return value
+
+
+def encode_cursor(values):
+    """Koda nyckelvärdena för sista raden på en sida till en opak sträng"""
+    payload = json.dumps([_encode_value(value) for value in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    """Avkoda en cursor till nyckelvärden. En tom cursor betyder första sidan."""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+    # Formen kontrolleras före avkodningen; t.ex. ett objekt skulle annars itereras som nycklar
+    if not isinstance(values, list) or len(values) != size:
+        raise InvalidCursor(cursor)
+    try:
+        return [_decode_value(value) for value in values]
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+
+
+def after_filter(keys, values, descending):
+    """Bygg ett villkor för rader som kommer efter (keys) == (values) i sorteringen.
+
+    Villkoret skrivs ut som (a < x) OR (a = x AND b < y) så att det kan använda
+    ett sammansatt index på alla databaser.
+    """
+    clauses = []
+    for i, (key, value) in enumerate(zip(keys, values)):
+        beyond = key < value if descending else key > value
+        equal_prefix = [k == v for k, v in zip(keys[:i], values[:i])]
+        clauses.append(and_(*equal_prefix, beyond))
+    return or_(*clauses)
+
+
+def clamp_per_page(per_page):
+    return max(1, min(per_page, MAX_PER_PAGE))
+
+
+class KeysetPage:
+    """En sida hämtad med keyset-paginering"""
+
+    def __init__(self, items, per_page, key_func, total=None):
+        self.has_next = len(items) > per_page
+        self.items = items[:per_page]
+        self.per_page = per_page
+        self.total = total
+        self.next_cursor = encode_cursor(key_func(self.items[-1])) if self.has_next else None
+
+
+def keyset_paginate(query, keys, cursor, per_page, descending=False, key_func=None, count=False):
+    """Hämta en sida efter cursorn sorterad på keys utan OFFSET och COUNT(*)"""
+    values = decode_cursor(cursor, len(keys))
+    per_page = clamp_per_page(per_page)
+
+    total = query.order_by(None).count() if count else None
+
+    if values is not None:
+        query = query.filter(after_filter(keys, values, descending))
+    order = [key.desc() if descending else key.asc() for key in keys]
+    items = query.order_by(*order).limit(per_page + 1).all()
+
+    return KeysetPage(items, per_page, key_func, total=total)
+
+
+def wants_total():
+    """Om klienten uttryckligen bett om totalt antal träffar"""
+    return request.args.get('include_total', '').lower() in ('1', 'true', 'yes')
@@ -0,0 +1,33 @@
+from sqlalchemy import func, inspect, select, text
+
+from models import db, Post, Like, Comment
+
+COUNTER_COLUMNS = ('like_count', 'comment_count')
+
+
+def ensure_counter_columns():
+    """Lägg till räknarkolumnerna i en befintlig post-tabell om de saknas.
+
+    db.create_all() skapar bara nya tabeller, så databaser från före
+    räknarna behöver kolumnerna tillagda i efterhand.
+    """
+    existing = {column['name'] for column in inspect(db.engine).get_columns('post')}
+    added = []
+    for column in COUNTER_COLUMNS:
+        if column not in existing:
+            db.session.execute(text(f'ALTER TABLE post ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0'))
+            added.append(column)
+    db.session.commit()
+    return added
+
+
+def recount_all():
+    """Räkna om like_count och comment_count för alla inlägg med en UPDATE"""
+    like_total = select(func.count(Like.id)).where(Like.post_id == Post.id).scalar_subquery()
+    comment_total = select(func.count(Comment.id)).where(Comment.post_id == Post.id).scalar_subquery()
+
+    result = db.session.execute(
+        Post.__table__.update().values(like_count=like_total, comment_count=comment_total)
+    )
+    db.session.commit()
+    return result.rowcount
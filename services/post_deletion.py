@@ -0,0 +1,150 @@
+import os
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import bindparam, delete, inspect, or_, select, text, update
+
+from models import (
+    db, User, Profile, Post, Like, Comment, TimelineEntry,
+    followers, user_favorite_songs, user_favorite_albums, user_favorite_artists
+)
+
+# Inlägg med högst så många gillningar och kommentarer tas bort direkt i
+# anropet; större inlägg markeras som borttagna och rensas i bakgrunden
+INLINE_LIMIT = int(os.getenv('POST_DELETE_INLINE_LIMIT', 1000))
+
+# Rader per DELETE (och transaktion) vid rensning i bakgrunden
+PURGE_BATCH = int(os.getenv('POST_PURGE_BATCH', 2000))
+
+# Borttagningarna går förbi sessionen; inga objekt behöver synkas
+_BULK = {'synchronize_session': False}
+
+
+def delete_post(post):
+    """Ta bort ett inlägg utan att läsa in dess gillningar och kommentarer (utan commit).
+
+    Små inlägg tas bort direkt med en DELETE per tabell. Större inlägg får
+    deleted_at satt, syns inte längre och rensas av purge_post i bakgrunden.
+    Räknarna på inlägget avgör vilket, utan någon COUNT-fråga. Returnerar
+    True om inlägget behöver rensas.
+    """
+    if post.like_count + post.comment_count > INLINE_LIMIT:
+        post.deleted_at = datetime.utcnow()
+        return True
+    db.session.execute(delete(Like).where(Like.post_id == post.id).execution_options(**_BULK))
+    db.session.execute(delete(Comment).where(Comment.post_id == post.id).execution_options(**_BULK))
+    db.session.delete(post)
+    return False
+
+
+def _purge_rows(model, criterion, batch):
+    """Ta bort rader i omgångar om batch, med en commit per omgång"""
+    removed = 0
+    while True:
+        chunk = select(model.id).where(criterion).limit(batch)
+        count = db.session.execute(
+            delete(model).where(model.id.in_(chunk)).execution_options(**_BULK)
+        ).rowcount
+        db.session.commit()
+        removed += count
+        if count < batch:
+            return removed
+
+
+def purge_post(post_id, batch=PURGE_BATCH):
+    """Rensa ett borttaget inläggs gillningar och kommentarer och ta sedan bort inlägget.
+
+    Varje omgång är en egen kort transaktion, så minnet är konstant och
+    skrivlåset släpps mellan omgångarna även för inlägg med 100 000 gillningar.
+    Inlägg som inte är markerade som borttagna lämnas orörda. Returnerar
+    antalet borttagna gillningar och kommentarer.
+    """
+    tombstoned = db.session.execute(
+        select(Post.id).where(Post.id == post_id, Post.deleted_at.isnot(None))
+    ).first()
+    if tombstoned is None:
+        return 0
+    removed = _purge_rows(Like, Like.post_id == post_id, batch)
+    removed += _purge_rows(Comment, Comment.post_id == post_id, batch)
+    db.session.execute(delete(TimelineEntry).where(TimelineEntry.post_id == post_id).execution_options(**_BULK))
+    db.session.execute(delete(Post).where(Post.id == post_id).execution_options(**_BULK))
+    db.session.commit()
+    return removed
+
+
+def pending_purges():
+    """Id:n för borttagna inlägg som ännu inte rensats"""
+    return db.session.execute(select(Post.id).where(Post.deleted_at.isnot(None))).scalars().all()
+
+
+def _purge_authored(model, counter, user_id, batch):
+    """Ta bort en användares gillningar eller kommentarer och räkna ned inläggens räknare"""
+    column = Post.__table__.c[counter]
+    removed = 0
+    while True:
+        rows = db.session.execute(
+            select(model.id, model.post_id).where(model.user_id == user_id).limit(batch)
+        ).all()
+        if not rows:
+            return removed
+        per_post = Counter(post_id for _, post_id in rows)
+        db.session.execute(
+            Post.__table__.update().where(Post.__table__.c.id == bindparam('row_id')).values(
+                {counter: column - bindparam('delta')}
+            ),
+            [{'row_id': post_id, 'delta': count} for post_id, count in per_post.items()]
+        )
+        db.session.execute(
+            delete(model).where(model.id.in_([row_id for row_id, _ in rows])).execution_options(**_BULK)
+        )
+        db.session.commit()
+        removed += len(rows)
+
+
+def delete_user(user_id, batch=PURGE_BATCH):
+    """Ta bort ett konto med inlägg, gillningar, kommentarer, följningar och favoriter.
+
+    Inläggen döljs först i en transaktion och rensas sedan som borttagna
+    inlägg; gillningar och kommentarer på andras inlägg tas bort i omgångar
+    med räknarna nedräknade. Inget läses in i sessionen. Returnerar de
+    borttagna följrelationerna som (följare, följd) så att anroparen kan
+    uppdatera följgrafen.
+    """
+    db.session.execute(
+        update(Post).where(Post.user_id == user_id, Post.deleted_at.is_(None))
+        .values(deleted_at=datetime.utcnow()).execution_options(**_BULK)
+    )
+    db.session.execute(delete(TimelineEntry).where(
+        or_(TimelineEntry.user_id == user_id, TimelineEntry.author_id == user_id)
+    ).execution_options(**_BULK))
+    db.session.commit()
+
+    _purge_authored(Like, 'like_count', user_id, batch)
+    _purge_authored(Comment, 'comment_count', user_id, batch)
+    for post_id in db.session.execute(select(Post.id).where(Post.user_id == user_id)).scalars().all():
+        purge_post(post_id, batch)
+
+    edges = db.session.execute(
+        select(followers.c.follower_id, followers.c.followed_id).where(
+            or_(followers.c.follower_id == user_id, followers.c.followed_id == user_id)
+        )
+    ).all()
+    db.session.execute(followers.delete().where(
+        or_(followers.c.follower_id == user_id, followers.c.followed_id == user_id)
+    ))
+    for table in (user_favorite_songs, user_favorite_albums, user_favorite_artists):
+        db.session.execute(table.delete().where(table.c.user_id == user_id))
+    db.session.execute(delete(Profile).where(Profile.user_id == user_id).execution_options(**_BULK))
+    db.session.execute(delete(User).where(User.id == user_id).execution_options(**_BULK))
+    db.session.commit()
+    return [tuple(edge) for edge in edges]
+
+
+def ensure_tombstone_column():
+    """Lägg till deleted_at i en befintlig post-tabell; True om kolumnen lades till"""
+    existing = {column['name'] for column in inspect(db.engine).get_columns('post')}
+    if 'deleted_at' in existing:
+        return False
+    db.session.execute(text('ALTER TABLE post ADD COLUMN deleted_at DATETIME'))
+    db.session.commit()
+    return True
@@ -0,0 +1,115 @@
+from models import db, User, Profile, Like, Song, Album, Artist
+
+
+def _author_map(user_ids):
+    """Hämta författare och profilbilder för en mängd användare i en fråga"""
+    authors = {}
+    rows = db.session.query(
+        User.id, User.username, Profile.id, Profile.profile_picture
+    ).outerjoin(Profile, Profile.user_id == User.id).filter(User.id.in_(user_ids)).all()
+
+    for user_id, username, profile_id, profile_picture in rows:
+        # En användare ska bara ha en profil, men behåll den första om det finns flera
+        if user_id in authors:
+            continue
+        authors[user_id] = {
+            "id": user_id,
+            "username": username,
+            "profile_picture": profile_picture if profile_id is not None else "default.jpg"
+        }
+
+    return authors
+
+
+def _liked_set(viewer_id, post_ids):
+    """Hämta vilka av inläggen som tittaren har gillat"""
+    if viewer_id is None:
+        return set()
+    rows = db.session.query(Like.post_id).filter(
+        Like.user_id == viewer_id, Like.post_id.in_(post_ids)
+    ).all()
+    return {post_id for (post_id,) in rows}
+
+
+def _music_map(model, ids):
+    """Hämta låtar, album eller artister för en mängd id:n i en fråga"""
+    if not ids:
+        return {}
+    return {item.id: item for item in model.query.filter(model.id.in_(ids)).all()}
+
+
+def serialize_song(song):
+    return {
+        "id": song.id,
+        "title": song.title,
+        "artist": song.artist,
+        "cover_url": song.cover_url,
+        "spotify_url": song.spotify_url,
+        "embed_url": song.embed_url
+    }
+
+
+def serialize_album(album):
+    return {
+        "id": album.id,
+        "title": album.title,
+        "artist": album.artist,
+        "cover_url": album.cover_url,
+        "spotify_url": album.spotify_url
+    }
+
+
+def serialize_artist(artist):
+    return {
+        "id": artist.id,
+        "name": artist.name,
+        "cover_url": artist.cover_url,
+        "spotify_url": artist.spotify_url
+    }
+
+
+def hydrate_posts(posts, viewer_id=None):
+    """Bygg API-data för en sida inlägg.
+
+    Istället för flera frågor per inlägg hämtas författare, profiler, tittarens
+    gillningar och kopplad musik med ett fast antal mängdbaserade frågor för
+    hela sidan. Antal gillningar/kommentarer läses från inläggets räknare.
+    """
+    if not posts:
+        return []
+
+    post_ids = [post.id for post in posts]
+
+    authors = _author_map({post.user_id for post in posts})
+    liked = _liked_set(viewer_id, post_ids)
+
+    songs = _music_map(Song, {post.song_id for post in posts if post.song_id})
+    albums = _music_map(Album, {post.album_id for post in posts if post.album_id})
+    artists = _music_map(Artist, {post.artist_id for post in posts if post.artist_id})
+
+    posts_data = []
+    for post in posts:
+        # Grundläggande inläggsdata
+        post_data = {
+            "id": post.id,
+            "content": post.content,
+            "created_at": post.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "user": dict(authors[post.user_id]),
+            "likes_count": post.like_count,
+            "comments_count": post.comment_count,
+            "liked_by_user": post.id in liked
+        }
+
+        # Lägg till relaterad musikdata om det finns
+        if post.song_id and post.song_id in songs:
+            post_data["song"] = serialize_song(songs[post.song_id])
+
+        if post.album_id and post.album_id in albums:
+            post_data["album"] = serialize_album(albums[post.album_id])
+
+        if post.artist_id and post.artist_id in artists:
+            post_data["artist"] = serialize_artist(artists[post.artist_id])
+
+        posts_data.append(post_data)
+
+    return posts_data
@@ -1,120 +1,412 @@
 import os
 import base64
+import sqlite3
+import threading
+import time
 import requests
 import json
+from cachetools import TLRUCache
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+from services.spotify_scheduler import scheduler, SpotifyUnavailable
 
 load_dotenv()
 
+# Token förnyas i förväg när så här många sekunder återstår av livslängden;
+# under den sista minuten måste alla vänta på en ny token
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_EXPIRY_MARGIN = 60
+
+# Kan pekas om, t.ex. mot den lokala attrappen i benchmarks/fake_spotify.py
+ACCOUNTS_URL = os.getenv("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com").rstrip("/")
+API_URL = os.getenv("SPOTIFY_API_URL", "https://api.spotify.com").rstrip("/")
+
+# Anslutningspool som delas av alla trådar i processen
+POOL_SIZE = int(os.getenv("SPOTIFY_POOL_SIZE", 10))
+TIMEOUT = float(os.getenv("SPOTIFY_TIMEOUT", 5))
+
+# Sökcache: träffar sparas länge, tomma resultat (t.ex. felstavningar) kort
+CACHE_SIZE = int(os.getenv("SPOTIFY_CACHE_SIZE", 2048))
+CACHE_TTL = int(os.getenv("SPOTIFY_CACHE_TTL", 86400))
+NEGATIVE_CACHE_TTL = int(os.getenv("SPOTIFY_NEGATIVE_CACHE_TTL", 300))
+
+# Diskcachen delas av alla arbetsprocesser; tom sträng stänger av den
+CACHE_PATH = os.getenv(
+    "SPOTIFY_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "instance", "spotify_cache.db")
+)
+
+# Rensa utgångna rader på disk efter så här många skrivningar
+PRUNE_EVERY = 500
+
+
+def cache_key(query, search_types, limit, offset=0):
+    """Normaliserad nyckel så att "  Daft  punk" och "daft punk" delar cachepost"""
+    return f"{','.join(search_types)}:{limit}:{offset}:{' '.join(query.split()).casefold()}"
+
+
+def _is_empty(pages):
+    """Ett sökresultat utan några träffar (cachas bara kort)"""
+    return not any(page["items"] for page in pages.values())
+
+
+class SearchCache:
+    """Sökresultat från Spotify i två nivåer: LRU i minnet och SQLite på disk.
+
+    Minnesnivån är per process; disknivån överlever omstarter och delas av
+    alla processer. En träff på disk läggs även i minnet.
+    """
+    def __init__(self, path=CACHE_PATH, maxsize=CACHE_SIZE):
+        self.path = path
+        # Utgångstiderna är väggklocka (samma som på disk), så cachen måste mäta med time.time
+        self._memory = TLRUCache(maxsize=maxsize, ttu=lambda key, value, now: value[1], timer=time.time)
+        self._memory_lock = threading.Lock()
+        self._local = threading.local()
+        self._writes = 0
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "negative_hits": 0, "misses": 0}
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS spotify_search_cache ("
+                    "key TEXT PRIMARY KEY, items TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+            except sqlite3.Error as e:
+                print(f"Error: Spotify-cachen på disk är avstängd ({e})")
+                self.path = ""
+                return None
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        """Cachat sökresultat för nyckeln, eller None vid miss (ett tomt resultat är en träff)"""
+        now = time.time()
+        with self._memory_lock:
+            entry = self._memory.get(key)
+        if entry is not None:
+            self._count("negative_hits" if _is_empty(entry[0]) else "memory_hits")
+            return entry[0]
+
+        connection = self._connection() if self.path else None
+        if connection is not None:
+            try:
+                row = connection.execute(
+                    "SELECT items, expires_at FROM spotify_search_cache WHERE key = ? AND expires_at > ?",
+                    (key, now)
+                ).fetchone()
+            except sqlite3.Error:
+                row = None
+            if row is not None:
+                pages = json.loads(row[0])
+                with self._memory_lock:
+                    self._memory[key] = (pages, row[1])
+                self._count("negative_hits" if _is_empty(pages) else "disk_hits")
+                return pages
+
+        self._count("misses")
+        return None
+
+    def set(self, key, pages):
+        expires_at = time.time() + (NEGATIVE_CACHE_TTL if _is_empty(pages) else CACHE_TTL)
+        with self._memory_lock:
+            self._memory[key] = (pages, expires_at)
+
+        connection = self._connection() if self.path else None
+        if connection is None:
+            return
+        try:
+            connection.execute(
+                "INSERT OR REPLACE INTO spotify_search_cache (key, items, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(pages), expires_at)
+            )
+            self._writes += 1
+            if self._writes % PRUNE_EVERY == 0:
+                connection.execute("DELETE FROM spotify_search_cache WHERE expires_at <= ?", (time.time(),))
+        except sqlite3.Error as e:
+            print(f"Error: kunde inte skriva till Spotify-cachen ({e})")
+
+    def _count(self, name):
+        # Räknarna är ungefärliga vid samtidiga anrop, det räcker för dimensionering
+        self.stats[name] += 1
+
+    def info(self):
+        """Träff-/missräknare och fyllnadsgrad, för att dimensionera cachen"""
+        lookups = sum(self.stats.values())
+        hits = lookups - self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "memory_maxsize": self._memory.maxsize,
+        }
+
+    def clear(self):
+        with self._memory_lock:
+            self._memory.clear()
+        connection = self._connection() if self.path else None
+        if connection is not None:
+            connection.execute("DELETE FROM spotify_search_cache")
+
+
 class SpotifyAPI:
-    """Huvudklass för Spotify API-integration"""
+    """Huvudklass för Spotify API-integration.
+
+    En instans delas av hela processen (se `spotify_client`): den håller en
+    keep-alive-session med anslutningspool och cachar access-token tills
+    strax innan den går ut. Bara en tråd i taget hämtar ny token.
+    Sökresultat cachas i `SearchCache`.
+    """
     def __init__(self):
         self.__client_id = os.getenv("CLIENT_ID")
         self.__client_secret = os.getenv("CLIENT_SECRET")
-        self.__token = self.get_token()
+        self.__token = None
+        self.__expires_at = 0.0
+        self.__token_lock = threading.Lock()
 
-    def get_token(self):
-        """Hämtar en access token från Spotify API"""
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.cache = SearchCache()
+
+    def _request_token(self):
+        """Hämtar en ny access token från Spotify API, som (token, livslängd i sekunder)"""
         auth_string = f"{self.__client_id}:{self.__client_secret}"
         auth_bytes = auth_string.encode("utf-8")
         auth_base64 = str(base64.b64encode(auth_bytes), "utf-8")
 
-        url = "https://accounts.spotify.com/api/token"
+        url = f"{ACCOUNTS_URL}/api/token"
         headers = {
             "Authorization": "Basic " + auth_base64,
             "Content-Type": "application/x-www-form-urlencoded"
         }
         data = {"grant_type": "client_credentials"}
         
-        response = requests.post(url, headers=headers, data=data)
-        json_result = json.loads(response.content)
+        try:
+            # Samma budget och kretsbrytare som sökningarna; är Spotify nere
+            # kastas SpotifyUnavailable direkt i stället för att vänta ut TIMEOUT
+            response = scheduler.send(
+                lambda: self.session.post(url, headers=headers, data=data, timeout=TIMEOUT)
+            )
+            json_result = json.loads(response.content)
+        except (requests.RequestException, ValueError) as e:
+            print(f"Error: kunde inte hämta token ({e})")
+            return None, 0
         token = json_result.get("access_token")
 
+        return token, json_result.get("expires_in", 3600)
+
+    def _refresh_locked(self):
+        """Hämta ny token; anroparen håller låset, som släpps här"""
+        try:
+            # En annan tråd kan ha hunnit förnya medan vi väntade på låset
+            if self.__token and time.monotonic() < self.__expires_at - TOKEN_REFRESH_MARGIN:
+                return
+            requested_at = time.monotonic()
+            token, expires_in = self._request_token()
+            if token:
+                self.__token = token
+                self.__expires_at = requested_at + expires_in
+        finally:
+            self.__token_lock.release()
+
+    def _refresh_in_background(self):
+        try:
+            self._refresh_locked()
+        except SpotifyUnavailable:
+            # Den gamla token gäller fortfarande; nästa anrop försöker igen
+            pass
+
+    def get_token(self):
+        """Giltig access token från cachen; förnyas i förväg utan att anropare står och väntar.
+
+        Kastar SpotifyUnavailable om ingen token finns och Spotify inte kan nås.
+        """
+        remaining = self.__expires_at - time.monotonic()
+        if not self.__token or remaining < TOKEN_EXPIRY_MARGIN:
+            self.__token_lock.acquire()
+            self._refresh_locked()
+        elif remaining < TOKEN_REFRESH_MARGIN and self.__token_lock.acquire(blocking=False):
+            # Den gamla token gäller fortfarande: en bakgrundstråd förnyar, alla fortsätter
+            threading.Thread(target=self._refresh_in_background, daemon=True).start()
+        token = self.__token
+        if not token:
+            raise SpotifyUnavailable('Ingen access token från Spotify')
         return token
 
+    def invalidate_token(self, token):
+        """Glöm en token som Spotify har avvisat (om den inte redan bytts ut)"""
+        with self.__token_lock:
+            if self.__token == token:
+                self.__token = None
+                self.__expires_at = 0.0
+
     def get_auth_header(self):
         """Returnerar auth header för API-anrop"""
-        return {"Authorization": f"Bearer {self.__token}"}
+        return {"Authorization": f"Bearer {self.get_token()}"}
 
     def search(self, query, search_type="track", limit=1):
-        """Generisk sökfunktion för Spotify API"""
-        url = "https://api.spotify.com/v1/search"
-        headers = self.get_auth_header()
+        """Generisk sökfunktion för Spotify API (cachad); första träffen eller None"""
+        pages = self.search_many(query, [search_type], limit)
+        if not pages or not pages[search_type]["items"]:
+            return None
+        return pages[search_type]["items"][0]
+
+    def search_many(self, query, search_types, limit=10, offset=0):
+        """Sök flera typer i ett anrop (cachat).
+
+        Returnerar {typ: {"items", "total", "offset", "limit"}} med Spotifys
+        råa objekt, eller None vid fel.
+        """
+        key = cache_key(query, search_types, limit, offset)
+        pages = self.cache.get(key)
+        if pages is None:
+            try:
+                # Samtidiga identiska sökningar delar på ett anrop uppströms
+                pages = scheduler.flight.do(
+                    key, lambda: self._fetch(key, query, search_types, limit, offset)
+                )
+            except SpotifyUnavailable as e:
+                print(f"Error: {e}")
+                return None
+        return pages
+
+    def _fetch(self, key, query, search_types, limit, offset):
+        pages = self._search_pages(query, search_types, limit, offset)
+        if pages is not None:
+            # Fel från Spotify cachas inte
+            self.cache.set(key, pages)
+        return pages
+
+    def _search_pages(self, query, search_types, limit, offset):
+        """Anropar sök-API:t och returnerar en sida per typ, eller None vid fel"""
+        url = f"{API_URL}/v1/search"
         params = {
             "q": query,
-            "type": search_type,
-            "limit": limit
+            "type": ",".join(search_types),
+            "limit": limit,
+            "offset": offset
         }
         
-        response = requests.get(url, headers=headers, params=params)
+        for attempt in range(2):
+            headers = self.get_auth_header()
+            try:
+                # Budget, omförsök vid 429/5xx och kretsbrytare hanteras av schemaläggaren
+                response = scheduler.send(
+                    lambda: self.session.get(url, headers=headers, params=params, timeout=TIMEOUT)
+                )
+            except requests.RequestException as e:
+                print(f"Error: {e}")
+                return None
+            if response.status_code == 401 and attempt == 0:
+                # Token återkallad eller utgången i förtid: hämta en ny och försök igen
+                self.invalidate_token(headers["Authorization"][len("Bearer "):])
+                continue
+            break
         
         if response.status_code != 200:
             print(f"Error: {response.status_code}")
             print(response.text)
             return None
             
-        items_key = f"{search_type}s"
-        result = response.json().get(items_key, {}).get("items", [])
-        
-        return result[0] if result else None
+        body = response.json()
+        pages = {}
+        for search_type in search_types:
+            page = body.get(f"{search_type}s", {})
+            pages[search_type] = {
+                "items": [item for item in page.get("items", []) if item],
+                "total": page.get("total", 0),
+                "offset": page.get("offset", offset),
+                "limit": page.get("limit", limit)
+            }
+        return pages
+
+
+# Delad klient för hela processen
+spotify_client = SpotifyAPI()
+
+
+def track_info(track_data):
+    """Sammanställ låtinformation"""
+    return {
+        "spotify_id": track_data["id"],
+        "name": track_data["name"],
+        "artist": ", ".join(artist["name"] for artist in track_data["artists"]),
+        "album": track_data["album"]["name"],
+        "cover_url": track_data["album"]["images"][0]["url"] if track_data["album"]["images"] else None,
+        "spotify_url": track_data["external_urls"]["spotify"],
+        "embed_link": f"https://open.spotify.com/embed/track/{track_data['id']}"
+    }
+
+
+def album_info(album_data):
+    """Sammanställ albuminformation"""
+    return {
+        "spotify_id": album_data["id"],
+        "title": album_data["name"],
+        "artist": ", ".join(artist["name"] for artist in album_data["artists"]),
+        "release_date": album_data.get("release_date"),
+        "cover_url": album_data["images"][0]["url"] if album_data["images"] else None,
+        "spotify_url": album_data["external_urls"]["spotify"]
+    }
+
+
+def artist_info(artist_data):
+    """Sammanställ artistinformation"""
+    return {
+        "spotify_id": artist_data["id"],
+        "name": artist_data["name"],
+        "genres": artist_data.get("genres", []),
+        "cover_url": artist_data["images"][0]["url"] if artist_data["images"] else None,
+        "spotify_url": artist_data["external_urls"]["spotify"]
+    }
+
+
+FORMATTERS = {"track": track_info, "album": album_info, "artist": artist_info}
+SEARCH_TYPES = tuple(FORMATTERS)
+
+# Spotifys gränser för en söksida
+MAX_LIMIT = 50
+MAX_OFFSET = 1000
 
 
 class SpotifySearch:
     """Sökklass för att hämta data från Spotify"""
     def __init__(self, query):
-        self.spotify = SpotifyAPI()
+        self.spotify = spotify_client
         self.query = query
 
+    def search(self, search_types=SEARCH_TYPES, limit=10, offset=0):
+        """Flera typer och träffar i ett anrop, i samma format som get_track/get_album/get_artist.
+
+        Returnerar {"tracks": {"items", "total", "offset", "limit"}, ...} eller None vid fel.
+        """
+        pages = self.spotify.search_many(self.query, list(search_types), limit, offset)
+        if pages is None:
+            return None
+        return {
+            f"{search_type}s": {**page, "items": [FORMATTERS[search_type](item) for item in page["items"]]}
+            for search_type, page in pages.items()
+        }
+
     def get_track(self):
         """Hämtar låtinformation"""
         track_data = self.spotify.search(self.query, "track")
-        
-        if not track_data:
-            return None
-
-        # Sammanställ låtinformation
-        track_info = {
-            "name": track_data["name"],
-            "artist": ", ".join(artist["name"] for artist in track_data["artists"]),
-            "album": track_data["album"]["name"],
-            "cover_url": track_data["album"]["images"][0]["url"] if track_data["album"]["images"] else None,
-            "spotify_url": track_data["external_urls"]["spotify"],
-            "embed_link": f"https://open.spotify.com/embed/track/{track_data['id']}"
-        }
-        
-        return track_info
+        return track_info(track_data) if track_data else None
 
     def get_album(self):
         """Hämtar albuminformation"""
         album_data = self.spotify.search(self.query, "album")
-        
-        if not album_data:
-            return None
-
-        # Sammanställ albuminformation
-        album_info = {
-            "title": album_data["name"],
-            "artist": ", ".join(artist["name"] for artist in album_data["artists"]),
-            "release_date": album_data.get("release_date"),
-            "cover_url": album_data["images"][0]["url"] if album_data["images"] else None,
-            "spotify_url": album_data["external_urls"]["spotify"]
-        }
-        
-        return album_info
+        return album_info(album_data) if album_data else None
 
     def get_artist(self):
         """Hämtar artistinformation"""
         artist_data = self.spotify.search(self.query, "artist")
-        
-        if not artist_data:
-            return None
-
-        # Sammanställ artistinformation
-        artist_info = {
-            "name": artist_data["name"],
-            "genres": artist_data.get("genres", []),
-            "cover_url": artist_data["images"][0]["url"] if artist_data["images"] else None,
-            "spotify_url": artist_data["external_urls"]["spotify"]
-        }
-        
-        return artist_info
\ No newline at end of file
+        return artist_info(artist_data) if artist_data else None
@@ -0,0 +1,229 @@
+import os
+import random
+import threading
+import time
+
+import requests
+
+# Klientsidans budget mot Spotify: genomsnittlig takt och tillåten topp
+RATE = float(os.getenv('SPOTIFY_RATE', 10))
+BURST = int(os.getenv('SPOTIFY_BURST', 20))
+
+# Längsta tid ett anrop får vänta på budget eller Retry-After innan det ger upp
+MAX_WAIT = float(os.getenv('SPOTIFY_MAX_WAIT', 5))
+MAX_ATTEMPTS = 3
+BACKOFF_BASE = 0.25
+
+# Kretsbrytaren öppnar efter så många fel i rad och släpper igenom ett
+# provanrop efter RESET_TIMEOUT sekunder
+FAILURE_THRESHOLD = int(os.getenv('SPOTIFY_FAILURE_THRESHOLD', 5))
+RESET_TIMEOUT = float(os.getenv('SPOTIFY_RESET_TIMEOUT', 30))
+
+
+class SpotifyUnavailable(Exception):
+    """Spotify avvisas lokalt: kretsbrytaren är öppen eller budgeten räcker inte"""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Slår ihop identiska samtidiga anrop till ett anrop uppströms"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class TokenBucket:
+    """Token bucket med möjlighet att pausa helt (t.ex. efter 429 med Retry-After)"""
+
+    def __init__(self, rate=RATE, burst=BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """Ta en token om det går, annars hur länge man behöver vänta"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, max_wait=MAX_WAIT):
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait = self._reserve()
+            if wait == 0.0:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class CircuitBreaker:
+    """Stängd → öppen efter upprepade fel → halvöppen (ett provanrop) → stängd"""
+
+    def __init__(self, threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return 'open'
+            return 'half-open'
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._probing:
+                raise SpotifyUnavailable('Spotify är tillfälligt otillgängligt')
+            # Halvöppen: bara detta anrop släpps igenom som prov
+            self._probing = True
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def cancel(self):
+        """Anropet skickades aldrig; ett eventuellt provanrop får göras om"""
+        with self._lock:
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Väntetid före nästa försök: Retry-After om Spotify angett det, annars
+    exponentiell backoff; med slumpmässig jitter så att väntande anrop sprids ut"""
+    if retry_after is not None:
+        return retry_after + random.uniform(0, min(1.0, retry_after * 0.1 + 0.1))
+    return random.uniform(0, BACKOFF_BASE * (2 ** attempt))
+
+
+def _retry_after(response):
+    try:
+        return max(0.0, float(response.headers.get('Retry-After', 1)))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+class Scheduler:
+    """Alla sökanrop mot Spotify går härigenom"""
+
+    def __init__(self):
+        self.flight = SingleFlight()
+        self.bucket = TokenBucket()
+        self.breaker = CircuitBreaker()
+
+    def send(self, request_fn):
+        """Skicka ett anrop inom budgeten, med omförsök vid 429, 5xx och nätverksfel.
+
+        request_fn gör själva anropet och returnerar ett requests-svar. Svaret
+        från sista försöket returneras; SpotifyUnavailable kastas om anropet
+        inte får skickas.
+        """
+        self.breaker.before_call()
+        try:
+            response = self._attempts(request_fn)
+        except SpotifyUnavailable:
+            self.breaker.cancel()
+            raise
+        except Exception:
+            # Även oväntade fel räknas, så att ett provanrop aldrig blir hängande
+            self.breaker.failure()
+            raise
+
+        if response.status_code == 429 or response.status_code >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        return response
+
+    def _attempts(self, request_fn):
+        for attempt in range(MAX_ATTEMPTS):
+            last_attempt = attempt == MAX_ATTEMPTS - 1
+            if not self.bucket.acquire():
+                raise SpotifyUnavailable('Spotify-budgeten är slut för tillfället')
+
+            try:
+                response = request_fn()
+            except requests.RequestException:
+                if last_attempt:
+                    raise
+                time.sleep(backoff_delay(attempt))
+                continue
+
+            if response.status_code == 429:
+                retry_after = _retry_after(response)
+                # Pausa alla anrop i processen, inte bara detta
+                self.bucket.pause(retry_after)
+                if retry_after > MAX_WAIT or last_attempt:
+                    return response
+                time.sleep(backoff_delay(attempt, retry_after))
+            elif response.status_code >= 500 and not last_attempt:
+                time.sleep(backoff_delay(attempt))
+            else:
+                return response
+
+    def stats(self):
+        return {'circuit': self.breaker.state}
+
+
+scheduler = Scheduler()
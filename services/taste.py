@@ -0,0 +1,210 @@
+import os
+import threading
+import time
+
+import numpy as np
+from cachetools import LRUCache
+from sqlalchemy import select
+
+from models import db, user_favorite_songs, user_favorite_albums, user_favorite_artists
+from services.csr import Csr, EMPTY
+
+# Favorittyper och hur mycket en gemensam favorit av varje typ väger
+FAVORITE_TABLES = {
+    'songs': (user_favorite_songs, 'song_id'),
+    'albums': (user_favorite_albums, 'album_id'),
+    'artists': (user_favorite_artists, 'artist_id'),
+}
+TYPE_WEIGHTS = {'songs': 1.0, 'albums': 1.0, 'artists': 1.0}
+
+METRICS = ('cosine', 'jaccard')
+
+REBUILD_INTERVAL = int(os.getenv('TASTE_INDEX_TTL', 900))
+
+# Bygg om matriserna när så här många användare har ändrade favoriter
+MAX_OVERRIDES = 500
+
+# Antal grannar som sparas per användare
+NEIGHBOURS = 20
+
+
+def _similarity(metric, overlap, own_size, other_sizes):
+    """Likhet för binära favoritvektorer utifrån överlapp och storlekar"""
+    overlap = overlap.astype(np.float64)
+    if metric == 'jaccard':
+        return overlap / (own_size + other_sizes - overlap)
+    return overlap / np.sqrt(own_size * other_sizes)
+
+
+class _Snapshot:
+    """Glesa användare × objekt-matriser (och deras transponat) per favorittyp"""
+
+    def __init__(self, pairs_by_type):
+        self.by_user = {}
+        self.by_item = {}
+        for kind, pairs in pairs_by_type.items():
+            matrix = Csr.from_pairs(pairs)
+            self.by_user[kind] = matrix
+            self.by_item[kind] = matrix.transpose()
+        self.users = np.unique(np.concatenate([m.rows for m in self.by_user.values()] + [EMPTY]))
+
+
+def _load_pairs(user_id=None):
+    pairs_by_type = {}
+    for kind, (table, item_column) in FAVORITE_TABLES.items():
+        query = select(table.c.user_id, table.c[item_column]).where(
+            table.c.user_id.isnot(None), table.c[item_column].isnot(None)
+        )
+        if user_id is not None:
+            query = query.where(table.c.user_id == user_id)
+        pairs_by_type[kind] = db.session.execute(query).all()
+    return pairs_by_type
+
+
+class TasteIndex:
+    """Förberäknade "liknande musiksmak"-grannar med inkrementell uppdatering.
+
+    Favoriter som ändrats sedan matriserna byggdes hålls i ett överlägg per
+    användare; grannlistorna för användaren och alla som delar en gammal
+    eller ny favorit räknas om vid nästa läsning.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._built_at = 0.0
+        self._overrides = {}
+        # Räknas upp när favoriter ändras, så att en grannlista som räknats
+        # fram utanför låset mot gamla data inte sparas
+        self._version = 0
+        self._neighbours = LRUCache(maxsize=int(os.getenv('TASTE_CACHE_SIZE', 50000)))
+
+    def snapshot(self):
+        with self._lock:
+            stale = (
+                self._snapshot is None
+                or time.monotonic() - self._built_at > REBUILD_INTERVAL
+                or len(self._overrides) > MAX_OVERRIDES
+            )
+        if stale:
+            self.rebuild()
+        return self._snapshot
+
+    def rebuild(self):
+        snapshot = _Snapshot(_load_pairs())
+        with self._lock:
+            self._snapshot = snapshot
+            self._built_at = time.monotonic()
+            self._overrides = {}
+            self._version += 1
+            self._neighbours.clear()
+
+    @staticmethod
+    def _items(snapshot, overrides, user_id, kind):
+        override = overrides.get(user_id)
+        if override is not None:
+            return override[kind]
+        return snapshot.by_user[kind].row(user_id)
+
+    def refresh_user(self, user_id):
+        """Läs om en användares favoriter efter add/remove_favorite eller edit_profile"""
+        snapshot = self.snapshot()
+        pairs_by_type = _load_pairs(user_id)
+        items = {
+            kind: np.unique(np.array([item for _, item in pairs], dtype=np.int64))
+            for kind, pairs in pairs_by_type.items()
+        }
+        with self._lock:
+            # Alla som delar en gammal eller ny favorit får sin grannlista omräknad
+            affected = {user_id}
+            for kind in FAVORITE_TABLES:
+                old_items = self._items(snapshot, self._overrides, user_id, kind)
+                touched = np.union1d(old_items, items[kind])
+                affected.update(snapshot.by_item[kind].gather(touched).tolist())
+                for other_id, other in self._overrides.items():
+                    if len(np.intersect1d(other[kind], touched)):
+                        affected.add(other_id)
+            self._overrides[user_id] = items
+            self._version += 1
+            for affected_id in affected:
+                for metric in METRICS:
+                    self._neighbours.pop((affected_id, metric), None)
+
+    def _compute(self, snapshot, overrides, user_id, metric):
+        own = {kind: self._items(snapshot, overrides, user_id, kind) for kind in FAVORITE_TABLES}
+        active = [kind for kind in FAVORITE_TABLES if len(own[kind])]
+        if not active:
+            return []
+        total_weight = sum(TYPE_WEIGHTS[kind] for kind in active)
+        overridden = np.array(sorted(overrides), dtype=np.int64)
+
+        candidate_parts = []
+        score_parts = []
+        for kind in active:
+            weight = TYPE_WEIGHTS[kind] / total_weight
+            own_size = len(own[kind])
+
+            # Vektoriserat: alla som delar minst en favorit, och hur många de delar
+            candidates, overlap = np.unique(
+                snapshot.by_item[kind].gather(own[kind]), return_counts=True
+            )
+            keep = ~np.isin(candidates, overridden) & (candidates != user_id)
+            candidates, overlap = candidates[keep], overlap[keep]
+            sizes = snapshot.by_user[kind].lengths(candidates)
+            candidate_parts.append(candidates)
+            score_parts.append(weight * _similarity(metric, overlap, own_size, sizes))
+
+            # Användare med ändrade favoriter jämförs direkt mot sina nya listor
+            for other_id in overridden.tolist():
+                if other_id == user_id:
+                    continue
+                other_items = overrides[other_id][kind]
+                shared = len(np.intersect1d(own[kind], other_items, assume_unique=True))
+                if shared:
+                    candidate_parts.append(np.array([other_id], dtype=np.int64))
+                    score_parts.append(weight * _similarity(
+                        metric, np.array([shared]), own_size, np.array([len(other_items)])
+                    ))
+
+        if not candidate_parts:
+            return []
+        candidates, inverse = np.unique(np.concatenate(candidate_parts), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts))
+
+        if len(scores) > NEIGHBOURS:
+            top = np.argpartition(-scores, NEIGHBOURS)[:NEIGHBOURS]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.lexsort((candidates[top], -scores[top]))]
+        return [(int(candidates[i]), float(scores[i])) for i in top]
+
+    def neighbours(self, user_id, metric='cosine', limit=10):
+        """De mest lika användarna som (id, likhet), bäst först"""
+        self.snapshot()
+        key = (user_id, metric)
+        with self._lock:
+            cached = self._neighbours.get(key)
+            if cached is not None:
+                return cached[:limit]
+            # Beräkningen görs utanför låset mot en kopia av överlägget
+            snapshot, overrides, version = self._snapshot, dict(self._overrides), self._version
+        computed = self._compute(snapshot, overrides, user_id, metric)
+        with self._lock:
+            if self._version == version:
+                self._neighbours[key] = computed
+        return computed[:limit]
+
+    def shared_counts(self, user_id, other_id):
+        """Antal gemensamma favoriter per typ mellan två användare"""
+        snapshot = self.snapshot()
+        with self._lock:
+            return {
+                kind: len(np.intersect1d(
+                    self._items(snapshot, self._overrides, user_id, kind),
+                    self._items(snapshot, self._overrides, other_id, kind)
+                ))
+                for kind in FAVORITE_TABLES
+            }
+
+
+taste_index = TasteIndex()
@@ -0,0 +1,250 @@
+import heapq
+import os
+import threading
+
+from cachetools import TTLCache, cached
+from flask_sqlalchemy.pagination import Pagination
+from sqlalchemy import delete, exists, func, insert, literal, select, union
+
+from models import db, Post, TimelineEntry, followers
+from services.pagination import KeysetPage, after_filter, clamp_per_page, decode_cursor
+
+# Konton med fler följare än så här fläktas inte ut vid skrivning, utan
+# deras inlägg hämtas direkt från Post-tabellen när flödet läses
+FANOUT_FOLLOWER_LIMIT = int(os.getenv('TIMELINE_FANOUT_LIMIT', 10000))
+
+# Antal inlägg som kopieras in i tidslinjen när man börjar följa någon
+BACKFILL_LIMIT = int(os.getenv('TIMELINE_BACKFILL_LIMIT', 200))
+
+
+def follower_ids(user_id):
+    """Hämta id:n för alla som följer en användare"""
+    rows = db.session.execute(
+        select(followers.c.follower_id).where(followers.c.followed_id == user_id)
+    ).all()
+    return [follower_id for (follower_id,) in rows]
+
+
+# Anropas samtidigt från anropstrådar och utfläktningsjobb
+@cached(TTLCache(maxsize=1, ttl=60), lock=threading.Lock())
+def celebrity_ids():
+    """Användare med så många följare att de läses vid läsning istället för skrivning"""
+    rows = db.session.execute(
+        select(followers.c.followed_id).group_by(followers.c.followed_id).having(
+            func.count() >= FANOUT_FOLLOWER_LIMIT
+        )
+    ).all()
+    return frozenset(user_id for (user_id,) in rows)
+
+
+def followed_celebrity_ids(viewer_id):
+    """De konton med läsutfläktning som en användare följer"""
+    celebrities = celebrity_ids()
+    if not celebrities:
+        return []
+    rows = db.session.execute(
+        select(followers.c.followed_id).where(
+            followers.c.follower_id == viewer_id,
+            followers.c.followed_id.in_(celebrities)
+        )
+    ).all()
+    return [user_id for (user_id,) in rows]
+
+
+def fan_out_post(post, recipient_ids=None):
+    """Lägg ett nytt inlägg i författarens och följarnas tidslinjer.
+
+    Inlägget måste ha fått ett id (flush) innan. Följar-id:n returneras så att
+    anroparen kan återanvända dem, t.ex. för att ogiltigförklara cachar.
+    """
+    if recipient_ids is None:
+        recipient_ids = follower_ids(post.user_id)
+
+    targets = {post.user_id}
+    if len(recipient_ids) < FANOUT_FOLLOWER_LIMIT:
+        targets.update(recipient_ids)
+
+    db.session.execute(insert(TimelineEntry), [
+        {
+            "user_id": user_id,
+            "post_id": post.id,
+            "author_id": post.user_id,
+            "created_at": post.created_at
+        }
+        for user_id in targets
+    ])
+    return recipient_ids
+
+
+def remove_post(post_id):
+    """Ta bort ett inlägg ur alla tidslinjer och returnera vilka användare som berördes"""
+    rows = db.session.execute(
+        select(TimelineEntry.user_id).where(TimelineEntry.post_id == post_id)
+    ).all()
+    db.session.execute(delete(TimelineEntry).where(TimelineEntry.post_id == post_id))
+    return [user_id for (user_id,) in rows]
+
+
+def backfill(follower_id, followed_id):
+    """Kopiera in de senaste inläggen från ett konto man just börjat följa"""
+    if followed_id in celebrity_ids():
+        return
+
+    already_present = exists().where(
+        TimelineEntry.user_id == follower_id,
+        TimelineEntry.post_id == Post.id
+    )
+    recent_posts = select(
+        literal(follower_id), Post.id, Post.user_id, Post.created_at
+    ).where(
+        Post.user_id == followed_id, Post.deleted_at.is_(None), ~already_present
+    ).order_by(Post.created_at.desc()).limit(BACKFILL_LIMIT)
+
+    db.session.execute(insert(TimelineEntry).from_select(
+        ['user_id', 'post_id', 'author_id', 'created_at'], recent_posts
+    ))
+
+
+def prune(follower_id, followed_id):
+    """Ta bort ett kontos inlägg ur tidslinjen när man slutar följa det"""
+    db.session.execute(delete(TimelineEntry).where(
+        TimelineEntry.user_id == follower_id,
+        TimelineEntry.author_id == followed_id
+    ))
+
+
+def rebuild_all():
+    """Bygg om alla tidslinjer från Post- och followers-tabellerna.
+
+    Används för befintliga databaser som skapades innan tidslinjerna fanns.
+    """
+    db.session.execute(delete(TimelineEntry))
+
+    celebrities = celebrity_ids.__wrapped__()
+    columns = ['user_id', 'post_id', 'author_id', 'created_at']
+
+    # Egna inlägg
+    db.session.execute(insert(TimelineEntry).from_select(
+        columns, select(Post.user_id, Post.id, Post.user_id, Post.created_at)
+    ))
+
+    # Inlägg från konton man följer (utom konton med läsutfläktning)
+    followed_posts = select(
+        followers.c.follower_id, Post.id, Post.user_id, Post.created_at
+    ).join(Post, Post.user_id == followers.c.followed_id).where(
+        followers.c.follower_id != followers.c.followed_id
+    ).distinct()
+    if celebrities:
+        followed_posts = followed_posts.where(followers.c.followed_id.notin_(celebrities))
+    db.session.execute(insert(TimelineEntry).from_select(columns, followed_posts))
+
+    db.session.commit()
+
+
+def post_cursor_key(post):
+    """Sorteringsnyckel för inlägg i flöden: (created_at, id), nyast först"""
+    return (post.created_at, post.id)
+
+
+def _timeline_query(viewer_id):
+    return Post.query.join(TimelineEntry, TimelineEntry.post_id == Post.id).filter(
+        TimelineEntry.user_id == viewer_id, Post.deleted_at.is_(None)
+    )
+
+
+def _timeline_order():
+    return (TimelineEntry.created_at.desc(), TimelineEntry.post_id.desc())
+
+
+def _celebrity_query(celebrities):
+    return Post.query.filter(Post.user_id.in_(celebrities), Post.deleted_at.is_(None))
+
+
+def _merge_newest_first(*post_lists):
+    """Slå ihop redan sorterade inläggslistor i tidsordning utan dubbletter"""
+    merged = []
+    seen = set()
+    for post in heapq.merge(*post_lists, key=post_cursor_key, reverse=True):
+        if post.id in seen:
+            continue
+        seen.add(post.id)
+        merged.append(post)
+    return merged
+
+
+def _count_timeline(viewer_id, celebrities):
+    timeline_ids = select(TimelineEntry.post_id).where(TimelineEntry.user_id == viewer_id)
+    if celebrities:
+        timeline_ids = union(
+            timeline_ids, select(Post.id).where(Post.user_id.in_(celebrities), Post.deleted_at.is_(None))
+        )
+    return db.session.execute(
+        select(func.count()).select_from(timeline_ids.subquery())
+    ).scalar()
+
+
+class TimelinePagination(Pagination):
+    """Paginering över en användares materialiserade tidslinje.
+
+    Inlägg från konton med läsutfläktning slås ihop med tidslinjen vid läsning.
+    """
+
+    def _query_items(self):
+        viewer_id = self._query_args["viewer_id"]
+        celebrities = self._query_args["celebrity_ids"]
+        offset = self._query_offset
+
+        if not celebrities:
+            return _timeline_query(viewer_id).order_by(*_timeline_order()).offset(
+                offset
+            ).limit(self.per_page).all()
+
+        # Läs lika många rader från båda källorna och slå ihop dem i tidsordning
+        depth = offset + self.per_page
+        timeline_posts = _timeline_query(viewer_id).order_by(*_timeline_order()).limit(depth).all()
+        celebrity_posts = _celebrity_query(celebrities).order_by(
+            Post.created_at.desc(), Post.id.desc()
+        ).limit(depth).all()
+
+        return _merge_newest_first(timeline_posts, celebrity_posts)[offset:depth]
+
+    def _query_count(self):
+        return _count_timeline(self._query_args["viewer_id"], self._query_args["celebrity_ids"])
+
+
+def paginate_timeline(viewer_id, page, per_page):
+    """Hämta en sida ur en användares hemflöde"""
+    return TimelinePagination(
+        page=page,
+        per_page=per_page,
+        viewer_id=viewer_id,
+        celebrity_ids=followed_celebrity_ids(viewer_id)
+    )
+
+
+def timeline_after(viewer_id, cursor, per_page, count=False):
+    """Hämta sidan efter cursorn ur en användares hemflöde (keyset-paginering)"""
+    values = decode_cursor(cursor, 2)
+    per_page = clamp_per_page(per_page)
+    celebrities = followed_celebrity_ids(viewer_id)
+
+    query = _timeline_query(viewer_id)
+    if values is not None:
+        query = query.filter(after_filter(
+            [TimelineEntry.created_at, TimelineEntry.post_id], values, descending=True
+        ))
+    posts = query.order_by(*_timeline_order()).limit(per_page + 1).all()
+
+    if celebrities:
+        celebrity_query = _celebrity_query(celebrities)
+        if values is not None:
+            celebrity_query = celebrity_query.filter(after_filter(
+                [Post.created_at, Post.id], values, descending=True
+            ))
+        celebrity_posts = celebrity_query.order_by(
+            Post.created_at.desc(), Post.id.desc()
+        ).limit(per_page + 1).all()
+        posts = _merge_newest_first(posts, celebrity_posts)[:per_page + 1]
+
+    total = _count_timeline(viewer_id, celebrities) if count else None
+    return KeysetPage(posts, per_page, post_cursor_key, total=total)
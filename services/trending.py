@@ -0,0 +1,208 @@
+import math
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from cachetools import TTLCache
+from sqlalchemy import and_, delete, or_, select
+
+from models import db, Post, Like, TrendingScore, Song, Album, Artist, insert_ignoring_duplicates
+from services.post_hydration import serialize_song, serialize_album, serialize_artist
+
+# Fönster som kan väljas i /api/trending. Varje händelse väger e^(-ålder/fönster),
+# så en gillning som är ett fönster gammal väger ungefär en tredjedel.
+WINDOWS = {
+    '1h': timedelta(hours=1),
+    '24h': timedelta(hours=24),
+    '7d': timedelta(days=7),
+}
+DEFAULT_WINDOW = '24h'
+
+POST_WEIGHT = 1.0
+LIKE_WEIGHT = 1.0
+
+# Fast referenspunkt för de logaritmiska poängen
+EPOCH = datetime(2024, 1, 1)
+
+# Händelser äldre än så här många fönster bidrar mindre än e^-20 och hoppas över
+HORIZON_WINDOWS = 20
+
+MUSIC_MODELS = {
+    'song': (Song, serialize_song),
+    'album': (Album, serialize_album),
+    'artist': (Artist, serialize_artist),
+}
+
+# Försök per fönster innan record ger upp när andra skriver samma rad
+MAX_RETRIES = 10
+
+# Färdiga topplistor per fönster och längd; räcker att räkna om några gånger i minuten
+# Delas av anropstrådar och jobb; cachetools-cacher är inte trådsäkra
+_top_cache = TTLCache(maxsize=64, ttl=int(os.getenv('TRENDING_CACHE_TTL', 15)))
+_top_lock = threading.Lock()
+
+
+def _growth(at, window):
+    """Exponenten (t - epok) / fönster för en händelse vid tidpunkten at"""
+    return (at - EPOCH).total_seconds() / WINDOWS[window].total_seconds()
+
+
+def _logaddexp(a, b):
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(low - high))
+
+
+def music_item(post):
+    """(typ, id) för musiken som är kopplad till ett inlägg, eller None"""
+    if post.song_id:
+        return 'song', post.song_id
+    if post.album_id:
+        return 'album', post.album_id
+    if post.artist_id:
+        return 'artist', post.artist_id
+    return None
+
+
+def _insert_score(values):
+    """Lägg till en poängrad om ingen annan hunnit före; False om raden redan fanns"""
+    statement = insert_ignoring_duplicates(TrendingScore.__table__).values(values)
+    return db.session.execute(statement).rowcount > 0
+
+
+def _record_window(item_type, item_id, window, weight, contribution):
+    """Uppdatera ett fönsters poäng atomiskt.
+
+    Den nya poängen räknas i Python och skrivs med villkoret att den gamla
+    är oförändrad (compare-and-swap). Har en annan process hunnit skriva
+    emellan läses raden om och försöket görs om, så samtidiga händelser
+    varken skriver över varandra eller krockar på uq_trending_item.
+    """
+    table = TrendingScore.__table__
+    key = (table.c.window == window, table.c.item_type == item_type, table.c.item_id == item_id)
+    for _ in range(MAX_RETRIES):
+        current = db.session.execute(select(table.c.log_score).where(*key)).scalar()
+        if current is None:
+            if weight < 0 or _insert_score({
+                'window': window, 'item_type': item_type, 'item_id': item_id, 'log_score': contribution
+            }):
+                return
+            continue
+
+        unchanged = (*key, table.c.log_score == current)
+        if weight > 0:
+            statement = table.update().where(*unchanged).values(log_score=_logaddexp(current, contribution))
+        elif contribution >= current:
+            # log(e^a - e^b); försvinner hela poängen tas raden bort
+            statement = table.delete().where(*unchanged)
+        else:
+            statement = table.update().where(*unchanged).values(
+                log_score=current + math.log1p(-math.exp(contribution - current))
+            )
+        if db.session.execute(statement).rowcount:
+            return
+    raise RuntimeError(f"Trendpoängen för {item_type} {item_id} ({window}) ändrades hela tiden")
+
+
+def record(item_type, item_id, weight, at):
+    """Lägg till (eller dra ifrån, om weight < 0) en händelse i alla fönster"""
+    for window in WINDOWS:
+        contribution = math.log(abs(weight)) + _growth(at, window)
+        _record_window(item_type, item_id, window, weight, contribution)
+
+
+def record_post(post):
+    item = music_item(post)
+    if item:
+        record(item[0], item[1], POST_WEIGHT, post.created_at)
+
+
+def record_like(post, like, removed=False):
+    item = music_item(post)
+    if item:
+        record(item[0], item[1], -LIKE_WEIGHT if removed else LIKE_WEIGHT, like.created_at)
+
+
+def top(window=DEFAULT_WINDOW, limit=5):
+    """Topplistor per musiktyp för ett fönster, med aktuell poäng i popularity_score"""
+    key = (window, limit)
+    with _top_lock:
+        cached = _top_cache.get(key)
+    if cached is not None:
+        return cached
+
+    now_growth = _growth(datetime.utcnow(), window)
+    result = {}
+    for item_type, (model, serialize) in MUSIC_MODELS.items():
+        ranked = TrendingScore.query.filter_by(window=window, item_type=item_type).order_by(
+            TrendingScore.log_score.desc()
+        ).limit(limit).all()
+
+        items = {}
+        if ranked:
+            items = {
+                item.id: item
+                for item in model.query.filter(model.id.in_([row.item_id for row in ranked])).all()
+            }
+
+        result[item_type] = []
+        for row in ranked:
+            if row.item_id not in items:
+                continue
+            item_data = serialize(items[row.item_id])
+            item_data["popularity_score"] = round(math.exp(row.log_score - now_growth), 3)
+            result[item_type].append(item_data)
+
+    with _top_lock:
+        _top_cache[key] = result
+    return result
+
+
+def compact(window=None, now=None):
+    """Räkna om poängen från inlägg och gillningar inom horisonten.
+
+    Körs periodiskt. Rättar drift från borttagna inlägg och samtidiga
+    skrivningar, och rensar bort poster som avklingat till nära noll.
+    Inlägg och gillningar summeras var för sig, så en gillning räknas
+    exakt en gång.
+    """
+    now = now or datetime.utcnow()
+    windows = [window] if window else list(WINDOWS)
+
+    for window in windows:
+        since = now - WINDOWS[window] * HORIZON_WINDOWS
+        scores = defaultdict(lambda: float('-inf'))
+
+        # Borttagna inlägg som väntar på purge_post räknas inte
+        counted = and_(
+            or_(Post.song_id.isnot(None), Post.album_id.isnot(None), Post.artist_id.isnot(None)),
+            Post.deleted_at.is_(None)
+        )
+        posts = db.session.query(
+            Post.song_id, Post.album_id, Post.artist_id, Post.created_at
+        ).filter(counted, Post.created_at >= since).all()
+        likes = db.session.query(
+            Post.song_id, Post.album_id, Post.artist_id, Like.created_at
+        ).join(Like, Like.post_id == Post.id).filter(counted, Like.created_at >= since).all()
+
+        for rows, weight in ((posts, POST_WEIGHT), (likes, LIKE_WEIGHT)):
+            for song_id, album_id, artist_id, at in rows:
+                if song_id:
+                    item = ('song', song_id)
+                elif album_id:
+                    item = ('album', album_id)
+                elif artist_id:
+                    item = ('artist', artist_id)
+                else:
+                    continue
+                scores[item] = _logaddexp(scores[item], math.log(weight) + _growth(at, window))
+
+        db.session.execute(delete(TrendingScore).where(TrendingScore.window == window))
+        db.session.add_all([
+            TrendingScore(window=window, item_type=item_type, item_id=item_id, log_score=log_score)
+            for (item_type, item_id), log_score in scores.items()
+        ])
+
+    db.session.commit()
+    with _top_lock:
+        _top_cache.clear()
@@ -0,0 +1,174 @@
+from flask import current_app
+from sqlalchemy import bindparam, case, column, func, inspect, select, table, text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from models import db, User, Profile, username_key
+from services.follow_graph import follow_graph
+
+# Trigram-index: kortare söktermer matchas bara som prefix via uttrycksindexet
+MIN_SUBSTRING_LENGTH = 3
+
+_fts_table = table('user_search', column('rowid'), column('username_key'))
+
+_SQLITE_INDEX = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5("
+    "username_key, content='user', content_rowid='id', tokenize='trigram')",
+    # Triggrar håller indexet i synk vid registrering, namnbyte och borttagning
+    "CREATE TRIGGER IF NOT EXISTS user_search_ai AFTER INSERT ON user BEGIN "
+    "INSERT INTO user_search(rowid, username_key) VALUES (new.id, new.username_key); END",
+    "CREATE TRIGGER IF NOT EXISTS user_search_ad AFTER DELETE ON user BEGIN "
+    "INSERT INTO user_search(user_search, rowid, username_key) VALUES ('delete', old.id, old.username_key); END",
+    "CREATE TRIGGER IF NOT EXISTS user_search_au AFTER UPDATE OF username_key ON user BEGIN "
+    "INSERT INTO user_search(user_search, rowid, username_key) VALUES ('delete', old.id, old.username_key); "
+    "INSERT INTO user_search(rowid, username_key) VALUES (new.id, new.username_key); END",
+]
+
+# Äldre index på username/lower(username), ersatta av username_key
+_SQLITE_OLD_INDEX = [
+    "DROP TRIGGER IF EXISTS user_search_ai",
+    "DROP TRIGGER IF EXISTS user_search_ad",
+    "DROP TRIGGER IF EXISTS user_search_au",
+    "DROP TABLE IF EXISTS user_search",
+    "DROP INDEX IF EXISTS ix_user_username_lower",
+]
+
+_POSTGRES_OLD_INDEX = [
+    "DROP INDEX IF EXISTS ix_user_username_trgm",
+]
+
+_POSTGRES_INDEX = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    'CREATE INDEX IF NOT EXISTS ix_user_username_key_trgm ON "user" USING gin (username_key gin_trgm_ops)',
+]
+
+
+def ensure_index(app):
+    """Skapa sökindexet för användarnamn om det saknas"""
+    state = app.extensions.setdefault('user_search', {'fts': False})
+    dialect = db.engine.dialect.name
+
+    try:
+        if dialect == 'sqlite':
+            exists = db.session.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_search'"
+            )).first()
+            for statement in _SQLITE_INDEX:
+                db.session.execute(text(statement))
+            if not exists:
+                # Fyll ett nytt index med befintliga användare
+                db.session.execute(text("INSERT INTO user_search(user_search) VALUES ('rebuild')"))
+            state['fts'] = True
+        elif dialect == 'postgresql':
+            for statement in _POSTGRES_INDEX:
+                db.session.execute(text(statement))
+        db.session.commit()
+    except (OperationalError, ProgrammingError):
+        # T.ex. SQLite utan FTS5/trigram eller saknade rättigheter för pg_trgm;
+        # sökningen faller då tillbaka på LIKE
+        db.session.rollback()
+        state['fts'] = False
+
+
+def ensure_username_keys():
+    """Lägg till och fyll username_key i en befintlig user-tabell och bygg om sökindexet.
+
+    Nycklarna räknas fram i Python (casefold), som vid sparning.
+    """
+    dialect = db.engine.dialect.name
+    old_index = {'sqlite': _SQLITE_OLD_INDEX, 'postgresql': _POSTGRES_OLD_INDEX}.get(dialect, [])
+    for statement in old_index:
+        db.session.execute(text(statement))
+    db.session.commit()
+
+    existing = {column['name'] for column in inspect(db.engine).get_columns(User.__tablename__)}
+    if 'username_key' not in existing:
+        db.session.execute(text('ALTER TABLE "user" ADD COLUMN username_key VARCHAR(80)'))
+        db.session.commit()
+
+    table = User.__table__
+    rows = db.session.execute(select(table.c.id, table.c.username, table.c.username_key)).all()
+    changes = [
+        {'row_id': row.id, 'new_key': username_key(row.username)}
+        for row in rows if row.username_key != username_key(row.username)
+    ]
+    if changes:
+        db.session.execute(
+            table.update().where(table.c.id == bindparam('row_id')).values(username_key=bindparam('new_key')),
+            changes
+        )
+    db.session.commit()
+    for index in table.indexes:
+        index.create(db.engine, checkfirst=True)
+    ensure_index(current_app)
+    return len(changes)
+
+
+def _escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _fts_phrase(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+def relevance(term):
+    """Relevansgrupp: 0 = exakt träff, 1 = prefix, 2 = delsträng"""
+    return case(
+        (User.username_key == term, 0),
+        (User.username_key.like(_escape_like(term) + '%', escape='\\'), 1),
+        else_=2
+    )
+
+
+def relevance_key(user, term):
+    """Samma sorteringsnyckel som search() använder, beräknad för en hämtad användare"""
+    key = username_key(user.username)
+    group = 0 if key == term else 1 if key.startswith(term) else 2
+    return (group, len(key), key, user.id)
+
+
+def normalize(query):
+    # Samma casefold som username_key; SQLites lower() klarar bara ASCII
+    return username_key(query.strip())
+
+
+def search(term):
+    """Fråga och sorteringsnycklar för användare som matchar en normaliserad sökterm.
+
+    Med FTS5-indexet matchas delsträngar via trigram och korta termer som prefix
+    via indexet på username_key. Träffarna sorteras på relevans, sedan kortare
+    namn först.
+    """
+    use_fts = current_app.extensions.get('user_search', {}).get('fts', False)
+    key = User.username_key
+
+    if use_fts and len(term) >= MIN_SUBSTRING_LENGTH:
+        candidates = select(_fts_table.c.rowid).where(
+            text('user_search MATCH :phrase').bindparams(phrase=_fts_phrase(term))
+        )
+        query = User.query.filter(User.id.in_(candidates))
+    elif use_fts:
+        # Intervallfråga som kan använda indexet på username_key
+        query = User.query.filter(key >= term, key < term + '\U0010ffff')
+    else:
+        query = User.query.filter(key.like('%' + _escape_like(term) + '%', escape='\\'))
+
+    keys = [relevance(term), func.length(key), key, User.id]
+    return query, keys
+
+
+def profiles_for(user_ids):
+    """Profiler för en sida användare, i en fråga"""
+    if not user_ids:
+        return {}
+    profiles = {}
+    for profile in Profile.query.filter(Profile.user_id.in_(user_ids)).all():
+        profiles.setdefault(profile.user_id, profile)
+    return profiles
+
+
+def followed_among(viewer_id, user_ids):
+    """Vilka av användarna som tittaren följer, ur följgrafen i minnet (ingen fråga)"""
+    if not user_ids:
+        return set()
+    return follow_graph.followed_among(viewer_id, user_ids)